@@ -0,0 +1,137 @@
+"""
+Throughput benchmark for the REST API with SQL query budgets.
+
+Seeds (or reuses, with ``--keepdb``) a realistic dataset, then drives each
+endpoint through the full Django stack with the test client and reports
+requests/sec, latency percentiles, SQL queries and rows fetched per request.
+Every endpoint declares a query budget; the run exits with status 1 when an
+endpoint goes over it, so N+1 regressions fail the build instead of shipping.
+
+    python -m benchmarks.api --scale 0.1 --requests 200 --keepdb
+"""
+import argparse
+import json
+import sys
+import time
+from dataclasses import dataclass
+
+from benchmarks.fixtures import PREFIX, is_seeded, seed_scaled
+from benchmarks.harness import QueryCounter, benchmark_database, summarize
+from core.auth import create_access_token
+from django.db.models import Count
+from django.test import Client
+from groups.models import Group, Message
+from images.models import Image
+
+
+@dataclass
+class Endpoint:
+    name: str
+    path: str
+    query_budget: int
+
+
+ENDPOINTS = [
+    Endpoint('groups.search', '/api/groups/search?query=study', query_budget=2),
+    Endpoint('groups.list', '/api/groups/', query_budget=1),
+    Endpoint('groups.public', '/api/groups/public/', query_budget=1),
+    Endpoint('groups.unread', '/api/groups/unread', query_budget=1),
+    Endpoint('groups.messages', '/api/groups/{group_id}/messages', query_budget=1),
+    Endpoint('images.list', '/api/images/', query_budget=1),
+    Endpoint('auth.me', '/api/auth/me', query_budget=0),
+]
+
+
+def pick_subject():
+    """The owner of the busiest group: the worst case for most endpoints."""
+    busiest = (
+        Message.objects.values('group_id').annotate(total=Count('id')).order_by('-total').first()
+    )
+    group = Group.objects.get(id=busiest['group_id'])
+    if not Image.objects.filter(user_id=group.owner_id).exists():
+        Image.objects.bulk_create(
+            Image(user_id=group.owner_id, title=f'{PREFIX} {i}', image=f'user_images/{PREFIX}-{i}.jpg')
+            for i in range(200)
+        )
+    return group.owner_id, group.id
+
+
+def measure(client: Client, endpoint: Endpoint, path: str, headers: dict, requests: int, warmup: int, counter: QueryCounter) -> dict:
+    for _ in range(warmup):
+        response = client.get(path, **headers)
+        if response.status_code != 200:
+            raise RuntimeError(f'{endpoint.name}: {path} returned {response.status_code}: {response.content[:200]!r}')
+
+    latencies = []
+    max_queries = 0
+    total_queries = 0
+    total_rows = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        counter.reset()
+        request_started = time.perf_counter()
+        client.get(path, **headers)
+        latencies.append(time.perf_counter() - request_started)
+        max_queries = max(max_queries, counter.queries)
+        total_queries += counter.queries
+        total_rows += counter.rows
+    elapsed = time.perf_counter() - started
+
+    return {
+        'endpoint': endpoint.name,
+        'requests_per_sec': requests / elapsed,
+        **{key: value for key, value in summarize(latencies).items() if key != 'count'},
+        'queries': total_queries / requests,
+        'max_queries': max_queries,
+        'query_budget': endpoint.query_budget,
+        'rows': total_rows / requests,
+        'over_budget': max_queries > endpoint.query_budget,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1.0, help='Dataset size relative to 10k users / 50k groups / 5M messages')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--only', action='append', help='Endpoint name to run (repeatable)')
+    parser.add_argument('--keepdb', action='store_true')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    results = []
+    with benchmark_database(keepdb=args.keepdb):
+        if not is_seeded():
+            seed_scaled(args.scale)
+        user_id, group_id = pick_subject()
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {create_access_token(user_id=user_id)}'}
+        client = Client()
+        counter = QueryCounter()
+        try:
+            for endpoint in ENDPOINTS:
+                if args.only and endpoint.name not in args.only:
+                    continue
+                path = endpoint.path.format(group_id=group_id)
+                results.append(measure(client, endpoint, path, headers, args.requests, args.warmup, counter))
+        finally:
+            counter.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'endpoint':<18}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'budget':>8}{'rows':>9}")
+        for r in results:
+            flag = '  OVER BUDGET' if r['over_budget'] else ''
+            print(
+                f"{r['endpoint']:<18}{r['requests_per_sec']:>9.1f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}"
+                f"{r['p99_ms']:>9.2f}{r['max_queries']:>9}{r['query_budget']:>8}{r['rows']:>9.1f}{flag}"
+            )
+
+    over = [r['endpoint'] for r in results if r['over_budget']]
+    if over:
+        print(f"Query budget exceeded by: {', '.join(over)}", file=sys.stderr)
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
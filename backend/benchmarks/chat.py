@@ -0,0 +1,168 @@
+"""
+WebSocket load and latency benchmark for the chat hot path.
+
+Boots ``core.asgi.application`` in-process with the in-memory channel layer
+and a throwaway PostgreSQL database, connects ``--groups`` x ``--clients``
+sockets and has them chat. Reports connect rate, fan-out latency percentiles
+(send -> delivery at each recipient), messages/sec and database queries per
+message. No network services are needed besides the local database server.
+
+    python -m benchmarks.chat --groups 10 --clients 50 --messages 200
+
+Use ``--max-p99-ms`` / ``--min-messages-per-sec`` / ``--max-queries-per-message``
+to turn it into a release gate: the exit status is 1 when a budget is missed.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchmarks.harness import (
+    QueryCounter,
+    benchmark_database,
+    create_group,
+    create_users,
+    summarize,
+    tokens_for,
+)
+from channels.testing import WebsocketCommunicator
+from core.asgi import application
+from core.codec import codec
+from groups.sink import get_message_sink
+
+ORIGIN = [(b'origin', b'http://localhost')]
+
+
+async def connect(group_id: int, token: str) -> WebsocketCommunicator:
+    communicator = WebsocketCommunicator(application, f'/ws/chat/{group_id}/?token={token}', headers=ORIGIN)
+    connected, _ = await communicator.connect()
+    if not connected:
+        raise RuntimeError(f'Socket for group {group_id} was rejected')
+    return communicator
+
+
+async def discard_pending(communicator: WebsocketCommunicator):
+    while not await communicator.receive_nothing(timeout=0.01):
+        await communicator.receive_from()
+
+
+async def collect(communicator: WebsocketCommunicator, expected: int, sent_at: dict, latencies: list, timeout: float):
+    """Receive ``expected`` chat messages and record their fan-out latency."""
+    received = 0
+    while received < expected:
+        frame = codec.loads(await communicator.receive_from(timeout=timeout))
+        if frame['type'] != 'message':
+            continue
+        latencies.append(time.perf_counter() - sent_at[frame['message']])
+        received += 1
+
+
+async def run(groups, messages_per_group: int, timeout: float, counter: QueryCounter) -> dict:
+    # Connect phase
+    started = time.perf_counter()
+    sockets = {}
+    for group_id, tokens in groups.items():
+        sockets[group_id] = await asyncio.gather(*(connect(group_id, token) for token in tokens))
+    connect_seconds = time.perf_counter() - started
+    connections = sum(len(clients) for clients in sockets.values())
+
+    await asyncio.sleep(0.1)
+    for clients in sockets.values():
+        await asyncio.gather(*(discard_pending(client) for client in clients))
+
+    # Messaging phase
+    counter.reset()
+    sent_at = {}
+    latencies = []
+    collectors = [
+        asyncio.ensure_future(collect(client, messages_per_group, sent_at, latencies, timeout))
+        for clients in sockets.values()
+        for client in clients
+    ]
+    started = time.perf_counter()
+    for i in range(messages_per_group):
+        for group_id, clients in sockets.items():
+            text = f'g{group_id}-m{i}'
+            sent_at[text] = time.perf_counter()
+            await clients[i % len(clients)].send_to(text_data=json.dumps({'message': text}))
+        # Let the worker breathe like a real event loop would between frames
+        await asyncio.sleep(0)
+    await asyncio.gather(*collectors)
+    elapsed = time.perf_counter() - started
+
+    # Persisting is part of the cost of a message, so count the final flush too
+    await get_message_sink().flush()
+    total_messages = messages_per_group * len(sockets)
+    queries = counter.queries
+
+    for clients in sockets.values():
+        await asyncio.gather(*(client.disconnect() for client in clients))
+
+    return {
+        'groups': len(sockets),
+        'connections': connections,
+        'connects_per_sec': connections / connect_seconds,
+        'messages': total_messages,
+        'deliveries': len(latencies),
+        'messages_per_sec': total_messages / elapsed,
+        'deliveries_per_sec': len(latencies) / elapsed,
+        'queries_per_message': queries / total_messages,
+        **{f'fanout_{key}': value for key, value in summarize(latencies).items() if key != 'count'},
+        'codec': codec.name,
+    }
+
+
+def check_budgets(result: dict, args) -> list:
+    failures = []
+    if args.max_p99_ms is not None and result['fanout_p99_ms'] > args.max_p99_ms:
+        failures.append(f"p99 fan-out {result['fanout_p99_ms']:.2f}ms > {args.max_p99_ms}ms")
+    if args.min_messages_per_sec is not None and result['messages_per_sec'] < args.min_messages_per_sec:
+        failures.append(f"{result['messages_per_sec']:.0f} messages/sec < {args.min_messages_per_sec}")
+    if args.max_queries_per_message is not None and result['queries_per_message'] > args.max_queries_per_message:
+        failures.append(f"{result['queries_per_message']:.3f} queries/message > {args.max_queries_per_message}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=20, help='Sockets per group')
+    parser.add_argument('--messages', type=int, default=100, help='Messages sent per group')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--keepdb', action='store_true')
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    parser.add_argument('--max-p99-ms', type=float)
+    parser.add_argument('--min-messages-per-sec', type=float)
+    parser.add_argument('--max-queries-per-message', type=float)
+    args = parser.parse_args()
+
+    with benchmark_database(keepdb=args.keepdb):
+        users = create_users(args.groups * args.clients, prefix='chatbench')
+        tokens = tokens_for(users)
+        groups = {}
+        for g in range(args.groups):
+            members = users[g * args.clients:(g + 1) * args.clients]
+            group = create_group(members[0], members, name=f'Chat benchmark {g}')
+            groups[group.id] = [tokens[member.id] for member in members]
+
+        counter = QueryCounter()
+        try:
+            result = asyncio.run(run(groups, args.messages, args.timeout, counter))
+        finally:
+            counter.close()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print(f'{key:>22}: {value:.2f}' if isinstance(value, float) else f'{key:>22}: {value}')
+
+    failures = check_budgets(result, args)
+    for failure in failures:
+        print(f'BUDGET EXCEEDED: {failure}', file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
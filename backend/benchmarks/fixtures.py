@@ -0,0 +1,138 @@
+"""
+Realistic dataset generator for the API benchmarks.
+
+Defaults match production-like volume (10k users, 50k groups, 5M messages);
+``--scale`` shrinks everything proportionally for quick runs. Messages are
+generated inside PostgreSQL with ``generate_series`` and skewed so that a
+few groups are very busy, like real chat traffic.
+
+    python -m benchmarks.fixtures --scale 0.1 --keepdb
+"""
+import argparse
+import random
+import time
+
+from benchmarks.harness import benchmark_database, create_users
+from django.db import connection, transaction
+from groups.models import Group, Message
+from images.models import Image
+
+PREFIX = 'apibench'
+WORDS = (
+    'study', 'math', 'physics', 'book', 'club', 'running', 'design', 'python',
+    'history', 'music', 'weekend', 'project', 'exam', 'notes', 'chemistry', 'art',
+)
+
+
+def is_seeded() -> bool:
+    return Group.objects.filter(name__startswith=f'{PREFIX} ').exists()
+
+
+def _phrase(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+@transaction.atomic
+def seed(users: int = 10000, groups: int = 50000, messages: int = 5000000,
+         members_per_group: int = 10, images_per_user: int = 20, random_seed: int = 42, verbose: bool = True):
+    rng = random.Random(random_seed)
+    started = time.perf_counter()
+
+    def log(step):
+        if verbose:
+            print(f'[{time.perf_counter() - started:7.1f}s] {step}')
+
+    people = create_users(users, prefix=PREFIX)
+    log(f'{len(people)} users')
+
+    Group.objects.bulk_create(
+        [
+            Group(
+                owner=rng.choice(people),
+                name=f'{PREFIX} {_phrase(rng, 2)} {i}',
+                goal=_phrase(rng, 6),
+                description=_phrase(rng, 20),
+                public=rng.random() < 0.3,
+            )
+            for i in range(groups)
+        ],
+        batch_size=5000,
+    )
+    group_rows = list(Group.objects.filter(name__startswith=f'{PREFIX} ').values_list('id', 'owner_id'))
+    log(f'{len(group_rows)} groups')
+
+    Membership = Group.members.through
+    memberships = []
+    for group_id, owner_id in group_rows:
+        member_ids = {owner_id, *(rng.choice(people).id for _ in range(rng.randint(1, members_per_group * 2)))}
+        memberships.extend(Membership(group_id=group_id, user_id=user_id) for user_id in member_ids)
+    Membership.objects.bulk_create(memberships, batch_size=10000)
+    # bulk_create skips the signals that maintain the denormalized counts
+    Group.objects.filter(name__startswith=f'{PREFIX} ').recount_members()
+    log(f'{len(memberships)} memberships')
+
+    # A power-law pick over memberships makes a handful of groups very busy
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE TEMP TABLE bench_senders ON COMMIT DROP AS
+            SELECT row_number() OVER () - 1 AS idx, group_id, user_id FROM {Membership._meta.db_table}
+            """
+        )
+        cursor.execute("CREATE INDEX ON bench_senders (idx)")
+        cursor.execute(
+            f"""
+            INSERT INTO {Message._meta.db_table} (group_id, sender_id, content, created_at)
+            SELECT s.group_id, s.user_id,
+                   'benchmark message ' || picks.n || ' about ' || (ARRAY{list(WORDS)})[1 + picks.n %% {len(WORDS)}],
+                   now() - make_interval(secs => picks.n * 5)
+            FROM (
+                SELECT n, floor(%s * power(random(), 3))::bigint AS idx
+                FROM generate_series(1, %s) AS n
+            ) AS picks
+            JOIN bench_senders s ON s.idx = picks.idx
+            """,
+            [len(memberships), messages],
+        )
+    Group.objects.filter(name__startswith=f'{PREFIX} ').recount_messages()
+    log(f'{messages} messages')
+
+    Image.objects.bulk_create(
+        [
+            Image(user=person, title=f'{_phrase(rng, 2)} {i}', description=_phrase(rng, 8), image=f'user_images/{PREFIX}-{person.id}-{i}.jpg')
+            for person in people[:max(1, users // 10)]
+            for i in range(images_per_user)
+        ],
+        batch_size=5000,
+    )
+    log('images')
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    log('done')
+
+
+def seed_scaled(scale: float, verbose: bool = True):
+    seed(
+        users=max(10, int(10000 * scale)),
+        groups=max(10, int(50000 * scale)),
+        messages=max(100, int(5000000 * scale)),
+        verbose=verbose,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--keepdb', action='store_true', help='Keep the seeded database for later benchmark runs')
+    args = parser.parse_args()
+
+    with benchmark_database(keepdb=args.keepdb):
+        if is_seeded():
+            print('Database already seeded')
+        else:
+            seed_scaled(args.scale)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Shared helpers for the benchmarks: database lifecycle, seeding and stats.
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django
+
+django.setup()
+
+import math
+import statistics
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Sequence
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from core.auth import create_access_token
+from groups.models import Group
+
+User = get_user_model()
+
+
+@contextmanager
+def benchmark_database(keepdb: bool = False):
+    """Create (and afterwards drop) a migrated ``test_<NAME>`` database."""
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+
+def create_users(count: int, prefix: str = 'bench') -> List:
+    password = make_password(None)
+    User.objects.bulk_create(
+        [
+            User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password=password)
+            for i in range(count)
+        ],
+        batch_size=1000,
+    )
+    return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+
+def create_group(owner, members: Sequence, name: str, public: bool = False) -> Group:
+    group = Group.objects.create(owner=owner, name=name, goal='Benchmark', description='Benchmark group', public=public)
+    group.members.add(*members)
+    return group
+
+
+def tokens_for(users) -> Dict[int, str]:
+    return {user.id: create_access_token(user_id=user.id) for user in users}
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize(values: Sequence[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds for values given in seconds."""
+    return {
+        'count': len(values),
+        'mean_ms': statistics.fmean(values) * 1000 if values else float('nan'),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+    }
+
+
+class QueryCounter:
+    """
+    Counts SQL statements (and rows, where the driver reports them) on every
+    database connection, including the ones opened by worker threads.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+        connection_created.connect(self._on_connection_created, weak=False)
+        for conn in connections.all(initialized_only=True):
+            self._attach(conn)
+
+    def _attach(self, conn):
+        if self not in conn.execute_wrappers:
+            conn.execute_wrappers.append(self)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        self._attach(connection)
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        rowcount = getattr(context['cursor'], 'rowcount', -1)
+        with self._lock:
+            self.queries += 1
+            if rowcount and rowcount > 0:
+                self.rows += rowcount
+        return result
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.rows = 0
+
+    def close(self):
+        connection_created.disconnect(self._on_connection_created)
+        for conn in connections.all(initialized_only=True):
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
@@ -0,0 +1,56 @@
+"""
+Settings for the offline benchmarks.
+
+Everything that would need a network service is swapped for an in-process
+equivalent; the database is a throwaway copy created on the configured
+PostgreSQL server (see ``benchmarks.harness.benchmark_database``).
+"""
+import tempfile
+
+from core.settings import *  # noqa: F401,F403
+from core.settings import MESSAGE_SINK, PRESENCE, RECENT_MESSAGES, SECRET_KEY
+
+SECRET_KEY = SECRET_KEY or 'benchmark-secret-key'
+DEBUG = False
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': 10000},
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+MESSAGE_SINK = {
+    **MESSAGE_SINK,
+    'SPOOL_DIR': tempfile.mkdtemp(prefix='noted-bench-spool-'),
+}
+
+PRESENCE = {
+    **PRESENCE,
+    'BACKEND': 'memory',
+}
+
+RECENT_MESSAGES = {
+    **RECENT_MESSAGES,
+    'BACKEND': 'memory',
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': 'WARNING',
+    },
+}
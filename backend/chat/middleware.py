@@ -1,39 +0,0 @@
-from urllib.parse import parse_qs
-
-import jwt
-from channels.auth import AuthMiddlewareStack
-from channels.db import database_sync_to_async
-from channels.middleware import BaseMiddleware
-from django.conf import settings
-from django.contrib.auth import get_user_model
-from django.contrib.auth.models import AnonymousUser
-
-User = get_user_model()
-
-@database_sync_to_async
-def get_user(token):
-    try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-        user = User.objects.get(id=payload['sub'])
-        return user
-    except (jwt.InvalidTokenError, User.DoesNotExist):
-        return AnonymousUser()
-
-class JWTAuthMiddleware(BaseMiddleware):
-    def __init__(self, inner):
-        super().__init__(inner)
-
-    async def __call__(self, scope, receive, send):
-        query_string = scope.get('query_string', b'').decode()
-        query_params = parse_qs(query_string)
-        
-        token = query_params.get('token', [None])[0]
-        if token:
-            scope['user'] = await get_user(token)
-        else:
-            scope['user'] = AnonymousUser()
-        
-        return await super().__call__(scope, receive, send)
-
-def JWTAuthMiddlewareStack(inner):
-    return JWTAuthMiddleware(AuthMiddlewareStack(inner))
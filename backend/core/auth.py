@@ -1,9 +1,13 @@
+import asyncio
+import copy
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+from channels.db import database_sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from jose import JWTError, jwt
 from ninja.security import HttpBearer
+from .principals import principal_cache
 from .schemas import TokenPayload
 import logging
 
@@ -11,37 +15,81 @@ logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+def decode_access_token(token: str) -> Optional[Tuple[int, int]]:
+    """Validate a token's signature and expiry, returning ``(user_id, exp)``."""
+    try:
+        payload = jwt.decode(
+            token, settings.SECRET_KEY, algorithms=["HS256"]
+        )
+        # Convert sub back to int for database lookup
+        user_id = int(payload["sub"])
+        exp = payload["exp"]
+    except (JWTError, KeyError, ValueError) as e:
+        logger.debug(f"Rejected token: {str(e)}")
+        return None
+
+    if datetime.fromtimestamp(exp) < datetime.now():
+        logger.debug("Token has expired")
+        return None
+    return user_id, exp
+
+def load_principal(token: str, user_id: int, exp: int):
+    """Fetch the active user behind a decoded token and cache it."""
+    # Read first: a change committed after this read retires the entry again
+    version = principal_cache.version(user_id)
+    user = User.objects.filter(id=user_id, is_active=True).first()
+    if user is None:
+        logger.debug(f"No active user found with id: {user_id}")
+        return None
+
+    principal_cache.set(token, user, version, token_exp=exp)
+    return user
+
+def authenticate_token(token: str):
+    """
+    Resolve an access token to an active user.
+    Cached principals are returned without touching the database.
+    """
+    user = principal_cache.get(token)
+    if user is not None:
+        return user
+
+    claims = decode_access_token(token)
+    if claims is None:
+        return None
+    return load_principal(token, *claims)
+
+_pending_principals = {}
+
+async def aauthenticate_token(token: str):
+    """
+    Async counterpart of ``authenticate_token`` for the event loop.
+
+    Cache hits and invalid tokens are answered without touching the database.
+    Concurrent misses for the same token share a single database lookup, so
+    a client reconnecting many sockets at once costs one query.
+    """
+    user = await principal_cache.aget(token)
+    if user is not None:
+        return user
+
+    claims = decode_access_token(token)
+    if claims is None:
+        return None
+
+    pending = _pending_principals.get(token)
+    if pending is None:
+        pending = asyncio.ensure_future(
+            database_sync_to_async(load_principal)(token, *claims)
+        )
+        _pending_principals[token] = pending
+        pending.add_done_callback(lambda _: _pending_principals.pop(token, None))
+    user = await asyncio.shield(pending)
+    return copy.copy(user) if user is not None else None
+
 class AuthBearer(HttpBearer):
     def authenticate(self, request, token):
-        try:
-            logger.debug(f"Attempting to decode token: {token}")
-            payload = jwt.decode(
-                token, settings.SECRET_KEY, algorithms=["HS256"]
-            )
-            logger.debug(f"Decoded payload: {payload}")
-            
-            # Convert sub back to int for database lookup
-            user_id = int(payload["sub"])
-            exp = payload["exp"]
-            
-            if datetime.fromtimestamp(exp) < datetime.now():
-                logger.debug("Token has expired")
-                return None
-                
-            user = User.objects.filter(id=user_id).first()
-            if user is None:
-                logger.debug(f"No user found with id: {user_id}")
-                return None
-                
-            logger.debug(f"Successfully authenticated user: {user.username}")
-            return user
-            
-        except (JWTError, ValueError) as e:
-            logger.debug(f"JWT Error: {str(e)}")
-            return None
-        except Exception as e:
-            logger.debug(f"Unexpected error: {str(e)}")
-            return None
+        return authenticate_token(token)
 
 def create_access_token(*, user_id: int, expires_delta: Optional[timedelta] = None) -> str:
     if expires_delta:
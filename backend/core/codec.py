@@ -0,0 +1,45 @@
+"""
+JSON codec used on hot paths (chat broadcasts).
+
+orjson is used when it is installed, the standard library otherwise. Set
+``JSON_CODEC`` to ``'json'`` or ``'orjson'`` to force one.
+"""
+import json
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+class JSONCodec:
+    name = 'json'
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj, separators=(',', ':'), cls=DjangoJSONEncoder)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class ORJSONCodec:
+    name = 'orjson'
+
+    def dumps(self, obj) -> str:
+        return orjson.dumps(obj, default=DjangoJSONEncoder().default).decode()
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def get_codec(name: str = 'auto'):
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("JSON_CODEC is 'orjson' but orjson is not installed")
+        return ORJSONCodec()
+    return JSONCodec()
+
+
+codec = get_codec(getattr(settings, 'JSON_CODEC', 'auto'))
@@ -0,0 +1,166 @@
+"""
+Media file serving with HTTP caching and byte ranges.
+
+Replaces ``django.conf.urls.static.static`` for ``MEDIA_URL``. Whole files go
+out through ``FileResponse`` (``wsgi.file_wrapper``/sendfile where the server
+offers it), conditional requests are answered with 304 from the file's
+metadata alone, and a single ``Range`` is honoured with 206. Content-addressed
+names never change content, so they are cached as immutable; that includes the
+variants rendered from a blob, which are named after its digest and deleted
+with it. With ``MEDIA_SERVING['ACCEL_REDIRECT']`` set, the bytes are left to
+nginx through ``X-Accel-Redirect``. Staging directories (content-addressed
+temporary files, resumable upload parts, message archives) are never served,
+even when configured inside ``MEDIA_ROOT``.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+from .storage import ContentAddressedStorage
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE = 'public, max-age=31536000, immutable'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _private_dirs():
+    return [
+        os.path.join(settings.MEDIA_ROOT, ContentAddressedStorage.prefix, 'tmp'),
+        settings.IMAGE_UPLOADS['DIR'],
+        settings.MESSAGE_ARCHIVE['DIR'],
+    ]
+
+
+def _is_private(full_path: str) -> bool:
+    real = os.path.realpath(full_path)
+    for directory in _private_dirs():
+        directory = os.path.realpath(directory)
+        if os.path.commonpath([real, directory]) == directory:
+            return True
+    return False
+
+
+def _etag(path: str, st: os.stat_result) -> str:
+    if path.startswith(f'{ContentAddressedStorage.prefix}/'):
+        # The file name is the SHA-256 of its content
+        return f'"{posixpath.basename(path).split(".", 1)[0]}"'
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == '*':
+        return True
+    # If-None-Match uses weak comparison
+    return any(candidate.strip().removeprefix('W/') == etag for candidate in header.split(','))
+
+
+def _not_modified(request, etag: str, mtime: int) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return if_modified_since is not None and mtime <= if_modified_since
+
+
+def _byte_range(request, etag: str, mtime: int, size: int):
+    """Return ``(start, end)`` for a satisfiable single range, ``None`` to send everything, or ``False`` if unsatisfiable."""
+    header = request.headers.get('Range')
+    if not header:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range is not None:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if if_range != etag:
+                return None
+        elif parse_http_date_safe(if_range) != mtime:
+            return None
+
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        # Multiple or malformed ranges: ignoring the header is allowed
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(path: str, start: int, length: int):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def _cache_headers(response, path: str, etag: str, mtime: int):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    response['Cache-Control'] = (
+        IMMUTABLE if path.startswith(f'{ContentAddressedStorage.prefix}/')
+        else f"public, max-age={settings.MEDIA_SERVING['MAX_AGE']}"
+    )
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        st = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404("File not found")
+    if not stat.S_ISREG(st.st_mode) or _is_private(full_path):
+        raise Http404("File not found")
+
+    path = posixpath.normpath(path).lstrip('/')
+    etag = _etag(path, st)
+    mtime = int(st.st_mtime)
+    if _not_modified(request, etag, mtime):
+        return _cache_headers(HttpResponseNotModified(), path, etag, mtime)
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    accel_prefix = settings.MEDIA_SERVING['ACCEL_REDIRECT']
+    if accel_prefix:
+        # nginx serves the bytes (including ranges) from its internal location
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = f'{accel_prefix.rstrip("/")}/{path}'
+        return _cache_headers(response, path, etag, mtime)
+
+    byte_range = _byte_range(request, etag, mtime, st.st_size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{st.st_size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+        response['Content-Length'] = st.st_size
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        if request.method == 'HEAD':
+            response = HttpResponse(status=206, content_type=content_type)
+        else:
+            response = StreamingHttpResponse(_read_range(full_path, start, length), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+        response['Content-Length'] = length
+    response['Accept-Ranges'] = 'bytes'
+    return _cache_headers(response, path, etag, mtime)
@@ -1,36 +1,46 @@
 from urllib.parse import parse_qs
+from channels.auth import AuthMiddlewareStack
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from jose import jwt, JWTError
-from django.conf import settings
+from .auth import aauthenticate_token
 
-User = get_user_model()
 
-@database_sync_to_async
-def get_user(user_id):
-    try:
-        return User.objects.get(id=user_id)
-    except User.DoesNotExist:
-        return AnonymousUser()
+def get_token(scope):
+    """Read the access token from ``?token=`` or an ``Authorization: Bearer`` header."""
+    query_params = parse_qs(scope.get('query_string', b'').decode())
+    token = query_params.get('token', [None])[0]
+    if token:
+        return token
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            scheme, _, credentials = value.decode().partition(' ')
+            if scheme.lower() == 'bearer' and credentials:
+                return credentials
+    return None
+
 
 class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticate WebSocket connections with the same access tokens and
+    principal cache as the HTTP API.
+
+    Sockets that carry a token never touch the session or cookie machinery;
+    only sockets without one are handed to ``fallback`` (the session stack).
+    """
+
+    def __init__(self, inner, fallback=None):
+        super().__init__(inner)
+        self.fallback = fallback
+
     async def __call__(self, scope, receive, send):
-        # Get the token from query string
-        query_string = scope.get('query_string', b'').decode()
-        query_params = parse_qs(query_string)
-        token = query_params.get('token', [None])[0]
-
-        if token:
-            try:
-                # Decode and validate the token
-                payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-                user_id = int(payload["sub"])
-                scope['user'] = await get_user(user_id)
-            except (JWTError, ValueError):
-                scope['user'] = AnonymousUser()
-        else:
-            scope['user'] = AnonymousUser()
-
-        return await super().__call__(scope, receive, send)
+        token = get_token(scope)
+        if token is None and self.fallback is not None:
+            return await self.fallback(scope, receive, send)
+
+        user = await aauthenticate_token(token) if token else None
+        scope = dict(scope, user=user or AnonymousUser())
+        return await self.inner(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    return JWTAuthMiddleware(inner, fallback=AuthMiddlewareStack(inner))
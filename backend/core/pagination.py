@@ -0,0 +1,89 @@
+import base64
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+from django.db.models import Q, QuerySet
+from ninja import Schema
+from pydantic import Field
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor we did not issue."""
+
+
+class CursorParams(Schema):
+    before: Optional[str] = None
+    after: Optional[str] = None
+    limit: int = Field(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+
+
+@dataclass
+class KeysetPage:
+    items: List[Any] = field(default_factory=list)
+    older_cursor: Optional[str] = None
+    newer_cursor: Optional[str] = None
+
+
+def encode_cursor(created_at: datetime, pk: int) -> str:
+    raw = f"{created_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def keyset_paginate(
+    queryset: QuerySet,
+    *,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    newest_first: bool = False,
+) -> KeysetPage:
+    """
+    Page through ``queryset`` on ``(created_at, id)`` without OFFSET.
+
+    ``before`` walks towards older rows and ``after`` towards newer rows; with
+    neither, the newest page is returned. Each page is a single index range
+    scan, so its cost does not depend on how deep into the history it is.
+    """
+    if before and after:
+        raise InvalidCursor("Use either 'before' or 'after', not both")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    if after:
+        created_at, pk = decode_cursor(after)
+        rows = list(
+            queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+            .order_by('created_at', 'id')[:limit]
+        )
+        has_older = True
+    else:
+        if before:
+            created_at, pk = decode_cursor(before)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+        rows = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+
+    page = KeysetPage(items=rows)
+    if rows:
+        if has_older:
+            page.older_cursor = encode_cursor(rows[0].created_at, rows[0].id)
+        # Always hand out a newer cursor so live clients can poll for new rows
+        page.newer_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    elif after:
+        page.newer_cursor = after
+    if newest_first:
+        page.items.reverse()
+    return page
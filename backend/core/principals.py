@@ -0,0 +1,172 @@
+import copy
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterable, Optional
+from django.conf import settings
+from django.core.cache import caches
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class PrincipalCache:
+    """
+    Bounded LRU of authenticated users keyed by access token.
+
+    Entries expire after ``ttl`` seconds or when the token itself expires,
+    whichever comes first. Every user also has a version in the shared cache
+    that is replaced whenever the user row is saved or deleted
+    (``invalidate_user``). Entries remember the version they were loaded
+    under and are only served while it is still current, so deactivation
+    and password changes take effect in every process at once. When the
+    shared cache is unreachable nothing is served from or added to the cache.
+    """
+
+    key_prefix = 'principal:v1'
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0, cache: str = 'default', version_ttl: int = 86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_alias = cache
+        self.version_ttl = version_ttl
+        self._entries = OrderedDict()  # token -> (user, expires_at, version)
+        self._tokens_by_user = defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def _version_key(self, user_id: int) -> str:
+        return f'{self.key_prefix}:{user_id}'
+
+    def version(self, user_id: int) -> Optional[str]:
+        """The user's current shared version ('' if never changed), ``None`` if it cannot be read."""
+        try:
+            return self.shared.get(self._version_key(user_id)) or ''
+        except Exception:
+            logger.warning("Shared cache unavailable, not using cached principals", exc_info=True)
+            return None
+
+    def versions(self, user_ids: Iterable[int]) -> Optional[Dict[int, str]]:
+        """``version`` of several users in one round trip, ``None`` if they cannot be read."""
+        keys = {user_id: self._version_key(user_id) for user_id in user_ids}
+        try:
+            found = self.shared.get_many(list(keys.values()))
+        except Exception:
+            logger.warning("Shared cache unavailable, not using cached principals", exc_info=True)
+            return None
+        return {user_id: found.get(key) or '' for user_id, key in keys.items()}
+
+    async def aversion(self, user_id: int) -> Optional[str]:
+        try:
+            return await self.shared.aget(self._version_key(user_id)) or ''
+        except Exception:
+            logger.warning("Shared cache unavailable, not using cached principals", exc_info=True)
+            return None
+
+    def _lookup(self, token: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= now:
+                self._discard(token)
+                self.misses += 1
+                return None
+            return entry
+
+    def _validate(self, token: str, entry, version: Optional[str]):
+        user, _, cached_version = entry
+        with self._lock:
+            if version is None or version != cached_version:
+                if version is not None and self._entries.get(token) is entry:
+                    self._discard(token)
+                self.misses += 1
+                return None
+            if token in self._entries:
+                self._entries.move_to_end(token)
+            self.hits += 1
+        # Hand out a copy so a view mutating request.auth cannot leak into other requests
+        return copy.copy(user)
+
+    def get(self, token: str):
+        entry = self._lookup(token)
+        if entry is None:
+            return None
+        return self._validate(token, entry, self.version(entry[0].pk))
+
+    async def aget(self, token: str):
+        entry = self._lookup(token)
+        if entry is None:
+            return None
+        return self._validate(token, entry, await self.aversion(entry[0].pk))
+
+    def set(self, token: str, user, version: Optional[str], token_exp: Optional[float] = None) -> None:
+        """Cache ``user`` as loaded under shared ``version``, which must be read before the user row."""
+        if version is None:
+            return
+        expires_at = time.monotonic() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, time.monotonic() + (token_exp - time.time()))
+        with self._lock:
+            if token in self._entries:
+                self._discard(token)
+            self._entries[token] = (user, expires_at, version)
+            self._tokens_by_user[user.pk].add(token)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Drop the user's tokens here and retire their version in every other process."""
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._discard(token)
+        try:
+            self.shared.set(self._version_key(user_id), uuid.uuid4().hex, self.version_ttl)
+        except Exception:
+            logger.exception(f"Failed to retire the cached principals of user {user_id}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _discard(self, token: str) -> None:
+        user, _, _ = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user.pk)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user.pk]
+
+
+principal_cache = PrincipalCache(
+    max_entries=settings.AUTH_PRINCIPAL_CACHE['MAX_ENTRIES'],
+    ttl=settings.AUTH_PRINCIPAL_CACHE['TTL'],
+    cache=settings.AUTH_PRINCIPAL_CACHE['CACHE'],
+)
+
+registry.register_collector(
+    'auth_principal_cache', 'Authenticated principal cache counters for this process', 'gauge', principal_cache.stats,
+)
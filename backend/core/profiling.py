@@ -0,0 +1,134 @@
+"""
+Per-route request profiling, toggled by ``settings.PROFILING['ENABLED']``.
+
+``RequestProfilingMiddleware`` records wall time, database time, query count
+and duplicated queries for every request, keyed by the matched URL route so
+label cardinality stays bounded. ``ProfiledJSONRenderer`` adds the time spent
+JSON-encoding Ninja responses (the schema conversion before it is only part of
+the wall time), and ``ProfiledConsumerMixin`` times each Channels
+consumer event. Everything lands in the histograms in ``core.metrics``.
+"""
+import logging
+import time
+from contextlib import ExitStack
+from collections import Counter as TallyCounter
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from ninja.renderers import JSONRenderer
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Wall time per request', ('method', 'route', 'status'),
+)
+db_seconds = registry.histogram(
+    'http_request_db_seconds', 'Time spent in database queries per request', ('method', 'route'),
+)
+query_count = registry.histogram(
+    'http_request_queries', 'Database queries per request', ('method', 'route'), buckets=QUERY_BUCKETS,
+)
+duplicate_queries = registry.counter(
+    'http_request_duplicate_queries_total', 'Queries repeated with identical SQL within one request', ('method', 'route'),
+)
+encode_seconds = registry.histogram(
+    'http_response_encode_seconds', 'Time spent JSON-encoding API responses, after schema conversion', ('method', 'route'),
+)
+consumer_event_seconds = registry.histogram(
+    'channels_event_duration_seconds', 'Handler time per Channels consumer event', ('consumer', 'event'),
+)
+
+
+def profiling_enabled() -> bool:
+    return settings.PROFILING['ENABLED']
+
+
+class QueryRecorder:
+    """``execute_wrapper`` that times queries and tallies their SQL text."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = TallyCounter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    def duplicates(self) -> int:
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+
+def route_for(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.route or match.view_name or 'unmatched'
+
+
+class RequestProfilingMiddleware:
+    def __init__(self, get_response):
+        if not profiling_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        method, route = request.method, route_for(request)
+        request_seconds.observe(elapsed, method=method, route=route, status=response.status_code)
+        db_seconds.observe(recorder.seconds, method=method, route=route)
+        query_count.observe(recorder.count, method=method, route=route)
+        duplicates = recorder.duplicates()
+        if duplicates:
+            duplicate_queries.inc(duplicates, method=method, route=route)
+            if duplicates >= settings.PROFILING['DUPLICATE_QUERY_WARNING']:
+                sql, count = recorder.statements.most_common(1)[0]
+                logger.warning(f"{method} {route} ran {duplicates} duplicate queries; most repeated ({count}x): {sql[:200]}")
+        encoded = getattr(request, '_profiling_encode_seconds', None)
+        if encoded is not None:
+            encode_seconds.observe(encoded, method=method, route=route)
+        return response
+
+
+class ProfiledJSONRenderer(JSONRenderer):
+    """Ninja's JSON renderer, timing the encode step when profiling is on."""
+
+    def render(self, request, data, *, response_status):
+        if not profiling_enabled():
+            return super().render(request, data, response_status=response_status)
+        started = time.perf_counter()
+        content = super().render(request, data, response_status=response_status)
+        request._profiling_encode_seconds = time.perf_counter() - started
+        return content
+
+
+class ProfiledConsumerMixin:
+    """Times every event a Channels consumer dispatches (connect, receive, group events)."""
+
+    async def dispatch(self, message):
+        if not profiling_enabled():
+            return await super().dispatch(message)
+        started = time.perf_counter()
+        try:
+            return await super().dispatch(message)
+        finally:
+            consumer_event_seconds.observe(
+                time.perf_counter() - started,
+                consumer=type(self).__name__,
+                event=message.get('type', 'unknown'),
+            )
@@ -1,16 +0,0 @@
-from django.urls import re_path
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from chat.consumers import ChatConsumer
-
-websocket_urlpatterns = [
-    re_path(r'ws/chat/(?P<group_id>\d+)/$', ChatConsumer.as_asgi()),
-]
-
-application = ProtocolTypeRouter({
-    'websocket': AuthMiddlewareStack(
-        URLRouter(
-            websocket_urlpatterns
-        )
-    ),
-})
@@ -1,8 +1,10 @@
 from datetime import datetime
-from typing import List, Optional
+from uuid import UUID
+from typing import Dict, List, Optional
 from ninja import Schema, File
 from ninja.files import UploadedFile
 from pydantic import EmailStr, Field, BaseModel
+from core.pagination import CursorParams
 
 class TokenSchema(Schema):
     access_token: str
@@ -25,49 +27,23 @@ class UserCreate(Schema):
 class UserUpdate(Schema):
     bio: Optional[str] = None
 
+class ImageVariantOut(Schema):
+    width: int
+    height: int
+    webp: str
+    jpeg: str
+
 class UserOut(Schema):
     id: int
     username: str
     email: str
     bio: Optional[str] = None
     avatar: Optional[str] = None
+    avatar_variants: Dict[str, ImageVariantOut] = {}
     date_joined: datetime = None
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
 
-class GroupBase(Schema):
-    name: str
-    goal: str
-    description: str
-
-class GroupCreate(GroupBase):
-    pass
-
-class GroupUpdate(Schema):
-    name: Optional[str] = None
-    goal: Optional[str] = None
-    description: Optional[str] = None
-
-class MessageBase(Schema):
-    content: str
-
-class MessageCreate(MessageBase):
-    pass
-
-class MessageOut(MessageBase):
-    id: int
-    sender: UserOut
-    created_at: datetime
-
-class GroupOut(GroupBase):
-    id: int
-    owner: UserOut
-    members: List[UserOut]
-    avatar: Optional[str] = None
-    created_at: datetime
-    updated_at: datetime
-    messages: List[MessageOut]
-
 class Message(Schema):
     detail: str
 
@@ -84,5 +60,52 @@ class ImageOut(Schema):
     title: str
     description: Optional[str]
     image: str
+    variants: Dict[str, ImageVariantOut] = {}
     created_at: datetime
-    user: UserOut
+    user_id: int
+
+# Fields a client may request with `fields=` on the image list
+IMAGE_LIST_FIELDS = ('id', 'title', 'description', 'image', 'variants', 'created_at', 'updated_at', 'user_id')
+
+class ImageListParams(CursorParams):
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    title_prefix: Optional[str] = Field(None, min_length=1, max_length=200)
+    fields: Optional[str] = Field(None, description="Comma-separated subset of: " + ", ".join(IMAGE_LIST_FIELDS))
+
+class ImageListItemOut(Schema):
+    """Image list row; only the requested fields are present."""
+    id: Optional[int] = None
+    title: Optional[str] = None
+    description: Optional[str] = None
+    image: Optional[str] = None
+    variants: Optional[Dict[str, ImageVariantOut]] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    user_id: Optional[int] = None
+
+class ImagePage(Schema):
+    items: List[ImageListItemOut]
+    older_cursor: Optional[str] = None
+    newer_cursor: Optional[str] = None
+
+class UploadInit(Schema):
+    filename: str = Field(..., min_length=1, max_length=255)
+    size: int = Field(..., gt=0)
+    sha256: Optional[str] = Field(None, pattern=r'^[0-9a-fA-F]{64}$')
+    title: str = Field(..., min_length=1, max_length=200)
+    description: Optional[str] = None
+
+class UploadFinalize(Schema):
+    sha256: Optional[str] = Field(None, pattern=r'^[0-9a-fA-F]{64}$')
+
+class UploadSessionOut(Schema):
+    id: UUID
+    filename: str
+    size: int
+    offset: int
+    expires_at: datetime
+
+class UploadConflictOut(Schema):
+    detail: str
+    offset: int
@@ -30,6 +30,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     # Third party apps
     'corsheaders',
     'ninja',
@@ -38,11 +39,11 @@ INSTALLED_APPS = [
     'users',
     'images',
     'groups',
-    'chat',
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.profiling.RequestProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +85,72 @@ CHANNEL_LAYERS = {
     },
 }
 
+# JSON codec for chat broadcasts: 'auto' picks orjson when installed
+JSON_CODEC = os.getenv('JSON_CODEC', 'auto')
+
+# Shared cache tier (Redis) used by the membership cache and friends
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://127.0.0.1:6380/1'),
+    },
+}
+
+# Group member id sets: LOCAL_TTL seconds in process, SHARED_TTL seconds in CACHE
+GROUP_MEMBERSHIP_CACHE = {
+    'CACHE': 'default',
+    'MAX_GROUPS': int(os.getenv('GROUP_MEMBERSHIP_CACHE_MAX_GROUPS', '10000')),
+    'LOCAL_TTL': float(os.getenv('GROUP_MEMBERSHIP_CACHE_LOCAL_TTL', '5')),
+    'SHARED_TTL': int(os.getenv('GROUP_MEMBERSHIP_CACHE_SHARED_TTL', '60')),
+}
+
+# Online users per group: sockets expire TTL seconds after their last frame,
+# diffs are broadcast at most once per INTERVAL seconds per group, by one worker
+PRESENCE = {
+    'BACKEND': os.getenv('PRESENCE_BACKEND', 'redis'),  # 'redis' or 'memory' (single process only)
+    'REDIS_URL': os.getenv('PRESENCE_REDIS_URL', 'redis://127.0.0.1:6380/2'),
+    'TTL': float(os.getenv('PRESENCE_TTL', '30')),
+    'INTERVAL': float(os.getenv('PRESENCE_INTERVAL', '1')),
+}
+
+# Latest SIZE messages per group, served for the first history page and the
+# WebSocket backfill; LOCAL_TTL seconds in process, TTL seconds in Redis
+RECENT_MESSAGES = {
+    'BACKEND': os.getenv('RECENT_MESSAGES_BACKEND', 'redis'),  # 'redis' or 'memory' (single process only)
+    'REDIS_URL': os.getenv('RECENT_MESSAGES_REDIS_URL', 'redis://127.0.0.1:6380/3'),
+    'SIZE': int(os.getenv('RECENT_MESSAGES_SIZE', '50')),
+    'TTL': int(os.getenv('RECENT_MESSAGES_TTL', '3600')),
+    'LOCAL_GROUPS': int(os.getenv('RECENT_MESSAGES_LOCAL_GROUPS', '1000')),
+    'LOCAL_TTL': float(os.getenv('RECENT_MESSAGES_LOCAL_TTL', '2')),
+}
+
+# Top public groups by member count, cached and patched as memberships change
+TRENDING_GROUPS = {
+    'CACHE': 'default',
+    'SIZE': int(os.getenv('TRENDING_GROUPS_SIZE', '10')),
+    'BUFFER': int(os.getenv('TRENDING_GROUPS_BUFFER', '50')),
+    'TTL': int(os.getenv('TRENDING_GROUPS_TTL', '300')),
+}
+
+# Chat messages are persisted write-behind: journaled to SPOOL_DIR and
+# bulk-inserted every BATCH_SIZE messages or FLUSH_INTERVAL seconds
+MESSAGE_SINK = {
+    'BATCH_SIZE': int(os.getenv('MESSAGE_SINK_BATCH_SIZE', '200')),
+    'FLUSH_INTERVAL': float(os.getenv('MESSAGE_SINK_FLUSH_INTERVAL', '0.25')),
+    'ID_BLOCK_SIZE': int(os.getenv('MESSAGE_SINK_ID_BLOCK_SIZE', '1000')),
+    'SPOOL_DIR': os.getenv('MESSAGE_SINK_SPOOL_DIR', str(BASE_DIR / 'spool')),
+    'FSYNC': os.getenv('MESSAGE_SINK_FSYNC', 'False') == 'True',
+}
+
+# groups_message is partitioned by month: PARTITIONS_AHEAD future months are
+# created ahead of time, months older than KEEP_MONTHS are exported to DIR
+MESSAGE_ARCHIVE = {
+    'DIR': os.getenv('MESSAGE_ARCHIVE_DIR', str(BASE_DIR / 'archive')),
+    'FORMAT': os.getenv('MESSAGE_ARCHIVE_FORMAT', 'ndjson'),  # 'ndjson' or 'parquet' (needs pyarrow)
+    'PARTITIONS_AHEAD': int(os.getenv('MESSAGE_PARTITIONS_AHEAD', '3')),
+    'KEEP_MONTHS': int(os.getenv('MESSAGE_ARCHIVE_KEEP_MONTHS', '12')),
+}
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -130,6 +197,12 @@ STATICFILES_DIRS = [
 # Media files
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_SERVING = {
+    # Cache lifetime for media that is not content-addressed (those are immutable)
+    'MAX_AGE': int(os.getenv('MEDIA_MAX_AGE', '3600')),
+    # Internal nginx location to hand files off to with X-Accel-Redirect, e.g. /protected-media/
+    'ACCEL_REDIRECT': os.getenv('MEDIA_ACCEL_REDIRECT', ''),
+}
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -148,6 +221,34 @@ NINJA_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
 }
 
+# Authenticated principals cached per process, keyed by access token and
+# checked against a per-user version in CACHE on every lookup
+AUTH_PRINCIPAL_CACHE = {
+    'CACHE': 'default',
+    'MAX_ENTRIES': int(os.getenv('AUTH_PRINCIPAL_CACHE_MAX_ENTRIES', '10000')),
+    'TTL': float(os.getenv('AUTH_PRINCIPAL_CACHE_TTL', '60')),
+}
+
+# Resized image variants are rendered on a process pool; 0 workers renders inline
+IMAGE_PROCESSING = {
+    'WORKERS': int(os.getenv('IMAGE_PROCESSING_WORKERS', '2')),
+}
+
+# Resumable uploads stage their bytes here; the directory must be shared by all API workers
+IMAGE_UPLOADS = {
+    'DIR': os.getenv('IMAGE_UPLOADS_DIR', str(BASE_DIR / 'uploads')),
+    'MAX_SIZE': int(os.getenv('IMAGE_UPLOADS_MAX_SIZE', str(50 * 1024 * 1024))),
+    'SESSION_TTL': int(os.getenv('IMAGE_UPLOADS_SESSION_TTL', str(24 * 60 * 60))),
+}
+
+# Per-route timing and SQL instrumentation, exported on /metrics
+PROFILING = {
+    'ENABLED': os.getenv('PROFILING_ENABLED', 'False') == 'True',
+    'DUPLICATE_QUERY_WARNING': int(os.getenv('PROFILING_DUPLICATE_QUERY_WARNING', '5')),
+}
+# /metrics requires "Authorization: Bearer <METRICS_TOKEN>" and answers 404 while it is unset
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 # Logging configuration
 LOGGING = {
     'version': 1,
@@ -159,12 +260,12 @@ LOGGING = {
     },
     'root': {
         'handlers': ['console'],
-        'level': 'DEBUG',
+        'level': os.getenv('LOG_LEVEL', 'INFO'),
     },
     'loggers': {
         'core.auth': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': os.getenv('LOG_LEVEL', 'INFO'),
             'propagate': False,
         },
     },
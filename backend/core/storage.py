@@ -0,0 +1,128 @@
+import hashlib
+import os
+import tempfile
+import threading
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that names every file after the SHA-256 of its bytes.
+
+    Content is hashed while it is streamed to a temporary file, which is then
+    renamed to ``cas/<aa>/<bb>/<digest><ext>``. Saving bytes that are already
+    stored keeps the temporary file aside until ``settle`` is called, so
+    identical uploads share one file. Files rendered from a blob are stored
+    beside it under names derived from its digest (``save_derived``), so they
+    are shared the same way. Deleting is left to ``images.blobs``, which
+    reference-counts the names.
+    """
+
+    prefix = 'cas'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = threading.local()
+
+    def _held(self) -> dict:
+        """Temporary copies of this thread's saves that found their file already stored, by name."""
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def digest_name(self, digest: str, extension: str) -> str:
+        return f'{self.prefix}/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+    def _write_temp(self, content):
+        """Stream ``content`` to a temporary file, returning its path and SHA-256 hex digest."""
+        tmp_dir = self.path(f'{self.prefix}/tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    tmp.write(chunk)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest()
+
+    def _move_into_place(self, tmp_path, name):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(tmp_path, self.file_permissions_mode)
+        # Atomic, so concurrent saves of the same bytes both end up with one intact file
+        os.replace(tmp_path, path)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        extension = os.path.splitext(name)[1].lower()
+
+        tmp_path, digest = self._write_temp(content)
+        try:
+            name = self.digest_name(digest, extension)
+            if os.path.exists(self.path(name)):
+                # Nothing references the name yet, so the stored file may still be
+                # collected; keep our copy until the caller settles the name
+                previous = self._held().pop(name, None)
+                if previous is not None:
+                    os.unlink(previous)
+                self._held()[name] = tmp_path
+            else:
+                self._move_into_place(tmp_path, name)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return name
+
+    def settle(self, name: str) -> bool:
+        """
+        Call once a reference to ``name`` is held, so it can no longer be collected.
+
+        If a save in this thread found the file already stored and it has been
+        deleted since, the saved bytes are put back; otherwise the kept copy is
+        dropped. Returns whether the file exists.
+        """
+        held = self._held().pop(name, None)
+        if held is not None:
+            if os.path.exists(self.path(name)):
+                os.unlink(held)
+            else:
+                self._move_into_place(held, name)
+        return os.path.exists(self.path(name))
+
+    def save_derived(self, name, content) -> str:
+        """
+        Store ``content`` under ``name`` as given, replacing any existing file.
+
+        For files rendered from a blob and named after its digest, such as
+        resized variants: rendering the same blob again yields the same name.
+        """
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        tmp_path, _ = self._write_temp(content)
+        try:
+            self._move_into_place(tmp_path, name)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Names are derived from content, an existing file is the same file
+        return name
+
+
+content_addressed_storage = ContentAddressedStorage()
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.utils.http import http_date
+from core.auth import create_access_token
+from core.media import IMMUTABLE
+from core.metrics import Registry
+from core.principals import principal_cache
+from core.profiling import QueryRecorder, encode_seconds, query_count, request_seconds
+from users.models import User
+
+# The shared cache tier without Redis, emptied before every test
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'core-tests'}}
+
+
+def observations(histogram) -> int:
+    """How many values ``histogram`` has recorded, over all label sets."""
+    with histogram._lock:
+        return sum(state[-1] for state in histogram._values.values())
+
+
+class RegistryTests(TestCase):
+    def test_counters_and_histograms_render_as_prometheus_text(self):
+        registry = Registry()
+        registry.counter('jobs_total', 'Jobs run', ('queue',)).inc(queue='mail')
+        registry.histogram('job_seconds', 'Job time', buckets=(0.1, 1.0)).observe(0.5)
+        lines = registry.render().splitlines()
+
+        self.assertIn('# TYPE jobs_total counter', lines)
+        self.assertIn('jobs_total{queue="mail"} 1', lines)
+        self.assertIn('job_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('job_seconds_bucket{le="1.0"} 1', lines)
+        self.assertIn('job_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('job_seconds_count 1', lines)
+
+    def test_registering_a_name_twice_returns_the_same_metric(self):
+        registry = Registry()
+        self.assertIs(registry.counter('jobs_total', 'Jobs run'), registry.counter('jobs_total', 'Jobs run'))
+
+    def test_collectors_are_read_on_every_render(self):
+        registry = Registry()
+        stats = {'hits': 1}
+        registry.register_collector('cache_stats', 'Cache stats', 'gauge', lambda: stats)
+        stats['hits'] = 2
+        self.assertIn('cache_stats{stat="hits"} 2', registry.render().splitlines())
+
+    def test_label_values_are_escaped(self):
+        registry = Registry()
+        registry.counter('errors_total', 'Errors', ('message',)).inc(message='say "hi"\n')
+        self.assertIn('errors_total{message="say \\"hi\\"\\n"} 1', registry.render().splitlines())
+
+
+class MetricsEndpointTests(TestCase):
+    @override_settings(METRICS_TOKEN=None)
+    def test_missing_without_a_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_wrong_token_is_forbidden(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer guess')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_exposition_with_the_token(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE http_request_duration_seconds histogram', response.content.decode())
+
+
+class QueryRecorderTests(TestCase):
+    def test_repeated_statements_count_as_duplicates(self):
+        recorder = QueryRecorder()
+        execute = lambda sql, params, many, context: None
+        for sql in ('SELECT 1', 'SELECT 1', 'SELECT 1', 'SELECT 2'):
+            recorder(execute, sql, (), False, {})
+        self.assertEqual(recorder.count, 4)
+        self.assertEqual(recorder.duplicates(), 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RequestProfilingTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        principal_cache.clear()
+        self.user = User.objects.create_user(username='profiled', email='profiled@example.com', password='secret-pass-1')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {create_access_token(user_id=self.user.id)}'}
+
+    @override_settings(PROFILING={'ENABLED': True, 'DUPLICATE_QUERY_WARNING': 1000})
+    def test_api_requests_are_timed_and_encoded(self):
+        before = [observations(metric) for metric in (request_seconds, query_count, encode_seconds)]
+        response = self.client.get('/api/groups/member/', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        after = [observations(metric) for metric in (request_seconds, query_count, encode_seconds)]
+        self.assertEqual([b - a for a, b in zip(before, after)], [1, 1, 1])
+
+    @override_settings(PROFILING={'ENABLED': False, 'DUPLICATE_QUERY_WARNING': 1000})
+    def test_nothing_is_recorded_when_disabled(self):
+        before = [observations(metric) for metric in (request_seconds, encode_seconds)]
+        self.client.get('/api/groups/member/', **self.headers)
+        self.assertEqual([observations(metric) for metric in (request_seconds, encode_seconds)], before)
+
+
+class MediaServingTests(TestCase):
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.media_root = root
+        self.enterContext(override_settings(
+            MEDIA_ROOT=root,
+            MEDIA_SERVING={'MAX_AGE': 600, 'ACCEL_REDIRECT': ''},
+            IMAGE_UPLOADS={**settings.IMAGE_UPLOADS, 'DIR': str(root / 'uploads')},
+            MESSAGE_ARCHIVE={**settings.MESSAGE_ARCHIVE, 'DIR': str(root / 'archive')},
+        ))
+        self.data = bytes(range(256)) * 4
+        self.digest = hashlib.sha256(self.data).hexdigest()
+        self.blob = f'cas/{self.digest[:2]}/{self.digest[2:4]}/{self.digest}.png'
+        self.write(self.blob, self.data)
+        self.write('legacy/photo.png', self.data)
+
+    def write(self, path, data):
+        full_path = self.media_root / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_bytes(data)
+
+    def get(self, path, **headers):
+        response = self.client.get(f'/media/{path}', **headers)
+        self.addCleanup(response.close)
+        return response
+
+    def test_content_addressed_files_are_immutable(self):
+        response = self.get(self.blob)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['ETag'], f'"{self.digest}"')
+        self.assertEqual(response['Cache-Control'], IMMUTABLE)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_other_files_get_a_bounded_lifetime(self):
+        response = self.get('legacy/photo.png')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=600')
+        self.assertIn('Last-Modified', response)
+
+    def test_matching_etag_is_not_modified(self):
+        response = self.get(self.blob, HTTP_IF_NONE_MATCH=f'W/"other", "{self.digest}"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], f'"{self.digest}"')
+        self.assertEqual(self.get(self.blob, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_unchanged_since_is_not_modified(self):
+        mtime = os.stat(self.media_root / 'legacy/photo.png').st_mtime
+        response = self.get('legacy/photo.png', HTTP_IF_MODIFIED_SINCE=http_date(mtime))
+        self.assertEqual(response.status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.get(self.blob, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.data)}')
+
+        response = self.get(self.blob, HTTP_RANGE='bytes=-16')
+        self.assertEqual(b''.join(response.streaming_content), self.data[-16:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(self.blob, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_stale_if_range_sends_the_whole_file(self):
+        response = self.get(self.blob, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_accel_redirect_leaves_the_bytes_to_nginx(self):
+        with override_settings(MEDIA_SERVING={'MAX_AGE': 600, 'ACCEL_REDIRECT': '/protected-media/'}):
+            response = self.get(self.blob)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.blob}')
+        self.assertEqual(response.content, b'')
+
+    def test_missing_files_and_traversal_are_not_found(self):
+        self.assertEqual(self.get('legacy/missing.png').status_code, 404)
+        self.assertEqual(self.get('../etc/passwd').status_code, 404)
+        self.assertEqual(self.get('legacy').status_code, 404)
+
+    def test_staging_files_are_never_served(self):
+        for path in ('cas/tmp/tmpabc123', 'uploads/session.part', 'archive/groups_message_p2020_01.ndjson.gz'):
+            self.write(path, b'private')
+            self.assertEqual(self.get(path).status_code, 404, path)
+
+    def test_writes_are_not_allowed(self):
+        self.assertEqual(self.client.post(f'/media/{self.blob}').status_code, 405)
@@ -15,14 +15,17 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 from ninja import NinjaAPI
 from users.api import router as users_router
 from images.api import router as images_router
-from groups.api import router as groups_router
+from groups.api import router as groups_router, messages_router, sync_router
 from core.auth import AuthBearer
+from core.media import serve_media
+from core.metrics import metrics_view
+from core.profiling import ProfiledJSONRenderer
 from groups.views import ChatTestView
 
 api = NinjaAPI(
@@ -31,15 +34,20 @@ api = NinjaAPI(
     description="API for managing notes and images",
     auth=AuthBearer(),
     csrf=False,
+    renderer=ProfiledJSONRenderer(),
 )
 
 # Add routers
 api.add_router("/auth/", users_router)
 api.add_router("/images/", images_router)
 api.add_router("/groups/", groups_router)
+api.add_router("/messages/", messages_router)
+api.add_router("/sync", sync_router)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", api.urls),
+    path("metrics", metrics_view, name="metrics"),
     path('test/chat/', ChatTestView.as_view(), name='chat_test'),
-] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT) + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    re_path(rf"^{settings.MEDIA_URL.strip('/')}/(?P<path>.+)$", serve_media, name="media"),
+] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -1,18 +1,42 @@
 from typing import Any, List, Optional, Union
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from ninja import Router, File, Schema, Path, Query
 from ninja.files import UploadedFile
 from ninja.pagination import paginate
 from core.auth import AuthBearer
-from core.schemas import Message as ErrorMessage, GroupOut
-from django.db.models import Count, Q, F, Value, FloatField, Case, When
-from django.db.models.functions import Cast, Greatest
-from .models import Group, Message
+from core.pagination import CursorParams, InvalidCursor, keyset_paginate
+from core.schemas import Message as ErrorMessage
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db.models import Q, F, Value, FloatField, Case, When
+from django.db.models.functions import Greatest
+from images.processing import process_image
+from .membership import membership_cache
+from .presence import presence_store
+from .recent import recent_messages, sender_json, serialize
+from .trending import trending_groups
+from .models import SEARCH_CONFIG, Group, Message, ReadState
+from .sync import changes_since
+from .archive import with_archived
+from .partitions import roll_forward
 from .schemas import (
     GroupCreate,
+    GroupOut,
+    GroupPage,
+    GroupSummaryOut,
     GroupUpdate,
     MessageCreate,
+    MessageListParams,
     MessageOut,
+    MessagePage,
+    MessageSearchPage,
+    MessageSearchParams,
+    PresenceOut,
+    ReadIn,
+    ReadStateOut,
+    SyncOut,
+    SyncParams,
+    UnreadOut,
 )
 import logging
 import re
@@ -20,12 +44,15 @@ import re
 logger = logging.getLogger(__name__)
 
 router = Router(tags=["groups"])
+messages_router = Router(tags=["messages"])
+sync_router = Router(tags=["sync"])
 
 class SearchParams(Schema):
     query: Optional[str] = None
     public_only: Optional[bool] = False
 
-@router.get("/search", response=List[GroupOut], auth=AuthBearer())
+@router.get("/search", response=List[GroupSummaryOut], auth=AuthBearer())
+@paginate
 def search_groups(
     request,
     params: SearchParams = Query(...),
@@ -33,13 +60,11 @@ def search_groups(
     """
     Search groups by query string.
     If no parameters are provided, returns all groups the user is a member of and public groups.
-    Results are ordered by relevance to the search query.
+    Results are ordered by relevance to the search query and paginated with `limit`/`offset`.
     """
     logger.info(f"Search request - query: {params.query}, public_only: {params.public_only}, raw query params: {request.GET}")
     
-    groups_query = Group.objects.annotate(
-        member_count=Count('members')
-    )
+    groups_query = Group.objects.with_summary()
     
     # Convert string 'true'/'false' to boolean if needed
     if isinstance(params.public_only, str):
@@ -51,87 +76,135 @@ def search_groups(
         logger.info("Filtering public groups only")
     else:
         # Show groups user is member of and public groups
-        groups_query = groups_query.filter(
-            Q(public=True) | Q(members=request.auth)
-        )
+        groups_query = groups_query.visible_to(request.auth)
         logger.info("Filtering public groups and user's groups")
 
     if params.query:
         # Normalize query to lowercase for case-insensitive search
-        query = params.query.lower()
+        query = params.query.strip().lower()
         logger.info(f"Searching with query: {query}")
-        
-        # Split query into words for word-based matching
-        words = query.split()
-        
-        # Add relevance scoring based on various matches
+
+        # Only word characters ever reach the raw tsquery, so user input
+        # cannot inject tsquery operators
+        terms = re.findall(r'[^\W_]+', query)
+        prefix_query = SearchQuery(
+            ' & '.join(f'{term}:*' for term in terms) or "''",
+            search_type='raw',
+            config=SEARCH_CONFIG,
+        )
+        word_query = SearchQuery(query, search_type='plain', config=SEARCH_CONFIG)
+
+        # Candidates come from the GIN indexes only: the tsvector for words and
+        # word prefixes, the trigram indexes for substrings (and typos in names)
+        groups_query = groups_query.filter(
+            Q(search_vector=prefix_query) |
+            Q(name__icontains=query) |
+            Q(goal__icontains=query) |
+            Q(description__icontains=query) |
+            Q(name__trigram_word_similar=query)
+        )
+
+        # Rank candidates: exact > word > prefix > contains > fuzzy
         groups_query = groups_query.annotate(
-            exact_match=Cast(
-                Q(name__iexact=query) | Q(goal__iexact=query) | Q(description__iexact=query),
-                output_field=FloatField()
-            ) * Value(1.0),
-            exact_word_match=Cast(
-                Q(name__iregex=r'(?:^|\s)' + query + r'(?:\s|$)') |
-                Q(goal__iregex=r'(?:^|\s)' + query + r'(?:\s|$)') |
-                Q(description__iregex=r'(?:^|\s)' + query + r'(?:\s|$)'),
-                output_field=FloatField()
-            ) * Value(0.8),
-            starts_with_word=Cast(
-                Q(name__istartswith=query) |
-                Q(goal__istartswith=query) |
-                Q(description__istartswith=query),
-                output_field=FloatField()
-            ) * Value(0.6),
-            contains_word=Cast(
-                Q(name__icontains=query) |
-                Q(goal__icontains=query) |
-                Q(description__icontains=query),
-                output_field=FloatField()
-            ) * Value(0.4),
+            exact_match=Case(
+                When(Q(name__iexact=query) | Q(goal__iexact=query) | Q(description__iexact=query), then=Value(1.0)),
+                default=Value(0.0),
+                output_field=FloatField(),
+            ),
+            exact_word_match=Case(
+                When(search_vector=word_query, then=Value(0.8)),
+                default=Value(0.0),
+                output_field=FloatField(),
+            ),
+            starts_with_word=Case(
+                When(
+                    Q(name__istartswith=query) | Q(goal__istartswith=query) |
+                    Q(description__istartswith=query) | Q(search_vector=prefix_query),
+                    then=Value(0.6),
+                ),
+                default=Value(0.0),
+                output_field=FloatField(),
+            ),
+            contains_word=Case(
+                When(
+                    Q(name__icontains=query) | Q(goal__icontains=query) | Q(description__icontains=query),
+                    then=Value(0.4),
+                ),
+                default=Value(0.0),
+                output_field=FloatField(),
+            ),
             relevance=Greatest(
                 F('exact_match'),
                 F('exact_word_match'),
                 F('starts_with_word'),
                 F('contains_word'),
-                Value(0.0)
-            )
-        ).filter(relevance__gt=0)
-        
+                Value(0.2)
+            ),
+            rank=SearchRank(F('search_vector'), prefix_query),
+        )
+
         logger.info("Added relevance scoring")
     else:
         # If no query, set a default relevance of 1.0 for all groups
         groups_query = groups_query.annotate(
-            relevance=Value(1.0, output_field=FloatField())
+            relevance=Value(1.0, output_field=FloatField()),
+            rank=Value(0.0, output_field=FloatField()),
         )
         logger.info("No query provided, using default relevance")
 
-    # Order by relevance (if search query provided), then by member count, then by name
-    groups_query = groups_query.order_by('-relevance', '-member_count', 'name')
+    # Order by relevance (if search query provided), then by text rank, member count and name
+    groups_query = groups_query.order_by('-relevance', '-rank', '-member_count', 'name', 'id')
     logger.info("Ordered results")
 
     return groups_query
 
-@router.get("/public/", response=List[GroupOut], auth=AuthBearer())
+@router.get("/public/", response=List[GroupSummaryOut], auth=AuthBearer())
 def list_public_groups(request) -> Any:
-    """List all public groups, ordered by member count."""
-    return Group.objects.filter(public=True).annotate(member_count=Count('members')).order_by('-member_count')[:10]
+    """List the biggest public groups, ordered by member count."""
+    return trending_groups.top()
 
-@router.get("/private/", response=List[GroupOut], auth=AuthBearer())
+@router.get("/private/", response=List[GroupSummaryOut], auth=AuthBearer())
 def list_private_groups(request) -> Any:
     """List all groups the user is a member of (excluding public groups they're not a member of)."""
-    return Group.objects.filter(members=request.auth, public=False)
+    return Group.objects.filter(members=request.auth, public=False).with_summary().with_unread(request.auth)
 
-@router.get("/member/", response=List[GroupOut], auth=AuthBearer())
+@router.get("/member/", response=List[GroupSummaryOut], auth=AuthBearer())
 def list_member_groups(request) -> Any:
     """List all groups the user is a member of, both public and private."""
-    return Group.objects.filter(members=request.auth)
+    return Group.objects.filter(members=request.auth).with_summary().with_unread(request.auth)
+
+@router.get("/unread", response=List[UnreadOut], auth=AuthBearer())
+def list_unread_counts(request) -> Any:
+    """Unread message counts for every group the user is a member of, in one query."""
+    return Group.objects.filter(members=request.auth).with_unread(request.auth).order_by().values('unread_count', group_id=F('id'))
 
-@router.get("/", response=List[GroupOut], auth=AuthBearer())
-def list_groups(request) -> Any:
-    """List all groups the user is a member of and all public groups."""
-    user_groups = request.auth.joined_groups.all()
-    public_groups = Group.objects.filter(public=True).exclude(members=request.auth)
-    return list(user_groups) + list(public_groups)
+@router.get("/", response={200: GroupPage, 400: ErrorMessage}, auth=AuthBearer())
+def list_groups(request, params: CursorParams = Query(...)) -> Any:
+    """
+    List the groups the user is a member of and all public groups, newest first.
+    Each group says whether the user is a member, and member groups carry
+    their unread count. Page with `before`/`after`; every page is a single query.
+    """
+    groups = (
+        Group.objects.visible_to(request.auth)
+        .with_membership(request.auth)
+        .with_summary()
+        .with_unread(request.auth)
+    )
+    try:
+        page = keyset_paginate(
+            groups,
+            before=params.before,
+            after=params.after,
+            limit=params.limit,
+            newest_first=True,
+        )
+    except InvalidCursor as e:
+        return 400, {"detail": str(e)}
+    for group in page.items:
+        if not group.is_member:
+            group.unread_count = None
+    return 200, page
 
 @router.post("/", response={201: GroupOut, 400: ErrorMessage}, auth=AuthBearer())
 def create_group(
@@ -141,15 +214,18 @@ def create_group(
 ) -> Any:
     """Create a new group."""
     try:
-        group = Group.objects.create(
-            owner=request.auth,
-            name=payload.name,
-            goal=payload.goal,
-            description=payload.description,
-            avatar=avatar,
-            public=payload.public
-        )
-        group.members.add(request.auth)  # Add owner as a member
+        with transaction.atomic():
+            group = Group.objects.create(
+                owner=request.auth,
+                name=payload.name,
+                goal=payload.goal,
+                description=payload.description,
+                avatar=avatar,
+                public=payload.public
+            )
+            group.members.add(request.auth)  # Add owner as a member
+        group.refresh_from_db(fields=['member_count'])
+        process_image(group, 'avatar', 'avatar_variants')
         return 201, group
     except Exception as e:
         return 400, {"detail": str(e)}
@@ -157,7 +233,11 @@ def create_group(
 @router.get("/{group_id}", response={200: GroupOut, 404: ErrorMessage}, auth=AuthBearer())
 def get_group(request, group_id: int = Path(...)) -> Any:
     """Get a specific group."""
-    group = get_object_or_404(Group, id=group_id, members=request.auth)
+    group = get_object_or_404(
+        Group.objects.with_summary().select_related('owner'),
+        id=group_id,
+        members=request.auth,
+    )
     return group
 
 @router.put("/{group_id}", response={200: GroupOut, 404: ErrorMessage}, auth=AuthBearer())
@@ -187,19 +267,70 @@ def delete_group(request, group_id: int = Path(...)) -> Any:
 @router.post("/{group_id}/join", response={200: GroupOut, 404: ErrorMessage}, auth=AuthBearer())
 def join_group(request, group_id: int = Path(...)) -> Any:
     """Join a group."""
-    group = get_object_or_404(Group, id=group_id)
-    group.members.add(request.auth)
+    with transaction.atomic():
+        group = get_object_or_404(Group, id=group_id)
+        group.members.add(request.auth)
+    group.refresh_from_db(fields=['member_count'])
     return group
 
 @router.post("/{group_id}/leave", response={200: GroupOut, 404: ErrorMessage}, auth=AuthBearer())
 def leave_group(request, group_id: int = Path(...)) -> Any:
     """Leave a group."""
     group = get_object_or_404(Group, id=group_id, members=request.auth)
-    if group.owner != request.auth:
-        group.members.remove(request.auth)
+    if group.owner_id != request.auth.id:
+        with transaction.atomic():
+            group.members.remove(request.auth)
+        group.refresh_from_db(fields=['member_count'])
         return group
     return {"detail": "Group owner cannot leave the group"}
 
+@router.post("/{group_id}/read", response={200: ReadStateOut, 404: ErrorMessage}, auth=AuthBearer())
+def mark_read(request, payload: ReadIn, group_id: int = Path(...)) -> Any:
+    """
+    Move the user's read pointer to `message_id`, or to the latest message.
+    The pointer never moves backwards.
+    """
+    if not membership_cache.is_member(group_id, request.auth.id):
+        return 404, {"detail": "Group not found"}
+    messages = Message.objects.filter(group_id=group_id)
+    with transaction.atomic():
+        # Holds off message inserts for this group, so message_count and the messages agree
+        group = get_object_or_404(Group.objects.select_for_update(no_key=True).only('id', 'message_count'), id=group_id)
+        if payload.message_id is None:
+            last_read = messages.order_by('-created_at', '-id').values('id').first()
+            message_id = last_read['id'] if last_read else None
+            read_count = group.message_count
+        else:
+            last_read = messages.filter(id=payload.message_id).values('created_at').first()
+            if last_read is None:
+                return 404, {"detail": "Message not found"}
+            message_id = payload.message_id
+            # Only the messages after the pointer are counted, usually a short index range
+            newer = messages.filter(
+                Q(created_at__gt=last_read['created_at'])
+                | Q(created_at=last_read['created_at'], id__gt=message_id)
+            ).count()
+            read_count = group.message_count - newer
+
+        state, _ = ReadState.objects.get_or_create(user=request.auth, group_id=group_id)
+        if message_id is not None and read_count >= state.read_count:
+            state.last_read_message_id = message_id
+            state.read_count = read_count
+            state.save(update_fields=['last_read_message_id', 'read_count', 'updated_at'])
+    return 200, {
+        "group_id": group_id,
+        "last_read_message_id": state.last_read_message_id,
+        "unread_count": max(group.message_count - state.read_count, 0),
+    }
+
+@router.get("/{group_id}/presence", response={200: PresenceOut, 404: ErrorMessage}, auth=AuthBearer())
+def get_presence(request, group_id: int = Path(...)) -> Any:
+    """Ids of the members currently connected to the group chat."""
+    if not membership_cache.is_member(group_id, request.auth.id):
+        return 404, {"detail": "Group not found"}
+    online = sorted(presence_store.online([group_id])[group_id])
+    return 200, {"group_id": group_id, "online": online, "count": len(online)}
+
 @router.get("/{group_id}/members", response=List[dict], auth=AuthBearer())
 def list_group_members(request, group_id: int = Path(...)) -> Any:
     """List all members of a group."""
@@ -218,19 +349,106 @@ def list_group_members(request, group_id: int = Path(...)) -> Any:
     
     return members_list
 
-@router.post("/{group_id}/messages", response={201: MessageOut, 400: ErrorMessage}, auth=AuthBearer())
+@router.post("/{group_id}/messages", response={201: MessageOut, 400: ErrorMessage, 404: ErrorMessage}, auth=AuthBearer())
 def create_message(request, payload: MessageCreate, group_id: int = Path(...)) -> Any:
     """Create a new message in a group."""
-    group = get_object_or_404(Group, id=group_id, members=request.auth)
-    message = Message.objects.create(
-        group=group,
-        sender=request.auth,
-        content=payload.content
-    )
+    if not membership_cache.is_member(group_id, request.auth.id):
+        return 404, {"detail": "Group not found"}
+    roll_forward()
+    with transaction.atomic():
+        message = Message.objects.create(
+            group_id=group_id,
+            sender=request.auth,
+            content=payload.content
+        )
+        Group.objects.add_messages({group_id: 1})
+    recent_messages.append(group_id, serialize(message), sender_json(request.auth))
     return 201, message
 
-@router.get("/{group_id}/messages", response=List[MessageOut], auth=AuthBearer())
-def list_messages(request, group_id: int = Path(...)) -> Any:
-    """List all messages in a group."""
-    group = get_object_or_404(Group, id=group_id, members=request.auth)
-    return Message.objects.filter(group=group)
+@router.get("/{group_id}/messages", response={200: MessagePage, 400: ErrorMessage, 404: ErrorMessage}, auth=AuthBearer())
+def list_messages(
+    request,
+    group_id: int = Path(...),
+    params: MessageListParams = Query(...),
+) -> Any:
+    """
+    List messages in a group, one page at a time.
+    Without a cursor the latest page is returned; pass `before` to load older
+    messages and `after` to fetch newer ones. Items are in chronological order.
+    The latest page is served from the group's recent-messages buffer. With
+    `include_archived=true` paging continues into archived months.
+    """
+    if not membership_cache.is_member(group_id, request.auth.id):
+        return 404, {"detail": "Group not found"}
+    if not params.before and not params.after and not params.include_archived:
+        page = recent_messages.page(group_id, params.limit)
+        if page is not None:
+            return 200, page
+    messages = Message.objects.filter(group_id=group_id).select_related('sender')
+    try:
+        page = keyset_paginate(
+            messages,
+            before=params.before,
+            after=params.after,
+            limit=params.limit,
+        )
+        if params.include_archived:
+            page = with_archived(page, group_id, before=params.before, after=params.after, limit=params.limit)
+        return 200, page
+    except InvalidCursor as e:
+        return 400, {"detail": str(e)}
+
+def _search_messages(messages, params: MessageSearchParams):
+    """Full-text match `params.q` in `messages`, newest first, with highlighted snippets."""
+    query = SearchQuery(params.q, search_type='websearch', config=SEARCH_CONFIG)
+    messages = messages.filter(search_vector=query).select_related('sender').annotate(
+        snippet=SearchHeadline(
+            'content',
+            query,
+            config=SEARCH_CONFIG,
+            start_sel='<mark>',
+            stop_sel='</mark>',
+            max_words=35,
+            min_words=15,
+        )
+    )
+    return keyset_paginate(
+        messages,
+        before=params.before,
+        after=params.after,
+        limit=params.limit,
+        newest_first=True,
+    )
+
+@router.get("/{group_id}/messages/search", response={200: MessageSearchPage, 400: ErrorMessage, 404: ErrorMessage}, auth=AuthBearer())
+def search_group_messages(
+    request,
+    group_id: int = Path(...),
+    params: MessageSearchParams = Query(...),
+) -> Any:
+    """Search the chat history of a group the user is a member of."""
+    if not membership_cache.is_member(group_id, request.auth.id):
+        return 404, {"detail": "Group not found"}
+    try:
+        return 200, _search_messages(Message.objects.filter(group_id=group_id), params)
+    except InvalidCursor as e:
+        return 400, {"detail": str(e)}
+
+@messages_router.get("/search", response={200: MessageSearchPage, 400: ErrorMessage}, auth=AuthBearer())
+def search_messages(request, params: MessageSearchParams = Query(...)) -> Any:
+    """Search messages across every group the user is a member of."""
+    messages = Message.objects.filter(group_id__in=request.auth.joined_groups.values('id'))
+    try:
+        return 200, _search_messages(messages, params)
+    except InvalidCursor as e:
+        return 400, {"detail": str(e)}
+
+@sync_router.get("", response=SyncOut, auth=AuthBearer())
+def sync(request, params: SyncParams = Query(...)) -> Any:
+    """
+    Return what changed in the user's groups since the `since` token: groups
+    joined, left or updated, membership changes and new messages. Start with
+    `since=0`, then pass the returned `token`; call again right away while
+    `has_more` is true.
+    """
+    return changes_since(request.auth, params.since, params.limit)
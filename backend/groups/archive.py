@@ -0,0 +1,249 @@
+"""
+Cold storage for old message partitions.
+
+``archive_messages`` streams a partition to a compressed file, gzipped NDJSON
+or Parquet when pyarrow is installed, records it as a ``MessageArchive`` and
+detaches the partition. ``list_messages(include_archived=true)`` reads
+history from those files once it runs out of rows in the database.
+
+Rows are written grouped by group, each group as its own gzip member or its
+own run of Parquet row groups, and ``MessageArchive.group_index`` records
+where each group starts. Reading a group's history seeks straight to it
+instead of decompressing the whole month.
+"""
+import gzip
+import os
+from collections import Counter
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Iterator, List, Optional, Tuple
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from core.codec import codec
+from core.pagination import KeysetPage, decode_cursor, encode_cursor
+from .models import MessageArchive
+from .partitions import Partition, detach_partition, drop_table, lock_partition
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:  # pragma: no cover - optional dependency
+    pyarrow = None
+    parquet = None
+
+ARCHIVE_COLUMNS = ('id', 'group_id', 'sender_id', 'content', 'created_at', 'change_seq')
+FETCH_SIZE = 5000
+
+
+def archive_dir() -> Path:
+    path = Path(settings.MESSAGE_ARCHIVE['DIR'])
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _partition_rows(name: str) -> Iterator[dict]:
+    """Stream a partition with a server-side cursor, grouped by group so readers can skip ahead."""
+    qn = connection.ops.quote_name
+    with transaction.atomic(), connection.chunked_cursor() as cursor:
+        cursor.execute(
+            f"SELECT {', '.join(qn(column) for column in ARCHIVE_COLUMNS)} FROM {qn(name)} "
+            "ORDER BY group_id, created_at, id"
+        )
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(zip(ARCHIVE_COLUMNS, row))
+
+
+def _write_ndjson(path: Path, rows: Iterator[dict], counts: Counter, index: dict) -> int:
+    written = 0
+    with open(path, 'wb') as out:
+        for group_id, group_rows in groupby(rows, key=itemgetter('group_id')):
+            start = out.tell()
+            # Concatenated gzip members are still one valid gzip file
+            with gzip.GzipFile(fileobj=out, mode='wb') as member:
+                for row in group_rows:
+                    counts[group_id] += 1
+                    # Full precision, the JSON encoder would cut timestamps to milliseconds
+                    member.write(codec.dumps({**row, 'created_at': row['created_at'].isoformat()}).encode())
+                    member.write(b'\n')
+                    written += 1
+            # Byte offset and length of the group's member
+            index[str(group_id)] = [start, out.tell() - start]
+    return written
+
+
+def _write_parquet(path: Path, rows: Iterator[dict], counts: Counter, index: dict) -> int:
+    schema = pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('group_id', pyarrow.int64()),
+        ('sender_id', pyarrow.int64()),
+        ('content', pyarrow.string()),
+        ('created_at', pyarrow.timestamp('us', tz='UTC')),
+        ('change_seq', pyarrow.int64()),
+    ])
+    written = 0
+    row_groups = 0
+    with parquet.ParquetWriter(path, schema, compression='zstd') as writer:
+        for group_id, group_rows in groupby(rows, key=itemgetter('group_id')):
+            first = row_groups
+            chunk = []
+            for row in group_rows:
+                counts[group_id] += 1
+                chunk.append(row)
+                if len(chunk) >= FETCH_SIZE:
+                    writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema), row_group_size=FETCH_SIZE)
+                    written += len(chunk)
+                    row_groups += 1
+                    chunk = []
+            if chunk:
+                writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema), row_group_size=FETCH_SIZE)
+                written += len(chunk)
+                row_groups += 1
+            # First row group of the group and how many there are
+            index[str(group_id)] = [first, row_groups - first]
+    return written
+
+
+def archive_partition(partition: Partition, format: str, drop: bool = False) -> MessageArchive:
+    """
+    Export ``partition`` to a file, then record the archive and detach the partition.
+
+    All in one transaction that locks the partition against writes first, so
+    no row can change between the export and the detach.
+    """
+    if format == MessageArchive.FORMAT_PARQUET and pyarrow is None:
+        raise RuntimeError("Parquet archives need pyarrow installed")
+    suffix = '.parquet' if format == MessageArchive.FORMAT_PARQUET else '.ndjson.gz'
+    path = archive_dir() / f'{partition.name}{suffix}'
+    tmp = path.with_name(path.name + '.tmp')
+    counts = Counter()
+    index = {}
+    writer = _write_parquet if format == MessageArchive.FORMAT_PARQUET else _write_ndjson
+    try:
+        with transaction.atomic():
+            lock_partition(partition.name)
+            try:
+                row_count = writer(tmp, _partition_rows(partition.name), counts, index)
+                os.replace(tmp, path)
+            finally:
+                tmp.unlink(missing_ok=True)
+            archive = MessageArchive.objects.create(
+                partition=partition.name,
+                range_start=partition.start,
+                range_end=partition.end,
+                path=str(path),
+                format=format,
+                row_count=row_count,
+                group_counts={str(group_id): count for group_id, count in counts.items()},
+                group_index=index,
+            )
+            detach_partition(partition.name)
+            if drop:
+                drop_table(partition.name)
+    except BaseException:
+        # The partition stays attached, nothing refers to the file
+        path.unlink(missing_ok=True)
+        raise
+    return archive
+
+
+def _read_archive(archive: MessageArchive, group_id: int) -> List[dict]:
+    position = archive.group_index.get(str(group_id))
+    if position is None:
+        return []
+    first, length = position
+    if archive.format == MessageArchive.FORMAT_PARQUET:
+        if parquet is None:
+            raise RuntimeError("Reading Parquet archives needs pyarrow installed")
+        return parquet.ParquetFile(archive.path).read_row_groups(range(first, first + length)).to_pylist()
+    with open(archive.path, 'rb') as f:
+        f.seek(first)
+        member = gzip.decompress(f.read(length))
+    rows = []
+    for line in member.splitlines():
+        row = codec.loads(line)
+        row['created_at'] = datetime.fromisoformat(row['created_at'])
+        rows.append(row)
+    return rows
+
+
+def archived_messages(
+    group_id: int,
+    *,
+    before: Optional[Tuple[datetime, int]] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    limit: int,
+) -> List[dict]:
+    """
+    Up to ``limit`` archived messages of a group strictly between the ``after`` and
+    ``before`` keys, in chronological order: the newest ones when walking back
+    with ``before`` (or no cursor), the oldest ones when walking forward with ``after``.
+    """
+    archives = MessageArchive.objects.all()
+    if before is not None:
+        archives = archives.exclude(range_start__gt=before[0])
+    if after is not None:
+        archives = archives.filter(range_end__gt=after[0])
+    walking_forward = after is not None and before is None
+    archives = archives.order_by('range_end' if walking_forward else '-range_end')
+
+    found = []
+    for archive in archives:
+        rows = [
+            row for row in _read_archive(archive, group_id)
+            if (before is None or (row['created_at'], row['id']) < before)
+            and (after is None or (row['created_at'], row['id']) > after)
+        ]
+        found.extend(rows)
+        if len(found) >= limit:
+            break
+    found.sort(key=lambda row: (row['created_at'], row['id']))
+    return found[:limit] if walking_forward else found[-limit:]
+
+
+def _as_messages(rows: List[dict]) -> list:
+    """Give archived rows the shape of ``Message`` objects, dropping those whose sender is gone."""
+    User = get_user_model()
+    senders = User.objects.in_bulk({row['sender_id'] for row in rows})
+    return [
+        SimpleNamespace(id=row['id'], content=row['content'], created_at=row['created_at'], sender=senders[row['sender_id']])
+        for row in rows
+        if row['sender_id'] in senders
+    ]
+
+
+def with_archived(page: KeysetPage, group_id: int, *, before: Optional[str], after: Optional[str], limit: int) -> KeysetPage:
+    """Continue a ``list_messages`` page into the archives where the database runs out."""
+    if after:
+        rows = archived_messages(group_id, after=decode_cursor(after), limit=limit)
+        if not rows:
+            return page
+        # Archived rows are older than anything still in the table
+        page.items = (_as_messages(rows) + page.items)[:limit]
+    else:
+        if page.older_cursor is not None or len(page.items) >= limit:
+            return page
+        if page.items:
+            boundary = (page.items[0].created_at, page.items[0].id)
+        else:
+            boundary = decode_cursor(before) if before else None
+        wanted = limit - len(page.items)
+        rows = archived_messages(group_id, before=boundary, limit=wanted + 1)
+        has_older = len(rows) > wanted
+        rows = rows[-wanted:]
+        page.items = _as_messages(rows) + page.items
+        if has_older and page.items:
+            page.older_cursor = encode_cursor(page.items[0].created_at, page.items[0].id)
+
+    if page.items:
+        if after:
+            page.older_cursor = encode_cursor(page.items[0].created_at, page.items[0].id)
+        page.newer_cursor = encode_cursor(page.items[-1].created_at, page.items[-1].id)
+    return page
@@ -1,36 +1,136 @@
-import json
+import asyncio
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import Group, Message
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from core.codec import codec
+from core.profiling import ProfiledConsumerMixin
+from .membership import membership_cache
+from .presence import get_presence_tracker
+from .recent import recent_messages, sender_json, serialize
+from .sink import get_message_sink
 
-User = get_user_model()
+MAX_MESSAGE_LENGTH = 4000
+MAX_STREAM_GROUPS = 500
 
-@database_sync_to_async
-def get_group_member(group_id, user):
-    if isinstance(user, AnonymousUser):
-        return None
-    try:
-        return Group.objects.filter(id=group_id, members=user).first()
-    except Group.DoesNotExist:
-        return None
+# Strong references to fire-and-forget tasks until they finish
+_background_tasks = set()
 
-@database_sync_to_async
-def save_message(group_id, user_id, content):
-    group = Group.objects.get(id=group_id)
-    user = User.objects.get(id=user_id)
-    return Message.objects.create(group=group, sender=user, content=content)
+def room_name(group_id: int) -> str:
+    return f'chat_{group_id}'
+
+class GroupEventsConsumer(ProfiledConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Chat behaviour shared by the per-group and the multiplexed endpoints.
+
+    Every event is broadcast as a JSON envelope with a ``type`` and the
+    ``group_id``; the envelope is encoded once and the same text is
+    forwarded to every socket subscribed to the group.
+    """
+
+    async def is_member(self, group_id: int) -> bool:
+        if not self.user.is_authenticated:
+            return False
+        return await membership_cache.ais_member(group_id, self.user.id)
+
+    def decode(self, text_data, bytes_data):
+        try:
+            data = codec.loads(text_data if text_data is not None else bytes_data)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    async def handle_event(self, group_id: int, kind: str, data: dict):
+        if kind == 'message':
+            await self.handle_message(group_id, data)
+        elif kind == 'typing':
+            await self.broadcast(group_id, self.envelope('typing', group_id))
+        else:
+            await self.send_error(f"Unknown event type: {kind}", group_id)
+
+    async def handle_message(self, group_id: int, data: dict):
+        content = data.get('message')
+        if not isinstance(content, str) or not content.strip():
+            await self.send_error("Message must be a non-empty string", group_id)
+            return
+        if len(content) > MAX_MESSAGE_LENGTH:
+            await self.send_error(f"Message exceeds {MAX_MESSAGE_LENGTH} characters", group_id)
+            return
+        if '\x00' in content:
+            # PostgreSQL text cannot hold NUL, the sink could never store it
+            await self.send_error("Message must not contain NUL characters", group_id)
+            return
+
+        # Hand the message to the write-behind sink; it is persisted in the background
+        message = await get_message_sink().submit(group_id, self.user.id, content)
+        await self.broadcast(group_id, self.envelope(
+            'message',
+            group_id,
+            id=message.id,
+            message=content,
+            timestamp=message.created_at.isoformat(),
+        ))
+        # Keep the group's recent-messages buffer warm without holding up the sender
+        task = asyncio.ensure_future(recent_messages.aappend(group_id, serialize(message), self.sender_json()))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    def sender_json(self) -> dict:
+        if not hasattr(self, '_sender_json'):
+            self._sender_json = sender_json(self.user)
+        return self._sender_json
+
+    async def send_backfill(self, group_id: int):
+        """Send the latest buffered messages so a fresh socket needs no history request."""
+        messages, _ = await recent_messages.alatest(group_id)
+        await self.send(text_data=codec.dumps({'type': 'backfill', 'group_id': group_id, 'messages': messages}))
+
+    def envelope(self, kind: str, group_id: int, **fields) -> dict:
+        return {
+            'type': kind,
+            'group_id': group_id,
+            'user_id': self.user.id,
+            'username': self.user.username,
+            **fields,
+        }
+
+    async def broadcast(self, group_id: int, envelope: dict):
+        """Encode once and fan the same text out to the whole group."""
+        await self.channel_layer.group_send(
+            room_name(group_id),
+            {'type': 'chat.broadcast', 'text': codec.dumps(envelope)},
+        )
+
+    async def send_error(self, detail: str, group_id: int = None):
+        error = {'type': 'error', 'detail': detail}
+        if group_id is not None:
+            error['group_id'] = group_id
+        await self.send(text_data=codec.dumps(error))
+
+    async def chat_broadcast(self, event):
+        # Already encoded by the sender, forward as-is
+        await self.send(text_data=event['text'])
+
+class ChatConsumer(GroupEventsConsumer):
+    """
+    WebSocket endpoint for one group chat.
+
+    Clients send ``{"type": "message", "message": "..."}``,
+    ``{"type": "typing"}`` or ``{"type": "heartbeat"}`` frames (``type``
+    defaults to ``message``). Every frame keeps the user's presence alive, so
+    idle clients send a heartbeat at least every ``PRESENCE['TTL'] / 3``
+    seconds. Presence changes arrive as coalesced ``presence`` diffs from
+    ``groups.presence``. Right after connecting the client receives a
+    ``backfill`` frame with the group's latest messages.
+    """
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.group_id = self.scope['url_route']['kwargs']['group_id']
-        self.room_group_name = f'chat_{self.group_id}'
-        self.user = self.scope["user"]
+        self.group_id = int(self.scope['url_route']['kwargs']['group_id'])
+        self.room_group_name = room_name(self.group_id)
+        self.user = self.scope.get('user', AnonymousUser())
+        self.joined = False
 
         # Check if user is authenticated and a member of the group
-        group = await get_group_member(self.group_id, self.user)
-        if not group:
+        if not await self.is_member(self.group_id):
             await self.close()
             return
 
@@ -39,44 +139,122 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
-
         await self.accept()
+        self.joined = True
+        get_presence_tracker().join(self.group_id, self.user.id, self.channel_name)
+        await self.send_backfill(self.group_id)
 
     async def disconnect(self, close_code):
+        if not getattr(self, 'joined', False):
+            return
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        get_presence_tracker().leave(self.group_id, self.user.id, self.channel_name)
 
-    async def receive(self, text_data):
-        if isinstance(self.user, AnonymousUser):
+    async def receive(self, text_data=None, bytes_data=None):
+        # Membership is re-checked per frame so a user who left is cut off
+        if not await self.is_member(self.group_id):
             await self.close()
             return
 
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
+        data = self.decode(text_data, bytes_data)
+        if data is None:
+            await self.send_error("Invalid message format")
+            return
 
-        # Save message to database
-        saved_message = await save_message(self.group_id, self.user.id, message)
+        get_presence_tracker().heartbeat(self.group_id, self.user.id, self.channel_name)
+        kind = data.get('type', 'message')
+        if kind != 'heartbeat':
+            await self.handle_event(self.group_id, kind, data)
 
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'user_id': self.user.id,
-                'username': self.user.username,
-                'timestamp': saved_message.created_at.isoformat()
-            }
-        )
+class StreamConsumer(GroupEventsConsumer):
+    """
+    One WebSocket per user for all of their groups.
+
+    On connect the socket is subscribed to every group the user belongs to.
+    Frames name the group they are about: ``{"type": "message",
+    "group_id": 1, "message": "..."}``, ``{"type": "typing", "group_id": 1}``,
+    ``{"type": "subscribe", "group_id": 1}`` and ``{"type": "unsubscribe",
+    "group_id": 1}``; ``{"type": "heartbeat"}`` keeps presence alive in every
+    subscribed group. Every event sent to the client carries a ``group_id``.
+    An explicit ``subscribe`` is answered with a ``backfill`` frame holding
+    the group's latest messages.
+    """
+
+    async def connect(self):
+        self.user = self.scope.get('user', AnonymousUser())
+        self.subscriptions = set()
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        await self.accept()
+        for group_id in await sync_to_async(self.joined_group_ids)():
+            await self.subscribe(group_id)
+        await self.send(text_data=codec.dumps({'type': 'subscribed', 'group_ids': sorted(self.subscriptions)}))
+
+    def joined_group_ids(self):
+        return list(self.user.joined_groups.order_by('-id').values_list('id', flat=True)[:MAX_STREAM_GROUPS])
+
+    async def subscribe(self, group_id: int):
+        if group_id in self.subscriptions:
+            return
+        await self.channel_layer.group_add(room_name(group_id), self.channel_name)
+        self.subscriptions.add(group_id)
+        get_presence_tracker().join(group_id, self.user.id, self.channel_name)
+
+    async def unsubscribe(self, group_id: int):
+        if group_id not in self.subscriptions:
+            return
+        await self.channel_layer.group_discard(room_name(group_id), self.channel_name)
+        self.subscriptions.discard(group_id)
+        get_presence_tracker().leave(group_id, self.user.id, self.channel_name)
+
+    async def disconnect(self, close_code):
+        for group_id in list(getattr(self, 'subscriptions', ())):
+            await self.unsubscribe(group_id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode(text_data, bytes_data)
+        if data is None:
+            await self.send_error("Invalid message format")
+            return
+
+        tracker = get_presence_tracker()
+        for group_id in self.subscriptions:
+            tracker.heartbeat(group_id, self.user.id, self.channel_name)
+
+        kind = data.get('type')
+        if kind == 'heartbeat':
+            return
+        try:
+            group_id = int(data['group_id'])
+        except (KeyError, TypeError, ValueError):
+            await self.send_error("A numeric group_id is required")
+            return
+
+        if kind == 'unsubscribe':
+            await self.unsubscribe(group_id)
+            await self.send(text_data=codec.dumps({'type': 'unsubscribed', 'group_id': group_id}))
+            return
+
+        # Membership is re-checked per frame so a user who left is cut off from that group
+        if not await self.is_member(group_id):
+            await self.unsubscribe(group_id)
+            await self.send_error("Not a member of this group", group_id)
+            return
 
-    async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': event['message'],
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'timestamp': event['timestamp']
-        }))
+        if kind == 'subscribe':
+            if group_id not in self.subscriptions and len(self.subscriptions) >= MAX_STREAM_GROUPS:
+                await self.send_error(f"At most {MAX_STREAM_GROUPS} groups per socket", group_id)
+                return
+            await self.subscribe(group_id)
+            await self.send(text_data=codec.dumps({'type': 'subscribed', 'group_ids': [group_id]}))
+            await self.send_backfill(group_id)
+        elif group_id not in self.subscriptions:
+            await self.send_error("Subscribe to the group first", group_id)
+        else:
+            await self.handle_event(group_id, kind, data)
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from groups.archive import archive_partition, pyarrow
+from groups.models import MessageArchive
+from groups.partitions import LEGACY_PARTITION, add_months, list_partitions, month_start, split_legacy_partition
+
+
+class Command(BaseCommand):
+    help = (
+        "Export message partitions older than the retention window to compressed "
+        "files in MESSAGE_ARCHIVE['DIR'] and detach them from groups_message."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-months',
+            type=int,
+            default=settings.MESSAGE_ARCHIVE['KEEP_MONTHS'],
+            help="Months of messages, including the current one, to keep in the database.",
+        )
+        parser.add_argument(
+            '--format',
+            choices=[choice for choice, _ in MessageArchive.FORMAT_CHOICES],
+            default=settings.MESSAGE_ARCHIVE['FORMAT'],
+        )
+        parser.add_argument('--drop', action='store_true', help="Drop the partitions once detached.")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the partitions that would be archived.")
+
+    def handle(self, *args, **options):
+        if options['format'] == MessageArchive.FORMAT_PARQUET and pyarrow is None:
+            raise CommandError("Parquet archives need pyarrow installed")
+        if options['keep_months'] < 1:
+            raise CommandError("--keep-months must be at least 1")
+
+        cutoff = add_months(month_start(timezone.now()), 1 - options['keep_months'])
+        # The legacy partition reaches into recent months; cut its old months out first
+        if options['dry_run']:
+            if any(partition.name == LEGACY_PARTITION for partition in list_partitions()):
+                self.stdout.write(f"Would split the months before {cutoff:%Y-%m} out of {LEGACY_PARTITION}")
+        else:
+            for name in split_legacy_partition(until=cutoff):
+                self.stdout.write(f"Split {name} out of {LEGACY_PARTITION}")
+        archivable = [
+            partition for partition in list_partitions()
+            if not partition.default and partition.end is not None and partition.end <= cutoff
+        ]
+        for partition in archivable:
+            if options['dry_run']:
+                self.stdout.write(f"Would archive {partition.name}")
+                continue
+            archive = archive_partition(partition, options['format'], drop=options['drop'])
+            self.stdout.write(f"Archived {archive.row_count} messages of {partition.name} to {archive.path}")
+        self.stdout.write(self.style.SUCCESS(f"{len(archivable)} partitions older than {cutoff:%Y-%m}"))
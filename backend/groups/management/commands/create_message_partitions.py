@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from groups.partitions import ensure_partitions
+
+
+class Command(BaseCommand):
+    help = "Create the monthly groups_message partitions for the current and the coming months."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months',
+            type=int,
+            default=settings.MESSAGE_ARCHIVE['PARTITIONS_AHEAD'],
+            help="How many months ahead of the current one to cover.",
+        )
+
+    def handle(self, *args, **options):
+        created = ensure_partitions(options['months'])
+        for name in created:
+            self.stdout.write(f"Created {name}")
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions"))
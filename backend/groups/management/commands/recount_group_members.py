@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from groups.models import Group
+from groups.trending import trending_groups
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized Group.member_count from the membership table."
+
+    def handle(self, *args, **options):
+        updated = Group.objects.recount_members()
+        trending_groups.invalidate()
+        self.stdout.write(self.style.SUCCESS(f"Recounted members of {updated} groups"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from collections import Counter
+from django.db import transaction
+from groups.models import Group, MessageArchive
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized Group.message_count from the message table and the archives."
+
+    def handle(self, *args, **options):
+        archived = Counter()
+        for group_counts in MessageArchive.objects.values_list('group_counts', flat=True):
+            archived.update({int(group_id): count for group_id, count in group_counts.items()})
+        with transaction.atomic():
+            updated = Group.objects.recount_messages()
+            Group.objects.add_messages(archived)
+        self.stdout.write(self.style.SUCCESS(f"Recounted messages of {updated} groups"))
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from groups.sink import MessageSpool, replay_segments
+
+
+class Command(BaseCommand):
+    help = "Write chat messages left in the spool by crashed workers to the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help="Replay every segment, including those of running workers. Only use with the chat workers stopped.",
+        )
+
+    def handle(self, *args, **options):
+        spool = MessageSpool(settings.MESSAGE_SINK['SPOOL_DIR'])
+        if options['all']:
+            segments = sorted(spool.directory.glob('messages-*.ndjson'))
+        else:
+            segments = spool.orphans()
+        replayed = replay_segments(segments, settings.MESSAGE_SINK['BATCH_SIZE'])
+        self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} messages from {len(segments)} segments"))
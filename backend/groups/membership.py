@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from core.metrics import registry
+from .models import Group
+
+logger = logging.getLogger(__name__)
+
+
+class MembershipCache:
+    """
+    Member id sets per group, for O(1) membership checks.
+
+    A small in-process LRU sits in front of the shared Django cache (Redis),
+    which sits in front of the membership table. ``invalidate`` clears both
+    tiers; it is wired to ``m2m_changed`` on ``Group.members`` and to group
+    deletion, so joins, leaves and admin edits are seen immediately by this
+    process and within ``local_ttl`` seconds by the others.
+
+    Like principal versions, every group has a generation in the shared cache
+    that ``invalidate`` replaces. Shared entries carry the generation read
+    before their members were loaded and are ignored once it changed, so a
+    reader that loaded before a commit cannot cache the old members after the
+    invalidation.
+    """
+
+    key_prefix = 'groups:members:v2'
+
+    def __init__(self, cache_alias='default', max_groups=10000, local_ttl=5.0, shared_ttl=60, generation_ttl=86400):
+        self.cache_alias = cache_alias
+        self.max_groups = max_groups
+        self.local_ttl = local_ttl
+        self.shared_ttl = shared_ttl
+        self.generation_ttl = generation_ttl
+        self._local = OrderedDict()  # group_id -> (member_ids, expires_at)
+        self._invalidations = 0  # In process, loads that overlap any invalidation are not kept
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _key(self, group_id):
+        return f'{self.key_prefix}:{group_id}'
+
+    def _generation_key(self, group_id):
+        return f'{self.key_prefix}:{group_id}:gen'
+
+    def _get_local(self, group_id):
+        with self._lock:
+            entry = self._local.get(group_id)
+            if entry is None:
+                return None
+            member_ids, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._local[group_id]
+                return None
+            self._local.move_to_end(group_id)
+            self.hits += 1
+            return member_ids
+
+    def _set_local(self, group_id, member_ids, invalidations):
+        with self._lock:
+            if self._invalidations != invalidations:
+                # Invalidated while we were loading
+                return
+            self._local[group_id] = (member_ids, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(group_id)
+            while len(self._local) > self.max_groups:
+                self._local.popitem(last=False)
+
+    def members(self, group_id: int) -> frozenset:
+        """Return the ids of the group's members, loading them if not cached."""
+        group_id = int(group_id)
+        member_ids = self._get_local(group_id)
+        if member_ids is not None:
+            return member_ids
+
+        with self._lock:
+            invalidations = self._invalidations
+        cache = caches[self.cache_alias]
+        key, generation_key = self._key(group_id), self._generation_key(group_id)
+        member_ids = None
+        try:
+            # Read before the members, so an invalidation committed in between retires what we store
+            cached = cache.get_many([key, generation_key])
+            generation = cached.get(generation_key) or ''
+            entry = cached.get(key)
+            if entry is not None and entry[0] == generation:
+                member_ids = entry[1]
+        except Exception:
+            logger.exception("Shared membership cache unavailable, falling back to the database")
+            generation = None
+
+        if member_ids is not None:
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            member_ids = frozenset(
+                Group.members.through.objects.filter(group_id=group_id).values_list('user_id', flat=True)
+            )
+            if generation is not None:
+                try:
+                    cache.set(key, (generation, member_ids), self.shared_ttl)
+                except Exception:
+                    logger.exception("Failed to store group members in the shared cache")
+
+        self._set_local(group_id, member_ids, invalidations)
+        return member_ids
+
+    def is_member(self, group_id: int, user_id: int) -> bool:
+        return user_id in self.members(group_id)
+
+    async def ais_member(self, group_id: int, user_id: int) -> bool:
+        """Async check that answers local hits without leaving the event loop."""
+        member_ids = self._get_local(int(group_id))
+        if member_ids is None:
+            member_ids = await sync_to_async(self.members)(group_id)
+        return user_id in member_ids
+
+    def invalidate(self, group_id: int) -> None:
+        group_id = int(group_id)
+        with self._lock:
+            self._local.pop(group_id, None)
+            self._invalidations += 1
+        try:
+            cache = caches[self.cache_alias]
+            cache.set(self._generation_key(group_id), uuid.uuid4().hex, self.generation_ttl)
+            cache.delete(self._key(group_id))
+        except Exception:
+            logger.exception(f"Failed to invalidate shared membership cache for group {group_id}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._local.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "size": len(self._local),
+                "max_groups": self.max_groups,
+            }
+
+
+membership_cache = MembershipCache(
+    cache_alias=settings.GROUP_MEMBERSHIP_CACHE['CACHE'],
+    max_groups=settings.GROUP_MEMBERSHIP_CACHE['MAX_GROUPS'],
+    local_ttl=settings.GROUP_MEMBERSHIP_CACHE['LOCAL_TTL'],
+    shared_ttl=settings.GROUP_MEMBERSHIP_CACHE['SHARED_TTL'],
+)
+
+registry.register_collector(
+    'groups_membership_cache', 'Group membership cache counters for this process', 'gauge', membership_cache.stats,
+)
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0002_group_public"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["group", "created_at", "id"],
+                name="groups_msg_group_created_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:40
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0003_message_group_created_idx"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name="group",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=(
+                    django.contrib.postgres.search.SearchVector(
+                        "name", config="english", weight="A"
+                    )
+                    + django.contrib.postgres.search.SearchVector(
+                        "goal", config="english", weight="B"
+                    )
+                    + django.contrib.postgres.search.SearchVector(
+                        "description", config="english", weight="C"
+                    )
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="group",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="groups_group_search_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="group",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["name"],
+                name="groups_group_name_trgm_idx",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:05
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0004_group_search_vector"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.SearchVector(
+                    "content", config="english"
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="groups_msg_search_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0005_message_search_vector"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="created_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.3 on 2026-10-18 14:35
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def backfill_member_count(apps, schema_editor):
+    Group = apps.get_model("groups", "Group")
+    Membership = Group.members.through
+    counts = (
+        Membership.objects.filter(group=models.OuterRef("pk"))
+        .order_by()
+        .values("group")
+        .annotate(count=models.Count("*"))
+        .values("count")
+    )
+    Group.objects.update(
+        member_count=Coalesce(models.Subquery(counts), 0)
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0008_alter_group_avatar"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="group",
+            name="member_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_member_count, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="group",
+            index=models.Index(
+                fields=["public", "member_count", "id"],
+                name="groups_public_members_idx",
+            ),
+        ),
+    ]
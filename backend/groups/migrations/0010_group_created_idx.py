@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0009_group_member_count"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="group",
+            index=models.Index(
+                fields=["created_at", "id"], name="groups_group_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,113 @@
+# Generated by Django 5.1.3 on 2026-10-18 16:40
+
+import django.db.models.deletion
+import groups.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_membership_changes(apps, schema_editor):
+    # Existing memberships become joins, so a first sync sees every member
+    Group = apps.get_model("groups", "Group")
+    MembershipChange = apps.get_model("groups", "MembershipChange")
+    memberships = Group.members.through.objects.order_by("id").values_list("group_id", "user_id")
+    MembershipChange.objects.bulk_create(
+        (MembershipChange(group_id=group_id, user_id=user_id, joined=True) for group_id, user_id in memberships.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0010_group_created_idx"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="CREATE SEQUENCE groups_change_seq;",
+            reverse_sql="DROP SEQUENCE groups_change_seq;",
+        ),
+        migrations.AddField(
+            model_name="group",
+            name="change_seq",
+            field=models.BigIntegerField(
+                db_default=groups.models.NextChangeSeq(), editable=False
+            ),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="change_seq",
+            field=models.BigIntegerField(
+                db_default=groups.models.NextChangeSeq(), editable=False
+            ),
+        ),
+        # Any UPDATE of a group, including the member_count increments, is a change
+        migrations.RunSQL(
+            sql="""
+            CREATE FUNCTION groups_group_bump_change_seq() RETURNS trigger AS $$
+            BEGIN
+                NEW.change_seq := nextval('groups_change_seq');
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER groups_group_change_seq
+                BEFORE UPDATE ON groups_group
+                FOR EACH ROW EXECUTE FUNCTION groups_group_bump_change_seq();
+            """,
+            reverse_sql="""
+            DROP TRIGGER groups_group_change_seq ON groups_group;
+            DROP FUNCTION groups_group_bump_change_seq();
+            """,
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["group", "change_seq"], name="groups_msg_group_change_idx"
+            ),
+        ),
+        migrations.CreateModel(
+            name="MembershipChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("group_id", models.BigIntegerField()),
+                ("joined", models.BooleanField()),
+                (
+                    "change_seq",
+                    models.BigIntegerField(
+                        db_default=groups.models.NextChangeSeq(), editable=False
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "change_seq"], name="groups_mchange_user_idx"
+                    ),
+                    models.Index(
+                        fields=["group_id", "change_seq"],
+                        name="groups_mchange_group_idx",
+                    ),
+                ],
+            },
+        ),
+        migrations.RunPython(backfill_membership_changes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.1.3 on 2026-10-18 17:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def backfill_message_count(apps, schema_editor):
+    Group = apps.get_model("groups", "Group")
+    Message = apps.get_model("groups", "Message")
+    counts = (
+        Message.objects.filter(group=models.OuterRef("pk"))
+        .order_by()
+        .values("group")
+        .annotate(count=models.Count("*"))
+        .values("count")
+    )
+    Group.objects.update(
+        message_count=Coalesce(models.Subquery(counts), 0)
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0011_change_seq_membershipchange"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="group",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_message_count, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name="ReadState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "last_read_message_id",
+                    models.BigIntegerField(blank=True, null=True),
+                ),
+                ("read_count", models.PositiveIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "group",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="read_states",
+                        to="groups.group",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="read_states",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("user", "group"), name="groups_readstate_user_group_uniq"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,143 @@
+# Generated by Django 5.1.3 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+# Turns groups_message into a table partitioned by month on created_at. The
+# existing table becomes the partition for everything before next month, so
+# no rows are copied; attaching it still scans it once and builds the
+# (id, created_at) primary key index. archive_messages later splits the
+# legacy partition into months as they fall out of the retention window.
+# PostgreSQL requires the partition key in every unique constraint, so the
+# key is (id, created_at); ids stay unique because they all come from
+# groups_message_id_seq.
+# Partitions for the next three months are created here; the write paths and
+# create_message_partitions keep PARTITIONS_AHEAD months rolling forward
+# (groups.partitions.roll_forward).
+PARTITION_MESSAGES = """
+DO $$
+DECLARE
+    next_id bigint;
+    bound timestamptz := (date_trunc('month', now() AT TIME ZONE 'UTC') + interval '1 month') AT TIME ZONE 'UTC';
+    month_start timestamptz;
+BEGIN
+    EXECUTE format('SELECT last_value FROM %s', pg_get_serial_sequence('groups_message', 'id')) INTO next_id;
+
+    ALTER TABLE groups_message RENAME TO groups_message_legacy;
+    ALTER TABLE groups_message_legacy RENAME CONSTRAINT groups_message_pkey TO groups_message_legacy_pkey;
+    ALTER INDEX groups_msg_group_created_idx RENAME TO groups_msg_legacy_group_created_idx;
+    ALTER INDEX groups_msg_search_idx RENAME TO groups_msg_legacy_search_idx;
+    ALTER INDEX groups_msg_group_change_idx RENAME TO groups_msg_legacy_group_change_idx;
+
+    -- Partitions cannot carry their own id generator: move it to the parent
+    ALTER TABLE groups_message_legacy ALTER COLUMN id DROP IDENTITY IF EXISTS;
+    ALTER TABLE groups_message_legacy ALTER COLUMN id DROP DEFAULT;
+    DROP SEQUENCE IF EXISTS groups_message_id_seq;
+    CREATE SEQUENCE groups_message_id_seq;
+    -- Past the ids chat sinks may have reserved but not written yet
+    PERFORM setval('groups_message_id_seq', GREATEST(next_id, 1));
+
+    CREATE TABLE groups_message (LIKE groups_message_legacy INCLUDING DEFAULTS INCLUDING GENERATED)
+        PARTITION BY RANGE (created_at);
+    ALTER TABLE groups_message ALTER COLUMN id SET DEFAULT nextval('groups_message_id_seq');
+    ALTER SEQUENCE groups_message_id_seq OWNED BY groups_message.id;
+    ALTER TABLE groups_message ADD CONSTRAINT groups_message_pkey PRIMARY KEY (id, created_at);
+    ALTER TABLE groups_message ADD CONSTRAINT groups_message_group_id_fk
+        FOREIGN KEY (group_id) REFERENCES groups_group (id) DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE groups_message ADD CONSTRAINT groups_message_sender_id_fk
+        FOREIGN KEY (sender_id) REFERENCES users_user (id) DEFERRABLE INITIALLY DEFERRED;
+    -- Matching indexes of the legacy table are attached instead of rebuilt
+    CREATE INDEX groups_msg_group_created_idx ON groups_message (group_id, created_at, id);
+    CREATE INDEX groups_msg_search_idx ON groups_message USING gin (search_vector);
+    CREATE INDEX groups_msg_group_change_idx ON groups_message (group_id, change_seq);
+    CREATE INDEX groups_message_sender_idx ON groups_message (sender_id);
+
+    EXECUTE format(
+        'ALTER TABLE groups_message ATTACH PARTITION groups_message_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        bound
+    );
+    FOR i IN 0..2 LOOP
+        month_start := bound + make_interval(months => i);
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF groups_message FOR VALUES FROM (%L) TO (%L)',
+            'groups_message_p' || to_char(month_start AT TIME ZONE 'UTC', 'YYYYMM'),
+            month_start,
+            month_start + interval '1 month'
+        );
+    END LOOP;
+    -- Catches rows past the last monthly partition until create_message_partitions runs
+    CREATE TABLE groups_message_default PARTITION OF groups_message DEFAULT;
+END;
+$$;
+"""
+
+# Back to a plain table. The rows of every attached partition are copied;
+# archived months stay in their files and detached tables are left alone.
+UNPARTITION_MESSAGES = """
+DO $$
+DECLARE
+    next_id bigint;
+BEGIN
+    SELECT last_value INTO next_id FROM groups_message_id_seq;
+
+    CREATE TABLE groups_message_plain (LIKE groups_message INCLUDING DEFAULTS INCLUDING GENERATED);
+    ALTER TABLE groups_message_plain ALTER COLUMN id DROP DEFAULT;
+    INSERT INTO groups_message_plain (id, group_id, sender_id, content, created_at, change_seq)
+        SELECT id, group_id, sender_id, content, created_at, change_seq FROM groups_message;
+    DROP TABLE groups_message;
+    ALTER TABLE groups_message_plain RENAME TO groups_message;
+
+    ALTER TABLE groups_message ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+    PERFORM setval(pg_get_serial_sequence('groups_message', 'id'), GREATEST(next_id, 1));
+    ALTER TABLE groups_message ADD CONSTRAINT groups_message_pkey PRIMARY KEY (id);
+    ALTER TABLE groups_message ADD CONSTRAINT groups_message_group_id_fk
+        FOREIGN KEY (group_id) REFERENCES groups_group (id) DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE groups_message ADD CONSTRAINT groups_message_sender_id_fk
+        FOREIGN KEY (sender_id) REFERENCES users_user (id) DEFERRABLE INITIALLY DEFERRED;
+    CREATE INDEX groups_msg_group_created_idx ON groups_message (group_id, created_at, id);
+    CREATE INDEX groups_msg_search_idx ON groups_message USING gin (search_vector);
+    CREATE INDEX groups_msg_group_change_idx ON groups_message (group_id, change_seq);
+    CREATE INDEX groups_message_sender_idx ON groups_message (sender_id);
+END;
+$$;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0012_group_message_count_readstate"),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=PARTITION_MESSAGES, reverse_sql=UNPARTITION_MESSAGES),
+        migrations.CreateModel(
+            name="MessageArchive",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("partition", models.CharField(max_length=63, unique=True)),
+                ("range_start", models.DateTimeField(blank=True, null=True)),
+                ("range_end", models.DateTimeField()),
+                ("path", models.CharField(max_length=500)),
+                (
+                    "format",
+                    models.CharField(
+                        choices=[("ndjson", "Gzipped NDJSON"), ("parquet", "Parquet")],
+                        max_length=10,
+                    ),
+                ),
+                ("row_count", models.PositiveBigIntegerField(default=0)),
+                ("group_counts", models.JSONField(default=dict)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "ordering": ["-range_end"],
+            },
+        ),
+    ]
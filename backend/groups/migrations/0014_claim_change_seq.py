@@ -0,0 +1,84 @@
+# Generated by Django 5.1.3 on 2026-10-18 21:10
+
+import groups.models
+from django.db import migrations, models
+
+# Sequence numbers are drawn before their transaction commits, so a sync
+# reader cannot tell from the sequence alone which numbers may still show up.
+# Before its first draw, a transaction takes a shared advisory lock keyed by
+# the last number already handed out. The lock is visible in pg_locks until
+# the transaction ends, and every number the transaction draws is above its
+# key. The sequence has no per-session cache (CACHE 1), so numbers are drawn
+# in order across sessions.
+# The lock uses the two-key form so it has a namespace of its own: the high
+# 16 bits of the first key are those of hashtext('groups_change_seq'), its low
+# 16 bits and the second key hold the number, which leaves 48 bits for it.
+CLAIM_CHANGE_SEQ = """
+CREATE FUNCTION groups_next_change_seq() RETURNS bigint AS $$
+DECLARE
+    announced bigint;
+BEGIN
+    IF coalesce(current_setting('groups.change_seq_floor', true), '') = '' THEN
+        SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END INTO announced FROM groups_change_seq;
+        IF announced >= 281474976710656 THEN
+            RAISE EXCEPTION 'groups_change_seq is past the 48 bits its advisory locks can hold';
+        END IF;
+        PERFORM pg_advisory_xact_lock_shared(
+            (hashtext('groups_change_seq') & -65536) | (announced >> 32)::int,
+            announced::bit(32)::int
+        );
+        PERFORM set_config('groups.change_seq_floor', announced::text, true);
+    END IF;
+    RETURN nextval('groups_change_seq');
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION groups_group_bump_change_seq() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := groups_next_change_seq();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+UNCLAIM_CHANGE_SEQ = """
+CREATE OR REPLACE FUNCTION groups_group_bump_change_seq() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := nextval('groups_change_seq');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION groups_next_change_seq();
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0013_partition_messages"),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=CLAIM_CHANGE_SEQ, reverse_sql=UNCLAIM_CHANGE_SEQ),
+        migrations.AlterField(
+            model_name="group",
+            name="change_seq",
+            field=models.BigIntegerField(
+                db_default=groups.models.ClaimChangeSeq(), editable=False
+            ),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="change_seq",
+            field=models.BigIntegerField(
+                db_default=groups.models.ClaimChangeSeq(), editable=False
+            ),
+        ),
+        migrations.AlterField(
+            model_name="membershipchange",
+            name="change_seq",
+            field=models.BigIntegerField(
+                db_default=groups.models.ClaimChangeSeq(), editable=False
+            ),
+        ),
+    ]
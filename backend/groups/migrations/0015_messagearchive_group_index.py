@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0014_claim_change_seq"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="messagearchive",
+            name="group_index",
+            field=models.JSONField(default=dict),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.3 on 2026-10-18 23:10
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("groups", "0015_messagearchive_group_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="group",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["goal"],
+                name="groups_group_goal_trgm_idx",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="group",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["description"],
+                name="groups_group_desc_trgm_idx",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+    ]
@@ -1,8 +1,99 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Greatest, Substr
 from django.conf import settings
+from django.utils import timezone
+from core.storage import content_addressed_storage
 
 # Create your models here.
 
+MESSAGE_PREVIEW_LENGTH = 140
+SEARCH_CONFIG = 'english'
+# One PostgreSQL sequence orders every change a sync client needs to see
+CHANGE_SEQUENCE = 'groups_change_seq'
+
+class NextChangeSeq(models.Func):
+    """``nextval`` of the change sequence, used as a database default."""
+    function = 'nextval'
+    template = f"%(function)s('{CHANGE_SEQUENCE}')"
+    output_field = models.BigIntegerField()
+
+class ClaimChangeSeq(models.Func):
+    """
+    The next change number, drawn by ``groups_next_change_seq()`` (migration 0014),
+    which first announces the transaction to sync readers; see ``groups.sync``.
+    """
+    function = 'groups_next_change_seq'
+    template = '%(function)s()'
+    output_field = models.BigIntegerField()
+
+class GroupQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """Public groups plus the groups ``user`` is a member of, without duplicate rows."""
+        return self.filter(Q(public=True) | Q(id__in=user.joined_groups.values('id')))
+
+    def with_membership(self, user):
+        """Annotate ``is_member`` for ``user`` with an indexed EXISTS in the same SELECT."""
+        return self.annotate(
+            is_member=Exists(self.model.members.through.objects.filter(group=OuterRef('pk'), user=user))
+        )
+
+    def with_summary(self):
+        """
+        Annotate a preview of the latest message.
+
+        Everything is computed with correlated subqueries in the same SELECT,
+        so listing N groups costs one query instead of one per group. The
+        member count is the denormalized ``member_count`` column.
+        """
+        latest = Message.objects.filter(group=OuterRef('pk')).order_by('-created_at', '-id')
+        return self.annotate(
+            last_message_id=Subquery(latest.values('id')[:1]),
+            last_message_content=Subquery(
+                latest.annotate(preview=Substr('content', 1, MESSAGE_PREVIEW_LENGTH)).values('preview')[:1]
+            ),
+            last_message_sender_id=Subquery(latest.values('sender_id')[:1]),
+            last_message_sender_username=Subquery(latest.values('sender__username')[:1]),
+            last_message_created_at=Subquery(latest.values('created_at')[:1]),
+        )
+
+    def with_unread(self, user):
+        """
+        Annotate ``unread_count`` for ``user`` from the denormalized ``message_count``
+        and the user's ``ReadState``, without reading the message table.
+        """
+        read_count = ReadState.objects.filter(group=OuterRef('pk'), user=user).values('read_count')[:1]
+        return self.annotate(
+            unread_count=Greatest(F('message_count') - Coalesce(Subquery(read_count), 0), 0)
+        )
+
+    def add_messages(self, counts):
+        """
+        Add ``{group_id: n}`` new messages to ``message_count``. Groups are updated
+        in id order so concurrent writers lock their rows in the same order.
+        """
+        for group_id, count in sorted(counts.items()):
+            self.filter(id=group_id).update(message_count=F('message_count') + count)
+
+    def recount_messages(self):
+        """
+        Recompute ``message_count`` from the message table for every group in the
+        queryset. Archived messages are not in the table, see ``recount_group_messages``.
+        """
+        messages = Message.objects.filter(
+            group=OuterRef('pk')
+        ).order_by().values('group').annotate(count=Count('*')).values('count')
+        return self.update(message_count=Coalesce(Subquery(messages), 0))
+
+    def recount_members(self):
+        """Recompute ``member_count`` from the membership table for every group in the queryset."""
+        memberships = self.model.members.through.objects.filter(
+            group=OuterRef('pk')
+        ).order_by().values('group').annotate(count=Count('*')).values('count')
+        return self.update(member_count=Coalesce(Subquery(memberships), 0))
+
 class Group(models.Model):
     """Model for user groups with chat capabilities."""
     name = models.CharField(max_length=200)
@@ -19,21 +110,70 @@ class Group(models.Model):
     description = models.TextField()
     avatar = models.ImageField(
         upload_to='group_avatars/',
+        storage=content_addressed_storage,
         null=True,
         blank=True
     )
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     public = models.BooleanField(default=False)
+    # Denormalized count of members, kept in step with the membership table by groups.signals
+    member_count = models.PositiveIntegerField(default=0, editable=False)
+    # Denormalized count of messages, bumped in the transaction that inserts them
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    # Drawn on insert and on every UPDATE (by a trigger, see migrations 0011 and 0014) for the sync API
+    change_seq = models.BigIntegerField(db_default=ClaimChangeSeq(), editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Weighted full-text document, stored by PostgreSQL and kept in sync on every write
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('goal', weight='B', config=SEARCH_CONFIG)
+            + SearchVector('description', weight='C', config=SEARCH_CONFIG)
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = GroupQuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            GinIndex(fields=['search_vector'], name='groups_group_search_idx'),
+            GinIndex(fields=['name'], name='groups_group_name_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['goal'], name='groups_group_goal_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['description'], name='groups_group_desc_trgm_idx', opclasses=['gin_trgm_ops']),
+            # Biggest public groups, read backwards
+            models.Index(fields=['public', 'member_count', 'id'], name='groups_public_members_idx'),
+            # Keyset pagination of the group list, newest first
+            models.Index(fields=['created_at', 'id'], name='groups_group_created_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # The counters only change through atomic UPDATEs and change_seq is set by
+        # the database, never write back a possibly stale copy of them
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and not field.generated
+                and field.name not in ('member_count', 'message_count', 'change_seq')
+                and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
 class Message(models.Model):
-    """Model for group chat messages."""
+    """
+    Model for group chat messages.
+
+    The table is partitioned by month on ``created_at`` (migration 0013, see
+    ``groups.partitions``); its primary key in PostgreSQL is ``(id, created_at)``.
+    """
     group = models.ForeignKey(
         Group,
         on_delete=models.CASCADE,
@@ -45,10 +185,110 @@ class Message(models.Model):
         related_name='sent_messages'
     )
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: the chat sink stamps messages before they are written
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    # Drawn when the row is inserted, so write-behind messages sort by when they became visible
+    change_seq = models.BigIntegerField(db_default=ClaimChangeSeq(), editable=False)
+    search_vector = models.GeneratedField(
+        expression=SearchVector('content', config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['group', 'created_at', 'id'], name='groups_msg_group_created_idx'),
+            GinIndex(fields=['search_vector'], name='groups_msg_search_idx'),
+            models.Index(fields=['group', 'change_seq'], name='groups_msg_group_change_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
+
+class MessageArchive(models.Model):
+    """A message partition exported to a file and detached from ``groups_message``."""
+    FORMAT_NDJSON = 'ndjson'
+    FORMAT_PARQUET = 'parquet'
+    FORMAT_CHOICES = [
+        (FORMAT_NDJSON, 'Gzipped NDJSON'),
+        (FORMAT_PARQUET, 'Parquet'),
+    ]
+
+    partition = models.CharField(max_length=63, unique=True)
+    # Null for the partition that starts at MINVALUE
+    range_start = models.DateTimeField(null=True, blank=True)
+    range_end = models.DateTimeField()
+    path = models.CharField(max_length=500)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    row_count = models.PositiveBigIntegerField(default=0)
+    # {group_id: messages}, so message_count can be recounted without the rows
+    group_counts = models.JSONField(default=dict)
+    # {group_id: [byte offset, length]} of its gzip member, or [first row group, count] for Parquet
+    group_index = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-range_end']
+
+    def __str__(self):
+        return f"{self.partition} -> {self.path}"
+
+class MembershipChange(models.Model):
+    """
+    Append-only log of joins and leaves, written by groups.signals.
+
+    ``group_id`` is a plain column rather than a foreign key, and ``user`` has
+    no database constraint, so the leaves recorded when a group or a user is
+    deleted outlive them.
+    """
+    group_id = models.BigIntegerField()
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name='+'
+    )
+    joined = models.BooleanField()
+    change_seq = models.BigIntegerField(db_default=ClaimChangeSeq(), editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'change_seq'], name='groups_mchange_user_idx'),
+            models.Index(fields=['group_id', 'change_seq'], name='groups_mchange_group_idx'),
+        ]
+
+    def __str__(self):
+        return f"{'+' if self.joined else '-'}{self.user_id} @ {self.group_id}"
+
+class ReadState(models.Model):
+    """
+    How far a user has read a group.
+
+    ``read_count`` is the group's ``message_count`` up to and including
+    ``last_read_message_id``, so the unread count is the difference of two
+    counters and never needs a scan of the messages.
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='read_states'
+    )
+    group = models.ForeignKey(
+        Group,
+        on_delete=models.CASCADE,
+        related_name='read_states'
+    )
+    # Not a foreign key: the message may have moved to an archive
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+    read_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'group'], name='groups_readstate_user_group_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.group_id} up to {self.last_read_message_id}"
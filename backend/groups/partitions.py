@@ -0,0 +1,216 @@
+"""
+Monthly range partitions of ``groups_message``.
+
+Every month of messages lives in its own partition, ``groups_message_pYYYYMM``,
+covering ``[first of the month, first of the next month)`` in UTC. Rows
+older than the partitioning migration stay in ``groups_message_legacy``
+until ``split_legacy_partition`` moves them into monthly partitions, and
+rows past the last monthly partition fall into ``groups_message_default``.
+The write paths call ``roll_forward`` to keep partitions ahead of time, and
+``create_message_partitions`` does the same from cron; both move any rows
+out of the default partition.
+"""
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timezone as dt_timezone
+from typing import List, Optional
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = Message._meta.db_table
+DEFAULT_PARTITION = f'{PARENT_TABLE}_default'
+LEGACY_PARTITION = f'{PARENT_TABLE}_legacy'
+
+BOUND_RE = re.compile(r"FROM \((?P<start>.+?)\) TO \((?P<end>.+?)\)")
+
+
+@dataclass
+class Partition:
+    name: str
+    # None for MINVALUE
+    start: Optional[datetime]
+    end: Optional[datetime]
+    default: bool = False
+
+    def overlaps(self, start: datetime, end: datetime) -> bool:
+        if self.default:
+            return False
+        return (self.start is None or self.start < end) and (self.end is None or self.end > start)
+
+
+def month_start(value: datetime) -> datetime:
+    value = value.astimezone(dt_timezone.utc)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(start: datetime) -> str:
+    return f'{PARENT_TABLE}_p{start:%Y%m}'
+
+
+def _parse_bound(text: str) -> Optional[datetime]:
+    if text == 'MINVALUE' or text == 'MAXVALUE':
+        return None
+    value = text.strip("'")
+    # PostgreSQL prints whole-hour offsets as +00
+    if re.search(r'[+-]\d\d$', value):
+        value += ':00'
+    return datetime.fromisoformat(value)
+
+
+def list_partitions() -> List[Partition]:
+    """The partitions attached to ``groups_message``, oldest first, the default one last."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+            """,
+            [PARENT_TABLE],
+        )
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        if bound == 'DEFAULT':
+            partitions.append(Partition(name, None, None, default=True))
+            continue
+        match = BOUND_RE.search(bound)
+        partitions.append(Partition(name, _parse_bound(match['start']), _parse_bound(match['end'])))
+    far_past = datetime.min.replace(tzinfo=dt_timezone.utc)
+    return sorted(partitions, key=lambda p: (p.default, p.start or far_past))
+
+
+def create_partition(start: datetime, end: datetime, source: str = DEFAULT_PARTITION) -> str:
+    """
+    Create and attach the partition for ``[start, end)``, moving over any rows
+    of that range from ``source``, by default the default partition.
+    """
+    name = partition_name(start)
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(field.column) for field in Message._meta.concrete_fields if not field.generated)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {qn(name)} (LIKE {qn(PARENT_TABLE)} INCLUDING DEFAULTS INCLUDING GENERATED)")
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {qn(source)} WHERE created_at >= %s AND created_at < %s
+                RETURNING {columns}
+            )
+            INSERT INTO {qn(name)} ({columns}) SELECT {columns} FROM moved
+            """,
+            [start, end],
+        )
+        cursor.execute(f"ALTER TABLE {qn(PARENT_TABLE)} ATTACH PARTITION {qn(name)} FOR VALUES FROM (%s) TO (%s)", [start, end])
+    return name
+
+
+def ensure_partitions(months_ahead: int) -> List[str]:
+    """Create the partitions of the current month and the next ``months_ahead`` months that are missing."""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Concurrent callers would race to create the same tables. Keyed by the
+            # table name, apart from the change floors groups.sync reads.
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s), 0)", [PARENT_TABLE])
+        existing = list_partitions()
+        first = month_start(timezone.now())
+        created = []
+        for offset in range(months_ahead + 1):
+            start = add_months(first, offset)
+            end = add_months(start, 1)
+            if not any(partition.overlaps(start, end) for partition in existing):
+                created.append(create_partition(start, end))
+    return created
+
+
+_checked_month = None
+
+
+def roll_forward() -> None:
+    """
+    Keep ``PARTITIONS_AHEAD`` monthly partitions ahead of the clock.
+
+    Cheap enough for every write: the catalog is only read the first time
+    this process writes in a new month. Failing to create partitions is
+    logged, not raised; rows then land in the default partition until the
+    next attempt moves them out.
+    """
+    global _checked_month
+    current = month_start(timezone.now())
+    if _checked_month == current:
+        return
+    try:
+        ensure_partitions(settings.MESSAGE_ARCHIVE['PARTITIONS_AHEAD'])
+    except DatabaseError:
+        logger.exception("Failed to create message partitions ahead of time")
+        return
+    _checked_month = current
+
+
+def split_legacy_partition(until: Optional[datetime] = None) -> List[str]:
+    """
+    Move the rows of ``groups_message_legacy`` into monthly partitions, oldest
+    month first, stopping at the month that starts at ``until`` (if given).
+
+    The legacy partition spans everything before the partitioning migration,
+    so it could never fall out of the retention window as a whole. Each month
+    is moved in its own transaction that detaches the legacy partition, copies
+    the month's rows and attaches both again with narrower bounds; messages
+    are locked while one month is copied. Once empty, the legacy partition is
+    dropped.
+    """
+    qn = connection.ops.quote_name
+    created = []
+    while True:
+        legacy = next((p for p in list_partitions() if p.name == LEGACY_PARTITION), None)
+        if legacy is None:
+            return created
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT min(created_at) FROM {qn(LEGACY_PARTITION)}")
+            oldest = cursor.fetchone()[0]
+        start = month_start(oldest) if oldest is not None else None
+        if start is not None and until is not None and start >= until:
+            return created
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            detach_partition(LEGACY_PARTITION)
+            if start is None:
+                drop_table(LEGACY_PARTITION)
+                return created
+            end = add_months(start, 1)
+            created.append(create_partition(start, end, source=LEGACY_PARTITION))
+            if end < legacy.end:
+                # Rows before start are gone, so the lower bound can follow them
+                cursor.execute(
+                    f"ALTER TABLE {qn(PARENT_TABLE)} ATTACH PARTITION {qn(LEGACY_PARTITION)} FOR VALUES FROM (%s) TO (%s)",
+                    [end, legacy.end],
+                )
+            else:
+                drop_table(LEGACY_PARTITION)
+
+
+def lock_partition(name: str) -> None:
+    """Block writes to partition ``name`` until the current transaction ends; reads go on."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {connection.ops.quote_name(name)} IN SHARE MODE")
+
+
+def detach_partition(name: str) -> None:
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {qn(PARENT_TABLE)} DETACH PARTITION {qn(name)}")
+
+
+def drop_table(name: str) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
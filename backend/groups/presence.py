@@ -0,0 +1,285 @@
+"""
+Who is online in each group.
+
+Every socket is a presence entry ``<user_id>:<channel_name>`` with an expiry
+time, refreshed on join and on every frame the client sends (clients send a
+``heartbeat`` frame when idle). Entries that stop being refreshed expire
+after ``TTL`` seconds, so a crashed worker's sockets disappear on their own.
+
+Entries live in one Redis sorted set per group (score = expiry), or in
+process memory for tests and benchmarks. Consumers do not write to the store
+or broadcast per event: each worker's ``PresenceTracker`` batches joins,
+leaves and heartbeats and, once per ``INTERVAL``, writes them in one round
+trip and broadcasts a single ``joined``/``left`` diff per changed group. A
+reconnect within the interval produces no broadcast at all, and hundreds of
+members reconnecting together produce one message per group.
+
+Many workers see changes to the same group, but only one broadcasts them:
+each interval a worker must ``claim`` a group (``SET NX`` with the interval
+as expiry) before broadcasting, and diffs against the online set of the
+last broadcast kept in the store rather than its own view. Workers that
+lose the claim keep the group pending and try again the next interval, when
+the diff is empty unless something changed after the winner looked.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, Iterable, Set
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from core.codec import codec
+
+logger = logging.getLogger(__name__)
+
+
+def _user_id(member) -> int:
+    if isinstance(member, bytes):
+        member = member.decode()
+    return int(member.split(':', 1)[0])
+
+
+class MemoryPresenceStore:
+    """Process-local presence store; only suitable for a single worker."""
+
+    def __init__(self):
+        self._entries = defaultdict(dict)  # group_id -> {member: expires_at}
+        self._broadcast = {}               # group_id -> user ids in the last broadcast
+        self._lock = threading.Lock()
+
+    def update(self, touches: Dict[int, Set[str]], removals: Dict[int, Set[str]], expires_at: float) -> None:
+        with self._lock:
+            for group_id, members in touches.items():
+                for member in members:
+                    self._entries[group_id][member] = expires_at
+            for group_id, members in removals.items():
+                for member in members:
+                    self._entries[group_id].pop(member, None)
+
+    def online(self, group_ids: Iterable[int]) -> Dict[int, Set[int]]:
+        now = time.time()
+        result = {}
+        with self._lock:
+            for group_id in group_ids:
+                entries = self._entries.get(group_id, {})
+                for member in [member for member, expires_at in entries.items() if expires_at <= now]:
+                    del entries[member]
+                result[group_id] = {_user_id(member) for member in entries}
+        return result
+
+    def claim(self, group_ids: Iterable[int], window: float) -> Set[int]:
+        # The only worker, so always the broadcaster
+        return set(group_ids)
+
+    def last_broadcast(self, group_ids: Iterable[int]) -> Dict[int, Set[int]]:
+        with self._lock:
+            return {group_id: self._broadcast.get(group_id, set()) for group_id in group_ids}
+
+    def record_broadcast(self, online: Dict[int, Set[int]]) -> None:
+        with self._lock:
+            for group_id, user_ids in online.items():
+                if user_ids:
+                    self._broadcast[group_id] = user_ids
+                else:
+                    self._broadcast.pop(group_id, None)
+
+
+class RedisPresenceStore:
+    """Sorted set per group, scored by expiry time; every call is a single pipelined round trip."""
+
+    key_prefix = 'presence:v1'
+    # The last broadcast outlives quiet periods, or the next diff would list everyone as joined
+    broadcast_ttl = 86400
+
+    def __init__(self, url: str, ttl: float):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+
+    def _key(self, group_id) -> str:
+        return f'{self.key_prefix}:{group_id}'
+
+    def update(self, touches: Dict[int, Set[str]], removals: Dict[int, Set[str]], expires_at: float) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        for group_id, members in touches.items():
+            pipe.zadd(self._key(group_id), {member: expires_at for member in members})
+            # Drop the whole set if every worker of this group went away
+            pipe.expire(self._key(group_id), int(self.ttl * 2) + 1)
+        for group_id, members in removals.items():
+            pipe.zrem(self._key(group_id), *members)
+        pipe.execute()
+
+    def online(self, group_ids: Iterable[int]) -> Dict[int, Set[int]]:
+        group_ids = list(group_ids)
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for group_id in group_ids:
+            pipe.zremrangebyscore(self._key(group_id), '-inf', now)
+            pipe.zrange(self._key(group_id), 0, -1)
+        results = pipe.execute()
+        return {
+            group_id: {_user_id(member) for member in members}
+            for group_id, members in zip(group_ids, results[1::2])
+        }
+
+    def claim(self, group_ids: Iterable[int], window: float) -> Set[int]:
+        """Return the groups this worker broadcasts for the next ``window`` seconds."""
+        group_ids = list(group_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for group_id in group_ids:
+            pipe.set(f'{self._key(group_id)}:broadcaster', self.token, nx=True, px=max(1, int(window * 1000)))
+        return {group_id for group_id, claimed in zip(group_ids, pipe.execute()) if claimed}
+
+    def last_broadcast(self, group_ids: Iterable[int]) -> Dict[int, Set[int]]:
+        group_ids = list(group_ids)
+        if not group_ids:
+            return {}
+        values = self.client.mget([f'{self._key(group_id)}:broadcast' for group_id in group_ids])
+        return {
+            group_id: set(json.loads(value)) if value else set()
+            for group_id, value in zip(group_ids, values)
+        }
+
+    def record_broadcast(self, online: Dict[int, Set[int]]) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        for group_id, user_ids in online.items():
+            key = f'{self._key(group_id)}:broadcast'
+            if user_ids:
+                pipe.set(key, json.dumps(sorted(user_ids)), ex=self.broadcast_ttl)
+            else:
+                pipe.delete(key)
+        pipe.execute()
+
+
+def build_store():
+    config = settings.PRESENCE
+    if config['BACKEND'] == 'memory':
+        return MemoryPresenceStore()
+    return RedisPresenceStore(config['REDIS_URL'], config['TTL'])
+
+
+presence_store = build_store()
+
+
+class PresenceTracker:
+    """Batches one worker's presence changes and broadcasts coalesced diffs."""
+
+    def __init__(self, store, interval: float = 1.0, ttl: float = 30.0):
+        self.store = store
+        self.interval = interval
+        self.ttl = ttl
+        self._sockets = defaultdict(set)    # group_id -> members connected to this worker
+        self._touches = defaultdict(set)    # group_id -> members to refresh
+        self._removals = defaultdict(set)   # group_id -> members that left
+        self._changed = set()               # groups whose online set may have changed
+        self._last_sweep = time.monotonic()
+        self._task = None
+        self._loop = None
+
+    @staticmethod
+    def member(user_id: int, channel_name: str) -> str:
+        return f'{user_id}:{channel_name}'
+
+    def join(self, group_id: int, user_id: int, channel_name: str) -> None:
+        member = self.member(user_id, channel_name)
+        self._sockets[group_id].add(member)
+        self._removals[group_id].discard(member)
+        self._touches[group_id].add(member)
+        self._changed.add(group_id)
+        self._schedule()
+
+    def heartbeat(self, group_id: int, user_id: int, channel_name: str) -> None:
+        member = self.member(user_id, channel_name)
+        if member in self._sockets.get(group_id, ()):
+            self._touches[group_id].add(member)
+            self._schedule()
+
+    def leave(self, group_id: int, user_id: int, channel_name: str) -> None:
+        member = self.member(user_id, channel_name)
+        sockets = self._sockets.get(group_id)
+        if sockets is not None:
+            sockets.discard(member)
+            if not sockets:
+                del self._sockets[group_id]
+        self._touches[group_id].discard(member)
+        self._removals[group_id].add(member)
+        self._changed.add(group_id)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        # Keep ticking while this worker has sockets, so expired entries are noticed too
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+            if not self._sockets and not self._changed:
+                return
+
+    async def flush(self) -> None:
+        touches = {group_id: members for group_id, members in self._touches.items() if members}
+        removals = {group_id: members for group_id, members in self._removals.items() if members}
+        changed = self._changed
+        self._touches, self._removals, self._changed = defaultdict(set), defaultdict(set), set()
+
+        # Periodically re-read every local group to notice sockets that expired elsewhere
+        if time.monotonic() - self._last_sweep >= self.ttl:
+            self._last_sweep = time.monotonic()
+            changed = changed | set(self._sockets)
+
+        if touches or removals:
+            await sync_to_async(self.store.update, thread_sensitive=False)(touches, removals, time.time() + self.ttl)
+        if not changed:
+            return
+        claimed = await sync_to_async(self.store.claim, thread_sensitive=False)(changed, self.interval)
+        # Another worker broadcasts these this interval; look again next time in case it read too early
+        self._changed |= changed - claimed
+        if not claimed:
+            return
+        online = await sync_to_async(self.store.online, thread_sensitive=False)(claimed)
+        previous = await sync_to_async(self.store.last_broadcast, thread_sensitive=False)(claimed)
+        await sync_to_async(self.store.record_broadcast, thread_sensitive=False)(online)
+
+        channel_layer = get_channel_layer()
+        for group_id, user_ids in online.items():
+            joined, left = user_ids - previous[group_id], previous[group_id] - user_ids
+            if not joined and not left:
+                continue
+            await channel_layer.group_send(f'chat_{group_id}', {
+                'type': 'chat.broadcast',
+                'text': codec.dumps({
+                    'type': 'presence',
+                    'group_id': group_id,
+                    'joined': sorted(joined),
+                    'left': sorted(left),
+                    'online': len(user_ids),
+                }),
+            })
+
+
+_tracker = None
+
+
+def get_presence_tracker() -> PresenceTracker:
+    """Return the tracker for the running event loop, creating it on first use."""
+    global _tracker
+    loop = asyncio.get_running_loop()
+    if _tracker is None or _tracker._loop is not loop:
+        _tracker = PresenceTracker(
+            presence_store,
+            interval=settings.PRESENCE['INTERVAL'],
+            ttl=settings.PRESENCE['TTL'],
+        )
+        _tracker._loop = loop
+    return _tracker
@@ -0,0 +1,376 @@
+"""
+The last few messages of every active group, ready to send.
+
+Opening a chat almost always asks for the newest page, so each group keeps a
+bounded buffer of its latest ``SIZE`` serialized messages: a Redis sorted set
+shared by all workers, with a short-lived in-process LRU in front of it.
+Buffered messages carry only their ``sender_id``; senders are filled in on
+read from a shared cache whose entries are tagged with the user's principal
+version, so a profile change shows in the next read of any worker (after at
+most ``LOCAL_TTL`` seconds where the page itself is cached in process). The
+chat consumers and ``create_message`` append to it; the first page of
+``list_messages`` and the WebSocket backfill are served from it. A cold group
+is primed from PostgreSQL on first read.
+
+Appends land in the buffer even while it is cold, and priming merges them
+with the rows read from the database: a message still waiting in some
+worker's write-behind sink is already in the buffer, so the primed page
+includes it. Entries are kept ordered by ``(created_at, id)`` and trimming
+drops the oldest by that order, whatever order the workers appended in.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from core.codec import codec
+from core.pagination import MAX_PAGE_SIZE, KeysetPage, encode_cursor
+from core.principals import principal_cache
+from core.schemas import UserOut
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+
+def sender_json(user) -> dict:
+    return UserOut.from_orm(user).model_dump(mode='json')
+
+
+def serialize(message: Message) -> dict:
+    """A buffered message; ``with_sender`` turns it into a ``MessageOut``-shaped dict."""
+    return {
+        'id': message.id,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+        'sender_id': message.sender_id,
+    }
+
+
+def with_sender(item: dict, sender: dict) -> dict:
+    hydrated = {key: value for key, value in item.items() if key != 'sender_id'}
+    hydrated['sender'] = sender
+    return hydrated
+
+
+def _timeline_key(item: dict):
+    return datetime.fromisoformat(item['created_at']), item['id']
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def position(item: dict) -> Tuple[int, int]:
+    """``(created_at in microseconds, id)``, the order the stores keep entries in."""
+    created_at = datetime.fromisoformat(item['created_at'])
+    return (created_at - EPOCH) // timedelta(microseconds=1), item['id']
+
+
+class MemoryRecentStore:
+    """Process-local store for tests and benchmarks."""
+
+    def __init__(self):
+        self._lists = defaultdict(dict)  # group_id -> {position: encoded}
+        self._meta = {}
+        self._lock = threading.Lock()
+
+    def _trim(self, group_id: int, size: int) -> bool:
+        """Drop the oldest entries beyond ``size``; return whether any were dropped."""
+        entries = self._lists[group_id]
+        excess = sorted(entries)[:-size]
+        for key in excess:
+            del entries[key]
+        return bool(excess)
+
+    def append(self, group_id: int, encoded: str, position: Tuple[int, int], size: int, ttl: int) -> None:
+        with self._lock:
+            self._lists[group_id][position] = encoded
+            if self._trim(group_id, size) and group_id in self._meta:
+                self._meta[group_id] = False
+
+    def read(self, group_id: int) -> Optional[Tuple[List[str], bool]]:
+        with self._lock:
+            if group_id not in self._meta:
+                return None
+            entries = self._lists[group_id]
+            return [entries[key] for key in sorted(entries)], self._meta[group_id]
+
+    def prime(self, group_id: int, entries: List[Tuple[Tuple[int, int], str]], complete: bool, size: int, ttl: int) -> Tuple[List[str], bool]:
+        with self._lock:
+            merged = self._lists[group_id]
+            merged.update(entries)
+            if self._trim(group_id, size):
+                complete = False
+            self._meta[group_id] = complete
+            return [merged[key] for key in sorted(merged)], complete
+
+
+class RedisRecentStore:
+    """
+    A capped sorted set per group plus a marker saying it was primed and whether
+    it holds the whole history.
+
+    Scores are ``created_at`` in microseconds, exact in a double until 2255.
+    Members are the encoded message prefixed with its zero-padded id, so
+    messages created in the same microsecond sort by id.
+    """
+
+    key_prefix = 'recent:v3'
+
+    # Cold sets take appends too, priming merges them; only the marker makes a set readable
+    APPEND_SCRIPT = """
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+    local trimmed = redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        if trimmed > 0 then
+            redis.call('SET', KEYS[2], 'partial', 'EX', ARGV[4])
+        else
+            redis.call('EXPIRE', KEYS[2], ARGV[4])
+        end
+    end
+    """
+
+    # Merge the rows read from the database with whatever was appended meanwhile
+    PRIME_SCRIPT = """
+    local complete = ARGV[1] == '1'
+    local size = tonumber(ARGV[2])
+    for i = 4, #ARGV, 2 do
+        redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    local excess = redis.call('ZCARD', KEYS[1]) - size
+    if excess > 0 then
+        redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+        complete = false
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('SET', KEYS[2], complete and 'complete' or 'partial', 'EX', ARGV[3])
+    return {complete and 1 or 0, redis.call('ZRANGE', KEYS[1], 0, -1)}
+    """
+
+    def __init__(self, url: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self._append = self.client.register_script(self.APPEND_SCRIPT)
+        self._prime = self.client.register_script(self.PRIME_SCRIPT)
+
+    def _keys(self, group_id):
+        return f'{self.key_prefix}:{group_id}', f'{self.key_prefix}:{group_id}:meta'
+
+    @staticmethod
+    def _member(position: Tuple[int, int], encoded: str) -> str:
+        return f'{position[1]:020d}:{encoded}'
+
+    @staticmethod
+    def _encoded(member: bytes) -> bytes:
+        return member.split(b':', 1)[1]
+
+    def append(self, group_id: int, encoded: str, position: Tuple[int, int], size: int, ttl: int) -> None:
+        self._append(keys=self._keys(group_id), args=[position[0], self._member(position, encoded), size, ttl])
+
+    def read(self, group_id: int) -> Optional[Tuple[List[str], bool]]:
+        items_key, meta_key = self._keys(group_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(meta_key)
+        pipe.zrange(items_key, 0, -1)
+        meta, members = pipe.execute()
+        if meta is None:
+            return None
+        return [self._encoded(member) for member in members], meta == b'complete'
+
+    def prime(self, group_id: int, entries: List[Tuple[Tuple[int, int], str]], complete: bool, size: int, ttl: int) -> Tuple[List[str], bool]:
+        args = ['1' if complete else '0', size, ttl]
+        for position, encoded in entries:
+            args += [position[0], self._member(position, encoded)]
+        complete, members = self._prime(keys=self._keys(group_id), args=args)
+        return [self._encoded(member) for member in members], bool(complete)
+
+
+class RecentMessages:
+    sender_key_prefix = 'recent:sender:v1'
+
+    def __init__(self, store, size=50, ttl=3600, local_groups=1000, local_ttl=2.0):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self.local_groups = local_groups
+        self.local_ttl = local_ttl
+        self._local = OrderedDict()  # group_id -> (items, complete, expires_at)
+        self._lock = threading.Lock()
+
+    def _get_local(self, group_id):
+        with self._lock:
+            entry = self._local.get(group_id)
+            if entry is None:
+                return None
+            items, complete, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._local[group_id]
+                return None
+            self._local.move_to_end(group_id)
+            return list(items), complete
+
+    def _set_local(self, group_id, items, complete):
+        with self._lock:
+            self._local[group_id] = (items, complete, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(group_id)
+            while len(self._local) > self.local_groups:
+                self._local.popitem(last=False)
+
+    def _append_local(self, group_id, item):
+        with self._lock:
+            entry = self._local.get(group_id)
+            if entry is not None:
+                items, complete, expires_at = entry
+                items = sorted(items + [item], key=_timeline_key)
+                # Trimmed messages are no longer in the buffer, so it stops being the whole history
+                complete = complete and len(items) <= self.size
+                self._local[group_id] = (items[-self.size:], complete, expires_at)
+
+    def append(self, group_id: int, item: dict, sender: dict) -> None:
+        self._append_local(group_id, with_sender(item, sender))
+        try:
+            self.store.append(group_id, codec.dumps(item), position(item), self.size, self.ttl)
+        except Exception:
+            logger.exception(f"Failed to append to the recent messages of group {group_id}")
+
+    async def aappend(self, group_id: int, item: dict, sender: dict) -> None:
+        self._append_local(group_id, with_sender(item, sender))
+        try:
+            await sync_to_async(self.store.append, thread_sensitive=False)(
+                group_id, codec.dumps(item), position(item), self.size, self.ttl
+            )
+        except Exception:
+            logger.exception(f"Failed to append to the recent messages of group {group_id}")
+
+    def latest(self, group_id: int) -> Tuple[List[dict], bool]:
+        """
+        Return the buffered messages, oldest first, and whether they are the group's
+        whole history. Loads and primes the buffer from the database when cold.
+        """
+        group_id = int(group_id)
+        local = self._get_local(group_id)
+        if local is not None:
+            return local
+
+        try:
+            stored = self.store.read(group_id)
+        except Exception:
+            logger.exception("Recent messages store unavailable, reading from the database")
+            stored = None
+        if stored is None:
+            rows = list(
+                Message.objects.filter(group_id=group_id).only('id', 'content', 'created_at', 'sender_id')
+                .order_by('-created_at', '-id')[:self.size]
+            )
+            rows.reverse()
+            complete = len(rows) < self.size
+            fetched = [serialize(row) for row in rows]
+            try:
+                # Comes back merged with messages appended but not written yet
+                stored = self.store.prime(
+                    group_id, [(position(item), codec.dumps(item)) for item in fetched], complete, self.size, self.ttl
+                )
+            except Exception:
+                logger.exception(f"Failed to prime the recent messages of group {group_id}")
+                items = fetched
+        if stored is not None:
+            encoded, complete = stored
+            items = [codec.loads(raw) for raw in encoded]
+
+        # The stores keep the timeline order; one message may be in a cold buffer and the database
+        items = sorted({item['id']: item for item in items}.values(), key=_timeline_key)
+        senders = self._senders({item['sender_id'] for item in items})
+        # Messages of a user deleted since they were buffered are gone from the database too
+        items = [with_sender(item, senders[item['sender_id']]) for item in items if item['sender_id'] in senders]
+
+        self._set_local(group_id, items, complete)
+        return list(items), complete
+
+    def _sender_key(self, user_id: int) -> str:
+        return f'{self.sender_key_prefix}:{user_id}'
+
+    def _senders(self, user_ids) -> Dict[int, dict]:
+        """
+        ``UserOut`` dicts of ``user_ids``. Shared entries remember the principal
+        version they were loaded under and are ignored once it changes; misses
+        are loaded in one query. Users that no longer exist are left out.
+        """
+        if not user_ids:
+            return {}
+        # Read before the users, so a change committed in between retires what we store
+        versions = principal_cache.versions(user_ids)
+        senders = {}
+        if versions is not None:
+            try:
+                cached = principal_cache.shared.get_many([self._sender_key(user_id) for user_id in user_ids])
+            except Exception:
+                logger.warning("Shared cache unavailable, loading message senders", exc_info=True)
+                cached = {}
+            for user_id in user_ids:
+                entry = cached.get(self._sender_key(user_id))
+                if entry is not None and entry[0] == versions[user_id]:
+                    senders[user_id] = entry[1]
+
+        missing = [user_id for user_id in user_ids if user_id not in senders]
+        if missing:
+            loaded = {user.id: sender_json(user) for user in User.objects.filter(id__in=missing)}
+            senders.update(loaded)
+            if versions is not None and loaded:
+                try:
+                    principal_cache.shared.set_many(
+                        {self._sender_key(user_id): (versions[user_id], sender) for user_id, sender in loaded.items()},
+                        self.ttl,
+                    )
+                except Exception:
+                    logger.exception("Failed to cache message senders")
+        return senders
+
+    async def alatest(self, group_id: int) -> Tuple[List[dict], bool]:
+        """Async ``latest`` that answers local hits without leaving the event loop."""
+        local = self._get_local(int(group_id))
+        if local is not None:
+            return local
+        return await sync_to_async(self.latest)(group_id)
+
+    def page(self, group_id: int, limit: int) -> Optional[KeysetPage]:
+        """The newest ``limit`` messages as a ``list_messages`` page, or ``None`` if the buffer cannot tell."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        if limit > self.size:
+            return None
+        items, complete = self.latest(group_id)
+        if len(items) < limit and not complete:
+            return None
+        rows = items[-limit:]
+        page = KeysetPage(items=rows)
+        if rows:
+            if len(items) > limit or not complete:
+                page.older_cursor = encode_cursor(datetime.fromisoformat(rows[0]['created_at']), rows[0]['id'])
+            page.newer_cursor = encode_cursor(datetime.fromisoformat(rows[-1]['created_at']), rows[-1]['id'])
+        return page
+
+    def clear(self) -> None:
+        with self._lock:
+            self._local.clear()
+
+
+def build_store():
+    config = settings.RECENT_MESSAGES
+    if config['BACKEND'] == 'memory':
+        return MemoryRecentStore()
+    return RedisRecentStore(config['REDIS_URL'])
+
+
+recent_messages = RecentMessages(
+    build_store(),
+    size=settings.RECENT_MESSAGES['SIZE'],
+    ttl=settings.RECENT_MESSAGES['TTL'],
+    local_groups=settings.RECENT_MESSAGES['LOCAL_GROUPS'],
+    local_ttl=settings.RECENT_MESSAGES['LOCAL_TTL'],
+)
@@ -1,7 +1,10 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 from ninja import Schema
-from core.schemas import UserOut
+from pydantic import Field
+from core.pagination import CursorParams
+from core.schemas import ImageVariantOut, UserOut
+from .models import MESSAGE_PREVIEW_LENGTH
 
 class GroupBase(Schema):
     name: str
@@ -29,11 +32,136 @@ class MessageOut(MessageBase):
     sender: UserOut
     created_at: datetime
 
-class GroupOut(GroupBase):
+class MessageListParams(CursorParams):
+    # Continue into exported partitions once the database runs out of history
+    include_archived: bool = False
+
+class MessagePage(Schema):
+    items: List[MessageOut]
+    older_cursor: Optional[str] = None
+    newer_cursor: Optional[str] = None
+
+class MessageSearchParams(CursorParams):
+    q: str = Field(..., min_length=1, max_length=200)
+
+class MessageSearchHitOut(Schema):
     id: int
-    owner: UserOut
-    members: List[UserOut]
-    avatar: Optional[str]
+    group_id: int
+    sender_id: int
+    sender_username: str
+    snippet: str
+    created_at: datetime
+
+    @staticmethod
+    def resolve_sender_username(obj):
+        return obj.sender.username
+
+class MessageSearchPage(Schema):
+    items: List[MessageSearchHitOut]
+    older_cursor: Optional[str] = None
+    newer_cursor: Optional[str] = None
+
+class PresenceOut(Schema):
+    group_id: int
+    online: List[int]
+    count: int
+
+class MessagePreviewOut(Schema):
+    id: int
+    content: str
+    sender_id: int
+    sender_username: str
+    created_at: datetime
+
+class GroupSummaryOut(GroupBase):
+    """
+    Lightweight group representation for list endpoints.
+    Members and messages are served by `/{group_id}/members` and `/{group_id}/messages`.
+    """
+    id: int
+    owner_id: int
+    avatar: Optional[str] = None
+    avatar_variants: Dict[str, ImageVariantOut] = {}
+    member_count: int
+    # Only set where the list is of the user's own groups
+    unread_count: Optional[int] = None
+    last_message: Optional[MessagePreviewOut] = None
     created_at: datetime
     updated_at: datetime
-    messages: List[MessageOut]
+
+    @staticmethod
+    def resolve_last_message(obj):
+        if not hasattr(obj, 'last_message_id'):
+            message = obj.messages.select_related('sender').order_by('-created_at', '-id').first()
+            if message is None:
+                return None
+            return {
+                'id': message.id,
+                'content': message.content[:MESSAGE_PREVIEW_LENGTH],
+                'sender_id': message.sender_id,
+                'sender_username': message.sender.username,
+                'created_at': message.created_at,
+            }
+        if obj.last_message_id is None:
+            return None
+        return {
+            'id': obj.last_message_id,
+            'content': obj.last_message_content,
+            'sender_id': obj.last_message_sender_id,
+            'sender_username': obj.last_message_sender_username,
+            'created_at': obj.last_message_created_at,
+        }
+
+class GroupListItemOut(GroupSummaryOut):
+    is_member: bool
+
+class GroupPage(Schema):
+    items: List[GroupListItemOut]
+    older_cursor: Optional[str] = None
+    newer_cursor: Optional[str] = None
+
+class GroupOut(GroupSummaryOut):
+    owner: UserOut
+
+class ReadIn(Schema):
+    # Defaults to the group's latest message
+    message_id: Optional[int] = None
+
+class ReadStateOut(Schema):
+    group_id: int
+    last_read_message_id: Optional[int] = None
+    unread_count: int
+
+class UnreadOut(Schema):
+    group_id: int
+    unread_count: int
+
+class SyncParams(Schema):
+    since: int = Field(0, ge=0)
+    limit: int = Field(500, ge=1, le=1000)
+
+class SyncMessageOut(Schema):
+    id: int
+    group_id: int
+    sender_id: int
+    content: str
+    created_at: datetime
+
+class MembershipChangeOut(Schema):
+    group_id: int
+    user_id: int
+    username: Optional[str] = None  # None once the user is deleted
+    joined: bool
+
+class SyncOut(Schema):
+    """
+    Everything that changed in the user's groups since a sync token.
+    Groups are listed when they changed or were joined; older messages of a
+    newly joined group are loaded from `/{group_id}/messages`.
+    """
+    token: int
+    has_more: bool
+    groups: List[GroupSummaryOut]
+    left_group_ids: List[int]
+    memberships: List[MembershipChangeOut]
+    messages: List[SyncMessageOut]
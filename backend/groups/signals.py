@@ -0,0 +1,126 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from .membership import membership_cache
+from .models import Group, MembershipChange
+from .trending import trending_groups
+
+@receiver(m2m_changed, sender=Group.members.through)
+def sync_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep member counts and cached member sets in step with membership changes,
+    from the API or the admin, and log them for the sync API. Runs inside the
+    transaction that changes the membership table, so the counts and the log
+    commit or roll back with it; cached member sets are dropped on commit.
+    """
+    memberships = Group.members.through.objects
+    if reverse:
+        # instance is a user; a clear() does not say which groups it left, and
+        # pk_set of a remove also lists groups the user was not a member of.
+        # The rows are locked so a concurrent remove cannot delete them first.
+        if action == 'pre_clear':
+            instance._cleared_group_ids = list(instance.joined_groups.values_list('id', flat=True))
+            return
+        if action == 'pre_remove':
+            instance._removed_group_ids = list(
+                memberships.select_for_update().filter(user_id=instance.pk, group_id__in=pk_set).values_list('group_id', flat=True)
+            )
+            return
+        if action == 'post_clear':
+            group_ids = getattr(instance, '_cleared_group_ids', [])
+        elif action == 'post_remove':
+            group_ids = getattr(instance, '_removed_group_ids', [])
+        elif action == 'post_add':
+            group_ids = list(pk_set or [])
+        else:
+            return
+        per_group = 1
+        changes = [(group_id, instance.pk) for group_id in group_ids]
+    else:
+        if action == 'pre_clear':
+            instance._cleared_user_ids = list(instance.members.values_list('id', flat=True))
+            return
+        if action == 'pre_remove':
+            instance._removed_user_ids = list(
+                memberships.select_for_update().filter(group_id=instance.pk, user_id__in=pk_set).values_list('user_id', flat=True)
+            )
+            return
+        if action == 'post_clear':
+            user_ids = getattr(instance, '_cleared_user_ids', [])
+        elif action == 'post_remove':
+            user_ids = getattr(instance, '_removed_user_ids', [])
+        elif action == 'post_add':
+            user_ids = list(pk_set or [])
+        else:
+            return
+        group_ids = [instance.pk]
+        per_group = len(user_ids)
+        changes = [(instance.pk, user_id) for user_id in user_ids]
+    if not group_ids or not changes:
+        return
+
+    MembershipChange.objects.bulk_create(
+        MembershipChange(group_id=group_id, user_id=user_id, joined=action == 'post_add')
+        for group_id, user_id in changes
+    )
+
+    groups = Group.objects.filter(id__in=group_ids)
+    if action == 'post_add':
+        # pk_set only holds rows that were actually inserted
+        groups.update(member_count=F('member_count') + per_group)
+    elif action == 'post_remove':
+        # Only the rows locked in pre_remove were deleted
+        groups.update(member_count=F('member_count') - per_group)
+    else:
+        groups.recount_members()
+
+    def invalidate_members():
+        for group_id in group_ids:
+            membership_cache.invalidate(group_id)
+
+    # Invalidating before commit would let a concurrent read cache the old members again
+    transaction.on_commit(invalidate_members)
+    transaction.on_commit(lambda: trending_groups.refresh(group_ids))
+
+@receiver(post_save, sender=Group)
+def refresh_trending_on_save(sender, instance, **kwargs):
+    # Creation and public/private switches change who may appear in the ranking
+    group_id = instance.pk
+    transaction.on_commit(lambda: trending_groups.refresh([group_id]))
+
+@receiver(pre_delete, sender=Group)
+def log_members_leaving_deleted_group(sender, instance, **kwargs):
+    # The membership rows go with the group without an m2m_changed signal
+    MembershipChange.objects.bulk_create(
+        MembershipChange(group_id=instance.pk, user_id=user_id, joined=False)
+        for user_id in instance.members.values_list('id', flat=True)
+    )
+
+@receiver(pre_delete, sender=get_user_model())
+def leave_groups_of_deleted_user(sender, instance, **kwargs):
+    # The membership rows go with the user without an m2m_changed signal
+    user_id = instance.pk
+    group_ids = sorted(
+        Group.members.through.objects.select_for_update().filter(user_id=user_id).values_list('group_id', flat=True)
+    )
+    if not group_ids:
+        return
+    MembershipChange.objects.bulk_create(
+        MembershipChange(group_id=group_id, user_id=user_id, joined=False) for group_id in group_ids
+    )
+    Group.objects.filter(id__in=group_ids).update(member_count=F('member_count') - 1)
+
+    def invalidate_members():
+        for group_id in group_ids:
+            membership_cache.invalidate(group_id)
+
+    transaction.on_commit(invalidate_members)
+    transaction.on_commit(lambda: trending_groups.refresh(group_ids))
+
+@receiver(post_delete, sender=Group)
+def invalidate_membership_on_delete(sender, instance, **kwargs):
+    group_id = instance.pk
+    transaction.on_commit(lambda: membership_cache.invalidate(group_id))
+    transaction.on_commit(lambda: trending_groups.refresh([group_id]))
@@ -0,0 +1,335 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+from .models import Group, Message
+from .partitions import roll_forward
+
+logger = logging.getLogger(__name__)
+
+
+def reserve_message_ids(count: int) -> List[int]:
+    """Reserve ``count`` ids from the message sequence in a single round trip."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [Message._meta.db_table, count],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+# Errors caused by a row itself; psycopg2 raises ValueError for NUL characters
+REJECTED_ROW_ERRORS = (IntegrityError, DataError, ValueError)
+
+
+def write_messages(messages: List[Message]) -> int:
+    """
+    Insert a batch of messages whose ids were assigned up front, and count
+    them into ``Group.message_count`` in the same transaction.
+
+    Inserting the same message twice is a no-op, which makes retries and
+    spool replays idempotent; only the rows actually inserted are counted.
+    If a row is rejected (e.g. its group was deleted in the meantime, or its
+    content cannot be stored) the rows are retried one by one and only the
+    offending ones are dropped, so one bad row cannot hold up the rest.
+    Connection and other operational errors are raised for the caller to retry.
+    Returns the number of rows inserted.
+    """
+    roll_forward()
+    try:
+        with transaction.atomic():
+            return _insert_new(messages)
+    except REJECTED_ROW_ERRORS:
+        inserted = 0
+        for message in messages:
+            try:
+                with transaction.atomic():
+                    inserted += _insert_new([message])
+            except REJECTED_ROW_ERRORS as e:
+                logger.warning(f"Dropping message {message.id} for group {message.group_id}: {e}")
+        return inserted
+
+
+# change_seq is left to its database default
+INSERT_COLUMNS = ('id', 'group_id', 'sender_id', 'content', 'created_at')
+
+
+def _insert_new(messages: List[Message]) -> int:
+    if not messages:
+        return 0
+    qn = connection.ops.quote_name
+    row = f"({', '.join(['%s'] * len(INSERT_COLUMNS))})"
+    params = []
+    for message in messages:
+        params.extend(getattr(message, column) for column in INSERT_COLUMNS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {qn(Message._meta.db_table)} ({', '.join(qn(column) for column in INSERT_COLUMNS)}) "
+            f"VALUES {', '.join([row] * len(messages))} "
+            "ON CONFLICT DO NOTHING RETURNING group_id",
+            params,
+        )
+        # Rows skipped as already stored are not returned, so they are not counted twice
+        inserted = [group_id for (group_id,) in cursor.fetchall()]
+    Group.objects.add_messages(Counter(inserted))
+    return len(inserted)
+
+
+def _to_record(message: Message) -> dict:
+    return {
+        'id': message.id,
+        'group_id': message.group_id,
+        'sender_id': message.sender_id,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def _from_record(record: dict) -> Message:
+    return Message(
+        id=record['id'],
+        group_id=record['group_id'],
+        sender_id=record['sender_id'],
+        content=record['content'],
+        created_at=datetime.fromisoformat(record['created_at']),
+    )
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MessageSpool:
+    """
+    Append-only NDJSON journal of messages that are not yet in PostgreSQL.
+
+    Each process writes its own segments, named ``messages-<pid>-<boot>-<n>``.
+    A segment is deleted only once every message in it has been committed,
+    so after a crash the leftover segments hold exactly what may be missing.
+    """
+
+    def __init__(self, directory, fsync: bool = False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.boot_id = uuid.uuid4().hex[:8]
+        self._sequence = 0
+        self._file = None
+
+    def append(self, message: Message) -> None:
+        if self._file is None:
+            self._sequence += 1
+            path = self.directory / f'messages-{os.getpid()}-{self.boot_id}-{self._sequence}.ndjson'
+            self._file = open(path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(_to_record(message)) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Close the current segment and return its path, or ``None`` if nothing was written."""
+        if self._file is None:
+            return None
+        path = Path(self._file.name)
+        self._file.close()
+        self._file = None
+        return path
+
+    def orphans(self) -> List[Path]:
+        """Segments left behind by processes that are no longer running."""
+        orphans = []
+        for path in sorted(self.directory.glob('messages-*.ndjson')):
+            try:
+                _, pid, boot_id, _ = path.stem.split('-')
+                pid = int(pid)
+            except ValueError:
+                continue
+            if boot_id == self.boot_id:
+                continue
+            if pid == os.getpid() or not _pid_alive(pid):
+                orphans.append(path)
+        return orphans
+
+    @staticmethod
+    def read(path) -> Iterator[Message]:
+        with open(path, encoding='utf-8') as f:
+            yield from MessageSpool.records(f)
+
+    @staticmethod
+    def records(f) -> Iterator[Message]:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield _from_record(json.loads(line))
+            except (ValueError, KeyError):
+                # A torn final line from a crash mid-write
+                logger.warning(f"Skipping unreadable spool record in {f.name}")
+
+    @staticmethod
+    def discard(path) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def replay_segments(paths, batch_size: int = 1000) -> int:
+    """
+    Write the messages of spool segments to the database and remove them.
+
+    Each segment is replayed under an exclusive ``flock``, so workers starting
+    together do not replay the same segment; a segment that is locked or
+    already removed is skipped. Returns the number of messages inserted.
+    """
+    replayed = 0
+    for path in paths:
+        try:
+            f = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"Message spool segment {path} is being replayed by another process")
+                continue
+            try:
+                if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    continue
+            except FileNotFoundError:
+                # Replayed and removed while we waited to open it
+                continue
+
+            batch = []
+            for message in MessageSpool.records(f):
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    replayed += write_messages(batch)
+                    batch = []
+            if batch:
+                replayed += write_messages(batch)
+            # Removed while still locked, so nobody can lock and replay it after us
+            MessageSpool.discard(path)
+        logger.info(f"Replayed message spool segment {path}")
+    return replayed
+
+
+class MessageSink:
+    """
+    Write-behind persistence for chat messages.
+
+    ``submit`` gives a message its id and timestamp immediately, journals it
+    to the spool and returns, so the caller can broadcast without waiting for
+    PostgreSQL. Buffered messages are written in one multi-row INSERT once
+    ``batch_size`` accumulate or ``flush_interval`` seconds pass.
+    """
+
+    def __init__(self, spool: MessageSpool, batch_size: int = 200, flush_interval: float = 0.25, id_block_size: int = 1000):
+        self.spool = spool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block_size = id_block_size
+        self._buffer: List[Message] = []
+        self._ids = deque()
+        self._journaled_segments = []
+        self._flush_lock = asyncio.Lock()
+        self._id_lock = asyncio.Lock()
+        self._timer = None
+        self._loop = None
+
+    async def submit(self, group_id: int, sender_id: int, content: str) -> Message:
+        if not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    self._ids.extend(await database_sync_to_async(reserve_message_ids)(self.id_block_size))
+
+        message = Message(
+            id=self._ids.popleft(),
+            group_id=group_id,
+            sender_id=sender_id,
+            content=content,
+            created_at=timezone.now(),
+        )
+        self.spool.append(message)
+        self._buffer.append(message)
+
+        if len(self._buffer) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+            )
+        return message
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._buffer:
+                return
+
+            batch, self._buffer = self._buffer, []
+            segment = self.spool.rotate()
+            if segment is not None:
+                self._journaled_segments.append(segment)
+            try:
+                await database_sync_to_async(write_messages)(batch)
+            except Exception:
+                logger.exception(f"Failed to persist {len(batch)} messages, will retry")
+                # Keep the journal and retry the batch with the next flush
+                self._buffer[:0] = batch
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(
+                        self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+                    )
+                return
+
+            # Everything journaled before this flush is now committed
+            for path in self._journaled_segments:
+                self.spool.discard(path)
+            self._journaled_segments = []
+
+    async def replay_orphans(self) -> None:
+        orphans = self.spool.orphans()
+        if orphans:
+            replayed = await database_sync_to_async(replay_segments)(orphans, self.batch_size)
+            logger.info(f"Recovered {replayed} messages from the spool")
+
+
+_sink = None
+
+
+def get_message_sink() -> MessageSink:
+    """Return the sink for the running event loop, creating it on first use."""
+    global _sink
+    loop = asyncio.get_running_loop()
+    if _sink is None or _sink._loop is not loop:
+        config = settings.MESSAGE_SINK
+        _sink = MessageSink(
+            MessageSpool(config['SPOOL_DIR'], fsync=config['FSYNC']),
+            batch_size=config['BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+            id_block_size=config['ID_BLOCK_SIZE'],
+        )
+        _sink._loop = loop
+        asyncio.ensure_future(_sink.replay_orphans())
+    return _sink
@@ -0,0 +1,115 @@
+"""
+Delta sync for offline-capable clients.
+
+Groups, messages and membership changes draw their ``change_seq`` from one
+PostgreSQL sequence, so "everything since token N" is a few index range
+scans whose cost follows the amount of change, not the size of the account.
+
+Sequence numbers are handed out before their transaction commits, so a
+change can become visible after a higher one. Every transaction that draws
+numbers first holds a shared advisory lock keyed below all of them (see
+migration 0014) until it ends, so the lowest such key bounds what may still
+commit. The token never passes it: changes committed out of order are sent
+on the next call instead of being skipped, and some recent changes may be
+sent twice, which clients absorb by upserting on ids.
+"""
+from typing import Optional
+from django.db import connection
+from django.contrib.auth import get_user_model
+from django.db.models import OuterRef, Q, Subquery
+from .models import CHANGE_SEQUENCE, Group, MembershipChange, Message
+
+# Advisory locks announcing change floors, see migration 0014
+CHANGE_FLOOR_LOCK_NAMESPACE = 'groups_change_seq'
+
+
+def current_change_seq() -> int:
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT last_value FROM {CHANGE_SEQUENCE}")
+        return cursor.fetchone()[0]
+
+
+def uncommitted_change_floor() -> Optional[int]:
+    """
+    The lowest key announced by a transaction that is still drawing change
+    numbers, or ``None``. Every number such a transaction may commit is above it.
+    """
+    with connection.cursor() as cursor:
+        # Two-key advisory locks show up as classid (first key) and objid (second key) with
+        # objsubid 2; the namespace is the high half of classid, the floor the remaining 48 bits
+        cursor.execute(
+            "SELECT min(((classid::bigint & 65535) << 32) | objid::bigint) FROM pg_locks "
+            "WHERE locktype = 'advisory' AND objsubid = 2 "
+            "AND classid::bigint & 4294901760 = hashtext(%s)::bigint & 4294901760 "
+            "AND database = (SELECT oid FROM pg_database WHERE datname = current_database())",
+            [CHANGE_FLOOR_LOCK_NAMESPACE],
+        )
+        return cursor.fetchone()[0]
+
+
+def _cap(rows: list, limit: int, truncated_at: list) -> list:
+    if len(rows) > limit:
+        rows = rows[:limit]
+        truncated_at.append(rows[-1]['change_seq'])
+    return rows
+
+
+def changes_since(user, since: int, limit: int) -> dict:
+    """
+    Collect what changed in the user's groups after token ``since``.
+
+    Messages and membership changes are capped at ``limit`` each; when either
+    is cut short ``has_more`` is set and the token stops at the last change
+    returned, so the client can keep calling until ``has_more`` is false.
+    """
+    # Read before anything else, the token must not get ahead of what was read.
+    # The head comes first: a number at or below it was drawn after its lock was taken.
+    head = current_change_seq()
+    floor = uncommitted_change_floor()
+    settled = head if floor is None else min(head, floor)
+    member_of = Group.members.through.objects.filter(user=user).values('group_id')
+    truncated_at = []
+
+    memberships = _cap(list(
+        MembershipChange.objects.filter(Q(user=user) | Q(group_id__in=member_of), change_seq__gt=since)
+        .order_by('change_seq')
+        .values(
+            'group_id', 'user_id', 'joined', 'change_seq',
+            # Not a join: the leaves of deleted users are kept without them
+            username=Subquery(get_user_model().objects.filter(pk=OuterRef('user_id')).values('username')),
+        )[:limit + 1]
+    ), limit, truncated_at)
+    messages = _cap(list(
+        Message.objects.filter(group_id__in=member_of, change_seq__gt=since)
+        .order_by('change_seq')
+        .values('id', 'group_id', 'sender_id', 'content', 'created_at', 'change_seq')[:limit + 1]
+    ), limit, truncated_at)
+
+    # Groups the user joined or left in this window, by their latest change
+    own = {}
+    for change in memberships:
+        if change['user_id'] == user.id:
+            own[change['group_id']] = change['joined']
+    current = set(
+        Group.members.through.objects.filter(user=user, group_id__in=own).values_list('group_id', flat=True)
+    ) if own else set()
+    joined_ids = [group_id for group_id in own if group_id in current]
+    left_group_ids = sorted(group_id for group_id in own if group_id not in current)
+
+    groups = list(
+        Group.objects.filter(id__in=member_of)
+        .filter(Q(change_seq__gt=since) | Q(id__in=joined_ids))
+        .with_summary()
+        .with_unread(user)
+        .order_by('change_seq')
+    )
+
+    token = max(since, min([settled, *truncated_at]))
+    return {
+        'token': token,
+        'has_more': bool(truncated_at),
+        'groups': groups,
+        'left_group_ids': left_group_ids,
+        'memberships': memberships,
+        'messages': messages,
+    }
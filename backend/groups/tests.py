@@ -1,3 +1,1209 @@
-from django.test import TestCase
+import asyncio
+import base64
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from core.auth import create_access_token
+from core.codec import codec
+from core.middleware import JWTAuthMiddleware
+from core.pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_paginate
+from core.principals import principal_cache
+from users.models import User
+from .archive import archive_partition, archived_messages
+from .membership import membership_cache
+from .models import MESSAGE_PREVIEW_LENGTH, Group, MembershipChange, Message, MessageArchive
+from .partitions import (
+    DEFAULT_PARTITION,
+    LEGACY_PARTITION,
+    PARENT_TABLE,
+    add_months,
+    ensure_partitions,
+    list_partitions,
+    month_start,
+    partition_name,
+    split_legacy_partition,
+)
+from .presence import MemoryPresenceStore, PresenceTracker
+from .recent import MemoryRecentStore, RecentMessages, sender_json, serialize
+from .routing import websocket_urlpatterns
+from .sink import MessageSink, MessageSpool, replay_segments, reserve_message_ids, write_messages
+from .trending import TrendingGroups
 
-# Create your tests here.
+# The shared cache tier without Redis, emptied before every API test
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'groups-tests'}}
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+class ApiTestMixin:
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        membership_cache.clear()
+        principal_cache.clear()
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': f'Bearer {create_access_token(user_id=user.id)}'}
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='pager', email='pager@example.com', password='secret-pass-1')
+        cls.group = Group.objects.create(owner=cls.user, name='Pager', goal='g', description='d')
+        cls.start = timezone.now() - timedelta(days=1)
+        # Every other pair of messages shares a created_at, so ties must be broken by id
+        cls.rows = [
+            Message.objects.create(
+                group=cls.group,
+                sender=cls.user,
+                content=f'message {i}',
+                created_at=cls.start + timedelta(seconds=i // 2),
+            )
+            for i in range(7)
+        ]
+
+    def messages(self):
+        return Message.objects.filter(group=self.group)
+
+    def ids(self, page):
+        return [message.id for message in page.items]
+
+    def test_cursor_round_trip(self):
+        message = self.rows[3]
+        self.assertEqual(decode_cursor(encode_cursor(message.created_at, message.id)), (message.created_at, message.id))
+
+    def test_latest_page_is_chronological(self):
+        page = keyset_paginate(self.messages(), limit=3)
+        self.assertEqual(self.ids(page), [m.id for m in self.rows[-3:]])
+        self.assertIsNotNone(page.older_cursor)
+        self.assertIsNotNone(page.newer_cursor)
+
+    def test_walking_back_visits_every_row_once_despite_ties(self):
+        seen = []
+        page = keyset_paginate(self.messages(), limit=2)
+        seen[:0] = self.ids(page)
+        while page.older_cursor:
+            page = keyset_paginate(self.messages(), before=page.older_cursor, limit=2)
+            seen[:0] = self.ids(page)
+        self.assertEqual(seen, [m.id for m in self.rows])
+
+    def test_walking_forward_visits_every_row_once_despite_ties(self):
+        first = self.rows[0]
+        seen = [first.id]
+        cursor = encode_cursor(first.created_at, first.id)
+        while True:
+            page = keyset_paginate(self.messages(), after=cursor, limit=2)
+            if not page.items:
+                break
+            seen.extend(self.ids(page))
+            cursor = page.newer_cursor
+        self.assertEqual(seen, [m.id for m in self.rows])
+
+    def test_last_page_has_no_older_cursor(self):
+        page = keyset_paginate(self.messages(), limit=len(self.rows))
+        self.assertEqual(len(page.items), len(self.rows))
+        self.assertIsNone(page.older_cursor)
+
+    def test_empty_page_keeps_the_newer_cursor(self):
+        last = self.rows[-1]
+        cursor = encode_cursor(last.created_at, last.id)
+        page = keyset_paginate(self.messages(), after=cursor, limit=5)
+        self.assertEqual(page.items, [])
+        self.assertEqual(page.newer_cursor, cursor)
+        self.assertIsNone(page.older_cursor)
+
+    def test_empty_queryset(self):
+        page = keyset_paginate(Message.objects.none(), limit=5)
+        self.assertEqual(page.items, [])
+        self.assertIsNone(page.older_cursor)
+        self.assertIsNone(page.newer_cursor)
+
+    def test_newest_first(self):
+        page = keyset_paginate(self.messages(), limit=3, newest_first=True)
+        self.assertEqual(self.ids(page), [m.id for m in reversed(self.rows[-3:])])
+
+    def test_invalid_cursors(self):
+        bad_date = base64.urlsafe_b64encode(b'yesterday|1').decode()
+        bad_id = base64.urlsafe_b64encode(f'{self.start.isoformat()}|one'.encode()).decode()
+        for cursor in ('bm9waXBl', bad_date, bad_id):
+            with self.subTest(cursor=cursor), self.assertRaises(InvalidCursor):
+                keyset_paginate(self.messages(), before=cursor)
+
+    def test_before_and_after_together_are_rejected(self):
+        cursor = encode_cursor(self.start, 1)
+        with self.assertRaises(InvalidCursor):
+            keyset_paginate(self.messages(), before=cursor, after=cursor)
+
+
+class SinkTestMixin:
+    def setUp(self):
+        self.user = User.objects.create_user(username='sender', email='sender@example.com', password='secret-pass-1')
+        self.group = Group.objects.create(owner=self.user, name='Sink', goal='g', description='d')
+        self.spool_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+
+    def build_messages(self, count):
+        return [
+            Message(id=message_id, group_id=self.group.id, sender_id=self.user.id, content=f'spooled {message_id}', created_at=timezone.now())
+            for message_id in reserve_message_ids(count)
+        ]
+
+    def write_segment(self, messages, pid=999999999):
+        # A pid that cannot be running marks the segment as left by a crashed worker
+        path = self.spool_dir / f'messages-{pid}-deadbeef-1.ndjson'
+        spool = MessageSpool(self.spool_dir)
+        for message in messages:
+            spool.append(message)
+        os.replace(spool.rotate(), path)
+        return path
+
+    def message_count(self):
+        self.group.refresh_from_db(fields=['message_count'])
+        return self.group.message_count
+
+
+class WriteMessagesTests(SinkTestMixin, TestCase):
+    def test_rewriting_a_batch_does_not_count_twice(self):
+        messages = self.build_messages(3)
+        self.assertEqual(write_messages(messages), 3)
+        self.assertEqual(write_messages(messages), 0)
+        self.assertEqual(Message.objects.filter(group=self.group).count(), 3)
+        self.assertEqual(self.message_count(), 3)
+
+    def test_partially_stored_batch_counts_only_new_rows(self):
+        messages = self.build_messages(4)
+        write_messages(messages[:2])
+        self.assertEqual(write_messages(messages), 2)
+        self.assertEqual(self.message_count(), 4)
+
+    def test_row_that_cannot_be_stored_is_dropped(self):
+        messages = self.build_messages(3)
+        messages[1].content = 'nul \x00 byte'
+        self.assertEqual(write_messages(messages), 2)
+        stored = Message.objects.filter(group=self.group).order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(stored), [messages[0].id, messages[2].id])
+        self.assertEqual(self.message_count(), 2)
+
+
+class SpoolReplayTests(SinkTestMixin, TestCase):
+    def test_replay_inserts_and_removes_orphaned_segments(self):
+        path = self.write_segment(self.build_messages(3))
+        spool = MessageSpool(self.spool_dir)
+        self.assertEqual(spool.orphans(), [path])
+        self.assertEqual(replay_segments(spool.orphans()), 3)
+        self.assertFalse(path.exists())
+        self.assertEqual(self.message_count(), 3)
+
+    def test_replaying_the_same_messages_twice_counts_once(self):
+        messages = self.build_messages(3)
+        first = self.write_segment(messages, pid=999999998)
+        second = self.write_segment(messages, pid=999999999)
+        self.assertEqual(replay_segments([first, second]), 3)
+        self.assertEqual(self.message_count(), 3)
+
+    def test_locked_segment_is_skipped(self):
+        path = self.write_segment(self.build_messages(2))
+        with open(path) as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            self.assertEqual(replay_segments([path]), 0)
+        self.assertTrue(path.exists())
+        self.assertEqual(replay_segments([path]), 2)
+
+    def test_torn_last_line_is_skipped(self):
+        path = self.write_segment(self.build_messages(2))
+        with open(path, 'a') as f:
+            f.write('{"id": 1, "group_')
+        self.assertEqual(replay_segments([path]), 2)
+
+    def test_missing_segment_is_skipped(self):
+        self.assertEqual(replay_segments([self.spool_dir / 'messages-1-gone-1.ndjson']), 0)
+
+
+class MessageSinkTests(SinkTestMixin, TransactionTestCase):
+    # The sink writes from worker threads, and foreign keys are only checked at commit
+
+    def test_rows_of_a_deleted_group_are_dropped(self):
+        other = Group.objects.create(owner=self.user, name='Gone', goal='g', description='d')
+        messages = self.build_messages(2)
+        messages[1].group_id = other.id
+        other_id = other.id
+        other.delete()
+        self.assertEqual(write_messages(messages), 1)
+        self.assertFalse(Message.objects.filter(group_id=other_id).exists())
+
+    def test_flush_persists_and_discards_the_journal(self):
+        sink = MessageSink(MessageSpool(self.spool_dir), batch_size=100, flush_interval=60, id_block_size=10)
+
+        async def run():
+            submitted = [await sink.submit(self.group.id, self.user.id, f'hello {i}') for i in range(3)]
+            await sink.flush()
+            return submitted
+
+        submitted = async_to_sync(run)()
+        stored = list(Message.objects.filter(group=self.group).order_by('id').values_list('id', 'content'))
+        self.assertEqual(stored, [(message.id, message.content) for message in submitted])
+        self.assertEqual(self.message_count(), 3)
+        self.assertEqual(list(self.spool_dir.glob('messages-*.ndjson')), [])
+
+    def test_poison_row_does_not_stall_the_sink(self):
+        sink = MessageSink(MessageSpool(self.spool_dir), batch_size=100, flush_interval=60, id_block_size=10)
+        poison = self.build_messages(1)[0]
+        poison.content = 'nul \x00 byte'
+
+        async def run():
+            for i in range(2):
+                await sink.submit(self.group.id, self.user.id, f'fine {i}')
+            sink._buffer.append(poison)
+            await sink.flush()
+
+        async_to_sync(run)()
+        self.assertEqual(sink._buffer, [])
+        self.assertEqual(self.message_count(), 2)
+        self.assertEqual(list(self.spool_dir.glob('messages-*.ndjson')), [])
+
+    def test_crashed_worker_is_recovered_on_start(self):
+        path = self.write_segment(self.build_messages(2))
+        sink = MessageSink(MessageSpool(self.spool_dir))
+        async_to_sync(sink.replay_orphans)()
+        self.assertFalse(path.exists())
+        self.assertEqual(self.message_count(), 2)
+
+
+class MembershipChangeTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', email='owner@example.com', password='secret-pass-1')
+        self.member = User.objects.create_user(username='member', email='member@example.com', password='secret-pass-1')
+        self.outsider = User.objects.create_user(username='outsider', email='outsider@example.com', password='secret-pass-1')
+        self.group = Group.objects.create(owner=self.owner, name='Members', goal='g', description='d')
+        self.group.members.add(self.member)
+
+    def leaves(self):
+        return list(
+            MembershipChange.objects.filter(group_id=self.group.id, joined=False).values_list('user_id', flat=True)
+        )
+
+    def test_removing_a_non_member_logs_only_actual_leaves(self):
+        self.group.members.remove(self.member, self.outsider)
+        self.assertEqual(self.leaves(), [self.member.id])
+        self.group.refresh_from_db(fields=['member_count'])
+        self.assertEqual(self.group.member_count, 0)
+
+    def test_removing_from_the_user_side_logs_only_actual_leaves(self):
+        other = Group.objects.create(owner=self.owner, name='Other', goal='g', description='d')
+        self.member.joined_groups.remove(self.group, other)
+        self.assertEqual(self.leaves(), [self.member.id])
+        self.assertFalse(MembershipChange.objects.filter(group_id=other.id, joined=False).exists())
+
+    def test_deleting_a_user_logs_their_leaves(self):
+        member_id = self.member.id
+        self.member.delete()
+        self.assertEqual(self.leaves(), [member_id])
+        self.group.refresh_from_db(fields=['member_count'])
+        self.assertEqual(self.group.member_count, 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class GroupSearchTests(ApiTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='searcher', email='searcher@example.com', password='secret-pass-1')
+        cls.named = Group.objects.create(owner=cls.user, name='Gardeners', goal='g', description='d', public=True)
+        cls.by_goal = Group.objects.create(
+            owner=cls.user, name='Weekend club', goal='Community gardening', description='d', public=True
+        )
+        cls.by_description = Group.objects.create(
+            owner=cls.user, name='Allotment', goal='g', description='We swap seedlings and planters', public=True
+        )
+
+    def search(self, query):
+        response = self.client.get('/api/groups/search', {'query': query}, **self.auth(self.user))
+        self.assertEqual(response.status_code, 200)
+        return [group['id'] for group in response.json()['items']]
+
+    def test_substring_of_goal_or_description_matches(self):
+        self.assertIn(self.by_goal.id, self.search('ardenin'))
+        self.assertIn(self.by_description.id, self.search('lanter'))
+
+    def test_name_substring_matches(self):
+        self.assertEqual(self.search('ardener'), [self.named.id])
+
+    def test_word_prefix_matches(self):
+        self.assertIn(self.by_description.id, self.search('seedl'))
+
+    def test_exact_name_ranks_first(self):
+        Group.objects.create(owner=self.user, name='Allotment swap', goal='g', description='d', public=True)
+        self.assertEqual(self.search('allotment')[0], self.by_description.id)
+
+    def test_query_operators_are_not_interpreted(self):
+        for query in ("garden & !", "'", ':*', '(|)'):
+            with self.subTest(query=query):
+                self.search(query)
+
+    def test_private_groups_of_others_are_hidden(self):
+        stranger = User.objects.create_user(username='stranger', email='stranger@example.com', password='secret-pass-1')
+        hidden = Group.objects.create(owner=stranger, name='Secret gardeners', goal='g', description='d')
+        self.assertNotIn(hidden.id, self.search('gardeners'))
+
+    def test_results_are_paginated(self):
+        response = self.client.get('/api/groups/search', {'query': 'g', 'limit': 1, 'offset': 1}, **self.auth(self.user))
+        self.assertEqual(len(response.json()['items']), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class GroupSummaryTests(ApiTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='summary', email='summary@example.com', password='secret-pass-1')
+        cls.other = User.objects.create_user(username='other', email='other@example.com', password='secret-pass-1')
+        cls.group = Group.objects.create(owner=cls.user, name='Summary', goal='g', description='d', public=True)
+        cls.group.members.add(cls.user, cls.other)
+        Message.objects.create(group=cls.group, sender=cls.user, content='first', created_at=timezone.now() - timedelta(minutes=1))
+        cls.last = Message.objects.create(group=cls.group, sender=cls.other, content='x' * (MESSAGE_PREVIEW_LENGTH + 10))
+
+    def member_groups(self):
+        response = self.client.get('/api/groups/member/', **self.auth(self.user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_summary_carries_member_count_and_last_message(self):
+        [group] = self.member_groups()
+        self.assertEqual(group['member_count'], 2)
+        self.assertEqual(group['owner_id'], self.user.id)
+        self.assertNotIn('members', group)
+        self.assertEqual(group['last_message']['id'], self.last.id)
+        self.assertEqual(group['last_message']['sender_username'], 'other')
+        self.assertEqual(len(group['last_message']['content']), MESSAGE_PREVIEW_LENGTH)
+
+    def test_query_count_does_not_grow_with_the_number_of_groups(self):
+        self.member_groups()  # Warm the principal and membership caches
+        with CaptureQueriesContext(connection) as one:
+            self.member_groups()
+        for i in range(3):
+            group = Group.objects.create(owner=self.user, name=f'More {i}', goal='g', description='d')
+            group.members.add(self.user, self.other)
+            Message.objects.create(group=group, sender=self.other, content=f'hello {i}')
+        with CaptureQueriesContext(connection) as four:
+            self.assertEqual(len(self.member_groups()), 4)
+        self.assertEqual(len(four), len(one))
+
+    def test_search_lists_a_group_with_several_members_once(self):
+        response = self.client.get('/api/groups/search', **self.auth(self.user))
+        ids = [group['id'] for group in response.json()['items']]
+        self.assertEqual(ids.count(self.group.id), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MessageSearchTests(ApiTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='reader', email='reader@example.com', password='secret-pass-1')
+        cls.outsider = User.objects.create_user(username='outsider', email='outsider@example.com', password='secret-pass-1')
+        cls.group = Group.objects.create(owner=cls.user, name='Readers', goal='g', description='d')
+        cls.group.members.add(cls.user)
+        cls.elsewhere = Group.objects.create(owner=cls.user, name='Writers', goal='g', description='d')
+        cls.elsewhere.members.add(cls.user)
+        cls.hidden = Group.objects.create(owner=cls.outsider, name='Hidden', goal='g', description='d')
+        cls.hidden.members.add(cls.outsider)
+        start = timezone.now() - timedelta(hours=1)
+        cls.matches = [
+            Message.objects.create(group=cls.group, sender=cls.user, content=f'we are reading book {i}', created_at=start + timedelta(minutes=i))
+            for i in range(3)
+        ]
+        Message.objects.create(group=cls.group, sender=cls.user, content='nothing to see', created_at=start)
+        cls.other_match = Message.objects.create(group=cls.elsewhere, sender=cls.user, content='books to read', created_at=start)
+        Message.objects.create(group=cls.hidden, sender=cls.outsider, content='secret reading list', created_at=start)
+
+    def get(self, url, **params):
+        return self.client.get(url, params, **self.auth(self.user))
+
+    def test_group_search_matches_word_forms_newest_first(self):
+        response = self.get(f'/api/groups/{self.group.id}/messages/search', q='read')
+        self.assertEqual(response.status_code, 200)
+        items = response.json()['items']
+        self.assertEqual([item['id'] for item in items], [message.id for message in reversed(self.matches)])
+        self.assertIn('<mark>reading</mark>', items[0]['snippet'])
+
+    def test_group_search_pages_with_cursors(self):
+        first = self.get(f'/api/groups/{self.group.id}/messages/search', q='read', limit=2).json()
+        self.assertEqual(len(first['items']), 2)
+        rest = self.get(f'/api/groups/{self.group.id}/messages/search', q='read', before=first['older_cursor']).json()
+        self.assertEqual([item['id'] for item in rest['items']], [self.matches[0].id])
+
+    def test_group_search_needs_membership(self):
+        response = self.get(f'/api/groups/{self.hidden.id}/messages/search', q='read')
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_across_groups_covers_only_joined_groups(self):
+        response = self.get('/api/messages/search', q='read')
+        ids = {item['id'] for item in response.json()['items']}
+        self.assertEqual(ids, {message.id for message in self.matches} | {self.other_match.id})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MembershipCacheTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(username='owner', email='owner@example.com', password='secret-pass-1')
+        self.joiner = User.objects.create_user(username='joiner', email='joiner@example.com', password='secret-pass-1')
+        self.group = Group.objects.create(owner=self.owner, name='Cached', goal='g', description='d')
+        self.group.members.add(self.owner)
+        membership_cache.clear()
+
+    def test_checks_are_answered_from_the_local_tier(self):
+        self.assertTrue(membership_cache.is_member(self.group.id, self.owner.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(membership_cache.is_member(self.group.id, self.owner.id))
+            self.assertFalse(membership_cache.is_member(self.group.id, self.joiner.id))
+
+    def test_other_processes_are_answered_from_the_shared_tier(self):
+        membership_cache.members(self.group.id)
+        membership_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertTrue(membership_cache.is_member(self.group.id, self.owner.id))
+
+    def test_joining_invalidates_on_commit(self):
+        self.assertFalse(membership_cache.is_member(self.group.id, self.joiner.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.members.add(self.joiner)
+        self.assertTrue(membership_cache.is_member(self.group.id, self.joiner.id))
+
+    def test_entries_of_an_older_generation_are_ignored(self):
+        membership_cache.members(self.group.id)
+        key = membership_cache._key(self.group.id)
+        stale = caches['default'].get(key)
+        membership_cache.invalidate(self.group.id)
+        # A reader that loaded before the invalidation stores its result late
+        caches['default'].set(key, (stale[0], frozenset({self.joiner.id})))
+        self.assertFalse(membership_cache.is_member(self.group.id, self.joiner.id))
+        self.assertTrue(membership_cache.is_member(self.group.id, self.owner.id))
+
+    def test_message_endpoints_use_the_cache(self):
+        url = f'/api/groups/{self.group.id}/messages'
+        response = self.client.post(url, {'content': 'hi'}, content_type='application/json', **self.auth(self.joiner))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(url, {'content': 'hi'}, content_type='application/json', **self.auth(self.owner))
+        self.assertEqual(response.status_code, 201)
+
+
+class ConsumerTestMixin(ApiTestMixin):
+    """Sockets against in-memory channel, presence and recent-message stores, with the sink flushed by hand."""
+
+    def setUp(self):
+        super().setUp()
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir, ignore_errors=True)
+        self.enterContext(override_settings(
+            MESSAGE_SINK={**settings.MESSAGE_SINK, 'SPOOL_DIR': spool_dir, 'FLUSH_INTERVAL': 60},
+            PRESENCE={**settings.PRESENCE, 'INTERVAL': 60},
+        ))
+        self.enterContext(mock.patch('groups.presence.presence_store', MemoryPresenceStore()))
+        self.recent = RecentMessages(MemoryRecentStore())
+        self.enterContext(mock.patch('groups.consumers.recent_messages', self.recent))
+
+    def communicator(self, user, path):
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        token = create_access_token(user_id=user.id)
+        return WebsocketCommunicator(application, f'{path}?token={token}')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatConsumerTests(ConsumerTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', email='alice@example.com', password='secret-pass-1')
+        self.bob = User.objects.create_user(username='bob', email='bob@example.com', password='secret-pass-1')
+        self.outsider = User.objects.create_user(username='outsider', email='outsider@example.com', password='secret-pass-1')
+        self.group = Group.objects.create(owner=self.alice, name='Chat', goal='g', description='d')
+        self.group.members.add(self.alice, self.bob)
+
+    async def join(self, user):
+        socket = self.communicator(user, f'/ws/chat/{self.group.id}/')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        backfill = await socket.receive_json_from()
+        self.assertEqual(backfill['type'], 'backfill')
+        return socket
+
+    async def test_non_members_are_turned_away(self):
+        socket = self.communicator(self.outsider, f'/ws/chat/{self.group.id}/')
+        connected, _ = await socket.connect()
+        self.assertFalse(connected)
+
+    async def test_messages_are_broadcast_to_the_group(self):
+        alice, bob = await self.join(self.alice), await self.join(self.bob)
+        await alice.send_json_to({'type': 'message', 'message': 'hello'})
+        for socket in (alice, bob):
+            event = await socket.receive_json_from()
+            self.assertEqual(event['type'], 'message')
+            self.assertEqual(event['message'], 'hello')
+            self.assertEqual(event['user_id'], self.alice.id)
+            self.assertEqual(event['group_id'], self.group.id)
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_invalid_frames_get_an_error(self):
+        alice = await self.join(self.alice)
+        for frame in ('not json', '[1, 2]', '{"message": ""}', '{"message": "nul \\u0000"}', '{"type": "dance"}'):
+            with self.subTest(frame=frame):
+                await alice.send_to(text_data=frame)
+                self.assertEqual((await alice.receive_json_from())['type'], 'error')
+        await alice.disconnect()
+
+    async def test_removed_members_are_cut_off(self):
+        bob = await self.join(self.bob)
+        await sync_to_async(self.group.members.remove)(self.bob)
+        await bob.send_json_to({'type': 'message', 'message': 'still here?'})
+        self.assertEqual((await bob.receive_output())['type'], 'websocket.close')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TrendingGroupsTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            User.objects.create_user(username=f'fan{i}', email=f'fan{i}@example.com', password='secret-pass-1')
+            for i in range(5)
+        ]
+        # Sizes 4, 3, 2, 1 and 0 members
+        self.groups = []
+        for i in range(5):
+            group = Group.objects.create(owner=self.users[0], name=f'Club {i}', goal='g', description='d', public=True)
+            group.members.add(*self.users[:4 - i])
+            self.groups.append(group)
+        self.trending = TrendingGroups(size=2, buffer=3, lock_wait=0)
+
+    def top_ids(self):
+        return [group.id for group in self.trending.top()]
+
+    def test_member_count_follows_joins_and_leaves(self):
+        group = self.groups[4]
+        group.members.add(*self.users)
+        group.members.remove(self.users[0])
+        group.refresh_from_db(fields=['member_count'])
+        self.assertEqual(group.member_count, 4)
+
+    def test_top_groups_are_read_from_the_cached_ranking(self):
+        self.assertEqual(self.top_ids(), [self.groups[0].id, self.groups[1].id])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.top_ids(), [self.groups[0].id, self.groups[1].id])
+
+    def test_joins_patch_the_ranking(self):
+        self.top_ids()
+        self.groups[2].members.add(*self.users)
+        self.trending.refresh([self.groups[2].id])
+        self.assertEqual(self.top_ids(), [self.groups[2].id, self.groups[0].id])
+        self.assertEqual(caches['default'].get(self.trending.key)['ranking'][0], (self.groups[2].id, 5))
+
+    def test_a_group_below_the_ranking_enters_once_it_passes_the_floor(self):
+        self.top_ids()
+        self.groups[4].members.add(*self.users)
+        self.trending.refresh([self.groups[4].id])
+        self.assertEqual(self.top_ids(), [self.groups[4].id, self.groups[0].id])
+
+    def test_private_groups_are_never_listed(self):
+        self.top_ids()
+        self.groups[0].public = False
+        self.groups[0].save()
+        # Even before the ranking is patched
+        self.assertEqual(self.top_ids(), [self.groups[1].id])
+        self.trending.refresh([self.groups[0].id])
+        self.assertEqual(self.top_ids(), [self.groups[1].id, self.groups[2].id])
+
+    def test_ranking_is_rebuilt_when_too_few_entries_remain(self):
+        self.top_ids()
+        Group.objects.filter(id__in=[self.groups[0].id, self.groups[1].id]).update(public=False)
+        self.trending.refresh([self.groups[0].id, self.groups[1].id])
+        self.assertIsNone(caches['default'].get(self.trending.key))
+        self.assertEqual(self.top_ids(), [self.groups[2].id, self.groups[3].id])
+
+    def test_a_patch_that_cannot_lock_keeps_the_holder_from_storing(self):
+        with self.trending._lock(wait=0) as locked:
+            self.assertTrue(locked)
+            state = self.trending._query()
+            # A change lands while the holder still works with what it read
+            self.groups[4].members.add(*self.users)
+            self.trending.refresh([self.groups[4].id])
+            self.trending._store_locked(state)
+        self.assertIsNone(caches['default'].get(self.trending.key))
+        self.assertEqual(self.top_ids()[0], self.groups[4].id)
+
+    def test_public_endpoint_lists_the_top_groups(self):
+        self.groups[1].public = False
+        self.groups[1].save()
+        response = self.client.get('/api/groups/public/', **self.auth(self.users[0]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [group['id'] for group in response.json()],
+            [self.groups[0].id, self.groups[2].id, self.groups[3].id, self.groups[4].id],
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class GroupListTests(ApiTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='lister', email='lister@example.com', password='secret-pass-1')
+        cls.other = User.objects.create_user(username='other', email='other@example.com', password='secret-pass-1')
+        cls.start = timezone.now() - timedelta(days=1)
+        cls.joined_private = cls.make_group('Joined private', public=False, members=[cls.user, cls.other])
+        cls.joined_public = cls.make_group('Joined public', public=True, members=[cls.user, cls.other])
+        cls.other_public = cls.make_group('Other public', public=True, members=[cls.other])
+        cls.other_private = cls.make_group('Other private', public=False, members=[cls.other])
+
+    @classmethod
+    def make_group(cls, name, public, members):
+        group = Group.objects.create(owner=cls.other, name=name, goal='g', description='d', public=public)
+        group.members.add(*members)
+        Group.objects.filter(id=group.id).update(created_at=cls.start + timedelta(minutes=Group.objects.count()))
+        return group
+
+    def list(self, **params):
+        response = self.client.get('/api/groups/', params, **self.auth(self.user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_member_and_public_groups_are_listed_once_newest_first(self):
+        items = self.list()['items']
+        self.assertEqual(
+            [(group['id'], group['is_member']) for group in items],
+            [(self.other_public.id, False), (self.joined_public.id, True), (self.joined_private.id, True)],
+        )
+        self.assertEqual(items[1]['member_count'], 2)
+
+    def test_a_page_is_a_single_query(self):
+        self.list()  # Warm the principal cache
+        with self.assertNumQueries(1):
+            self.list()
+
+    def test_pages_follow_the_older_cursor(self):
+        first = self.list(limit=2)
+        second = self.list(limit=2, before=first['older_cursor'])
+        ids = [group['id'] for group in first['items'] + second['items']]
+        self.assertEqual(ids, [self.other_public.id, self.joined_public.id, self.joined_private.id])
+        self.assertIsNone(second.get('older_cursor'))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/groups/', {'before': 'nope'}, **self.auth(self.user))
+        self.assertEqual(response.status_code, 400)
+
+
+class UnclaimablePresenceStore(MemoryPresenceStore):
+    """A store in which another worker holds every claim until ``claimable`` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.claimable = False
+
+    def claim(self, group_ids, window):
+        return set(group_ids) if self.claimable else set()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PresenceTrackerTests(ApiTestMixin, TestCase):
+    group_id = 7
+
+    def setUp(self):
+        super().setUp()
+        # Flushed by hand instead of every interval
+        self.enterContext(mock.patch.object(PresenceTracker, '_schedule'))
+        self.store = MemoryPresenceStore()
+
+    async def listen(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(f'chat_{self.group_id}', channel)
+        return channel
+
+    async def diffs(self, channel):
+        """Every presence diff broadcast so far."""
+        layer, diffs = get_channel_layer(), []
+        while True:
+            try:
+                event = await asyncio.wait_for(layer.receive(channel), 0.05)
+            except asyncio.TimeoutError:
+                return diffs
+            diffs.append(codec.loads(event['text']))
+
+    async def test_changes_within_an_interval_are_one_diff(self):
+        channel = await self.listen()
+        tracker = PresenceTracker(self.store)
+        tracker.join(self.group_id, 1, 'a')
+        tracker.join(self.group_id, 2, 'b')
+        tracker.join(self.group_id, 2, 'c')
+        await tracker.flush()
+
+        [diff] = await self.diffs(channel)
+        self.assertEqual(diff, {'type': 'presence', 'group_id': self.group_id, 'joined': [1, 2], 'left': [], 'online': 2})
+
+    async def test_reconnects_within_an_interval_are_silent(self):
+        channel = await self.listen()
+        tracker = PresenceTracker(self.store)
+        tracker.join(self.group_id, 1, 'a')
+        await tracker.flush()
+        await self.diffs(channel)
+
+        tracker.leave(self.group_id, 1, 'a')
+        tracker.join(self.group_id, 1, 'b')
+        await tracker.flush()
+        self.assertEqual(await self.diffs(channel), [])
+        self.assertEqual(self.store.online([self.group_id]), {self.group_id: {1}})
+
+    async def test_a_user_leaves_with_their_last_socket(self):
+        channel = await self.listen()
+        tracker = PresenceTracker(self.store)
+        tracker.join(self.group_id, 1, 'a')
+        tracker.join(self.group_id, 1, 'b')
+        await tracker.flush()
+        await self.diffs(channel)
+
+        tracker.leave(self.group_id, 1, 'a')
+        await tracker.flush()
+        self.assertEqual(await self.diffs(channel), [])
+        tracker.leave(self.group_id, 1, 'b')
+        await tracker.flush()
+        [diff] = await self.diffs(channel)
+        self.assertEqual((diff['joined'], diff['left'], diff['online']), ([], [1], 0))
+
+    async def test_workers_diff_against_the_last_broadcast(self):
+        channel = await self.listen()
+        first, second = PresenceTracker(self.store), PresenceTracker(self.store)
+        first.join(self.group_id, 1, 'a')
+        await first.flush()
+        second.join(self.group_id, 2, 'b')
+        await second.flush()
+
+        diffs = await self.diffs(channel)
+        self.assertEqual([diff['joined'] for diff in diffs], [[1], [2]])
+        self.assertEqual(diffs[-1]['online'], 2)
+
+    async def test_groups_claimed_elsewhere_stay_pending(self):
+        channel = await self.listen()
+        store = UnclaimablePresenceStore()
+        tracker = PresenceTracker(store)
+        tracker.join(self.group_id, 1, 'a')
+        await tracker.flush()
+        self.assertEqual(await self.diffs(channel), [])
+
+        store.claimable = True
+        await tracker.flush()
+        [diff] = await self.diffs(channel)
+        self.assertEqual(diff['joined'], [1])
+
+    async def test_heartbeats_keep_entries_alive(self):
+        tracker = PresenceTracker(self.store, ttl=30)
+        tracker.join(self.group_id, 1, 'a')
+        await tracker.flush()
+        # The entry was about to expire
+        self.store.update({self.group_id: {'1:a'}}, {}, time.time() + 0.01)
+        tracker.heartbeat(self.group_id, 1, 'a')
+        # Unknown sockets are not brought back to life
+        tracker.heartbeat(self.group_id, 2, 'gone')
+        await tracker.flush()
+        await asyncio.sleep(0.02)
+        self.assertEqual(self.store.online([self.group_id]), {self.group_id: {1}})
+
+    def test_expired_entries_are_offline(self):
+        self.store.update({self.group_id: {'1:a', '2:b'}}, {}, time.time() + 60)
+        self.store.update({self.group_id: {'2:b'}}, {}, time.time() - 1)
+        self.assertEqual(self.store.online([self.group_id]), {self.group_id: {1}})
+
+    def test_presence_endpoint_is_for_members(self):
+        user = User.objects.create_user(username='present', email='present@example.com', password='secret-pass-1')
+        outsider = User.objects.create_user(username='absent', email='absent@example.com', password='secret-pass-1')
+        group = Group.objects.create(owner=user, name='Online', goal='g', description='d')
+        group.members.add(user)
+        self.store.update({group.id: {f'{user.id}:a'}}, {}, time.time() + 60)
+
+        with mock.patch('groups.api.presence_store', self.store):
+            response = self.client.get(f'/api/groups/{group.id}/presence', **self.auth(user))
+            self.assertEqual(response.json(), {'group_id': group.id, 'online': [user.id], 'count': 1})
+            response = self.client.get(f'/api/groups/{group.id}/presence', **self.auth(outsider))
+            self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class StreamConsumerTests(ConsumerTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', email='alice@example.com', password='secret-pass-1')
+        self.bob = User.objects.create_user(username='bob', email='bob@example.com', password='secret-pass-1')
+        self.shared = Group.objects.create(owner=self.alice, name='Shared', goal='g', description='d')
+        self.shared.members.add(self.alice, self.bob)
+        self.own = Group.objects.create(owner=self.alice, name='Own', goal='g', description='d')
+        self.own.members.add(self.alice)
+
+    async def connect(self, user):
+        socket = self.communicator(user, '/ws/stream/')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        return socket, await socket.receive_json_from()
+
+    async def test_sockets_start_subscribed_to_every_group(self):
+        alice, subscribed = await self.connect(self.alice)
+        self.assertEqual(subscribed, {'type': 'subscribed', 'group_ids': sorted([self.shared.id, self.own.id])})
+        await alice.disconnect()
+
+    async def test_anonymous_sockets_are_refused(self):
+        socket = WebsocketCommunicator(JWTAuthMiddleware(URLRouter(websocket_urlpatterns)), '/ws/stream/?token=nope')
+        connected, _ = await socket.connect()
+        self.assertFalse(connected)
+
+    async def test_events_reach_only_the_groups_subscribers(self):
+        (alice, _), (bob, _) = await self.connect(self.alice), await self.connect(self.bob)
+        await alice.send_json_to({'type': 'message', 'group_id': self.own.id, 'message': 'just me'})
+        event = await alice.receive_json_from()
+        self.assertEqual((event['type'], event['group_id'], event['message']), ('message', self.own.id, 'just me'))
+        self.assertTrue(await bob.receive_nothing())
+
+        await alice.send_json_to({'type': 'typing', 'group_id': self.shared.id})
+        for socket in (alice, bob):
+            event = await socket.receive_json_from()
+            self.assertEqual((event['type'], event['group_id'], event['user_id']), ('typing', self.shared.id, self.alice.id))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_unsubscribe_and_subscribe_again(self):
+        alice, _ = await self.connect(self.alice)
+        await alice.send_json_to({'type': 'unsubscribe', 'group_id': self.own.id})
+        self.assertEqual(await alice.receive_json_from(), {'type': 'unsubscribed', 'group_id': self.own.id})
+        await alice.send_json_to({'type': 'message', 'group_id': self.own.id, 'message': 'hello?'})
+        self.assertEqual((await alice.receive_json_from())['type'], 'error')
+
+        await alice.send_json_to({'type': 'subscribe', 'group_id': self.own.id})
+        self.assertEqual(await alice.receive_json_from(), {'type': 'subscribed', 'group_ids': [self.own.id]})
+        backfill = await alice.receive_json_from()
+        self.assertEqual((backfill['type'], backfill['group_id']), ('backfill', self.own.id))
+        await alice.disconnect()
+
+    async def test_non_members_cannot_subscribe(self):
+        bob, _ = await self.connect(self.bob)
+        await bob.send_json_to({'type': 'subscribe', 'group_id': self.own.id})
+        error = await bob.receive_json_from()
+        self.assertEqual((error['type'], error['group_id']), ('error', self.own.id))
+        await bob.send_json_to({'type': 'typing', 'group_id': self.own.id})
+        self.assertEqual((await bob.receive_json_from())['type'], 'error')
+        await bob.disconnect()
+
+    async def test_frames_must_name_a_group(self):
+        alice, _ = await self.connect(self.alice)
+        for frame in ({'type': 'message', 'message': 'where?'}, {'type': 'typing', 'group_id': 'abc'}):
+            with self.subTest(frame=frame):
+                await alice.send_json_to(frame)
+                self.assertEqual((await alice.receive_json_from())['type'], 'error')
+        # Heartbeats are for every subscribed group at once
+        await alice.send_json_to({'type': 'heartbeat'})
+        self.assertTrue(await alice.receive_nothing())
+        await alice.disconnect()
+
+    async def test_removed_members_are_unsubscribed(self):
+        (alice, _), (bob, _) = await self.connect(self.alice), await self.connect(self.bob)
+        await sync_to_async(self.shared.members.remove)(self.bob)
+        await bob.send_json_to({'type': 'typing', 'group_id': self.shared.id})
+        self.assertEqual((await bob.receive_json_from())['type'], 'error')
+
+        await alice.send_json_to({'type': 'typing', 'group_id': self.shared.id})
+        await alice.receive_json_from()
+        self.assertTrue(await bob.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RecentMessagesTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='recent', email='recent@example.com', password='secret-pass-1')
+        self.group = Group.objects.create(owner=self.user, name='Recent', goal='g', description='d')
+        self.start = timezone.now() - timedelta(hours=1)
+        # Without the in-process copy every read goes to the store
+        self.recent = RecentMessages(MemoryRecentStore(), size=3, local_ttl=0)
+
+    def store_message(self, minute, content='stored'):
+        return Message.objects.create(
+            group=self.group, sender=self.user, content=content, created_at=self.start + timedelta(minutes=minute),
+        )
+
+    def unsaved(self, message_id, minute):
+        # Still waiting in a write-behind sink
+        return serialize(Message(
+            id=message_id, group=self.group, sender=self.user, content='pending', created_at=self.start + timedelta(minutes=minute),
+        ))
+
+    def ids(self):
+        items, _ = self.recent.latest(self.group.id)
+        return [item['id'] for item in items]
+
+    def test_cold_groups_are_primed_from_the_database(self):
+        first, second = self.store_message(1), self.store_message(2)
+        items, complete = self.recent.latest(self.group.id)
+        self.assertEqual([item['id'] for item in items], [first.id, second.id])
+        self.assertTrue(complete)
+        self.assertEqual(items[0]['sender']['username'], 'recent')
+        with self.assertNumQueries(0):
+            self.recent.latest(self.group.id)
+
+    def test_priming_keeps_messages_appended_while_cold(self):
+        stored = self.store_message(1)
+        pending = self.unsaved(stored.id + 1000, 2)
+        self.recent.append(self.group.id, pending, sender_json(self.user))
+        self.assertEqual(self.ids(), [stored.id, pending['id']])
+
+    def test_appends_are_kept_in_timeline_order(self):
+        self.recent.latest(self.group.id)
+        for message_id, minute in ((10, 3), (11, 1), (12, 2)):
+            self.recent.append(self.group.id, self.unsaved(message_id, minute), sender_json(self.user))
+        self.assertEqual(self.ids(), [11, 12, 10])
+
+    def test_trimming_drops_the_oldest_and_marks_the_buffer_partial(self):
+        self.recent.latest(self.group.id)
+        for message_id, minute in ((10, 4), (11, 1), (12, 3), (13, 2)):
+            self.recent.append(self.group.id, self.unsaved(message_id, minute), sender_json(self.user))
+        items, complete = self.recent.latest(self.group.id)
+        self.assertEqual([item['id'] for item in items], [13, 12, 10])
+        self.assertFalse(complete)
+
+    def test_long_histories_prime_as_partial(self):
+        for minute in range(5):
+            self.store_message(minute)
+        items, complete = self.recent.latest(self.group.id)
+        self.assertEqual(len(items), 3)
+        self.assertFalse(complete)
+
+    def test_local_copies_follow_appends(self):
+        recent = RecentMessages(MemoryRecentStore(), size=2, local_ttl=60)
+        recent.latest(self.group.id)
+        recent.append(self.group.id, self.unsaved(10, 2), sender_json(self.user))
+        recent.append(self.group.id, self.unsaved(11, 1), sender_json(self.user))
+        recent.append(self.group.id, self.unsaved(12, 3), sender_json(self.user))
+        items, complete = recent.latest(self.group.id)
+        self.assertEqual([item['id'] for item in items], [10, 12])
+        self.assertFalse(complete)
+
+    def test_sender_changes_show_in_the_next_read(self):
+        self.store_message(1)
+        self.recent.latest(self.group.id)
+        self.user.username = 'renamed'
+        self.user.save()
+        items, _ = self.recent.latest(self.group.id)
+        self.assertEqual(items[0]['sender']['username'], 'renamed')
+
+    def test_pages_need_enough_messages_or_the_whole_history(self):
+        for minute in range(2):
+            self.store_message(minute)
+        page = self.recent.page(self.group.id, limit=1)
+        self.assertEqual(len(page.items), 1)
+        self.assertIsNotNone(page.older_cursor)
+        page = self.recent.page(self.group.id, limit=3)
+        self.assertEqual(len(page.items), 2)
+        self.assertIsNone(page.older_cursor)
+        # Larger than the buffer, left to the database
+        self.assertIsNone(self.recent.page(self.group.id, limit=4))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UnreadCountTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader = User.objects.create_user(username='reader', email='reader@example.com', password='secret-pass-1')
+        self.writer = User.objects.create_user(username='writer', email='writer@example.com', password='secret-pass-1')
+        self.group = Group.objects.create(owner=self.writer, name='Unread', goal='g', description='d', public=True)
+        self.group.members.add(self.reader, self.writer)
+        self.start = timezone.now() - timedelta(hours=1)
+
+    def post(self, count, group=None):
+        """Write ``count`` messages the way the chat sink does."""
+        group = group or self.group
+        ids = reserve_message_ids(count)
+        offset = Message.objects.filter(group=group).count()
+        write_messages([
+            Message(id=message_id, group_id=group.id, sender_id=self.writer.id, content='news',
+                    created_at=self.start + timedelta(minutes=offset + i))
+            for i, message_id in enumerate(ids)
+        ])
+        return ids
+
+    def unread(self):
+        response = self.client.get('/api/groups/unread', **self.auth(self.reader))
+        self.assertEqual(response.status_code, 200)
+        return {entry['group_id']: entry['unread_count'] for entry in response.json()}
+
+    def read(self, message_id=None, group=None):
+        payload = {} if message_id is None else {'message_id': message_id}
+        return self.client.post(
+            f'/api/groups/{(group or self.group).id}/read', payload, content_type='application/json', **self.auth(self.reader),
+        )
+
+    def test_messages_start_unread(self):
+        self.post(3)
+        self.assertEqual(self.unread(), {self.group.id: 3})
+
+    def test_reading_to_the_latest_message(self):
+        ids = self.post(3)
+        response = self.read()
+        self.assertEqual(response.json(), {'group_id': self.group.id, 'last_read_message_id': ids[-1], 'unread_count': 0})
+        self.post(1)
+        self.assertEqual(self.unread(), {self.group.id: 1})
+
+    def test_reading_up_to_a_message(self):
+        ids = self.post(4)
+        self.assertEqual(self.read(ids[1]).json()['unread_count'], 2)
+        self.assertEqual(self.unread(), {self.group.id: 2})
+
+    def test_the_read_pointer_never_moves_backwards(self):
+        ids = self.post(3)
+        self.read()
+        response = self.read(ids[0])
+        self.assertEqual(response.json()['last_read_message_id'], ids[-1])
+        self.assertEqual(response.json()['unread_count'], 0)
+
+    def test_group_lists_carry_unread_counts_for_members_only(self):
+        self.post(2)
+        other = Group.objects.create(owner=self.writer, name='Elsewhere', goal='g', description='d', public=True)
+        self.post(1, group=other)
+
+        [member_group] = self.client.get('/api/groups/member/', **self.auth(self.reader)).json()
+        self.assertEqual(member_group['unread_count'], 2)
+        items = self.client.get('/api/groups/', **self.auth(self.reader)).json()['items']
+        self.assertEqual({group['id']: group['unread_count'] for group in items}, {self.group.id: 2, other.id: None})
+
+    def test_unread_counts_are_one_query(self):
+        self.post(2)
+        self.unread()  # Warm the principal cache
+        with self.assertNumQueries(1):
+            self.unread()
+
+    def test_only_members_may_read(self):
+        outsider = User.objects.create_user(username='outsider', email='outsider@example.com', password='secret-pass-1')
+        response = self.client.post(
+            f'/api/groups/{self.group.id}/read', {}, content_type='application/json', **self.auth(outsider),
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.read(message_id=10 ** 12).status_code, 404)
+
+    def test_recount_includes_archived_messages(self):
+        self.post(2)
+        Group.objects.filter(id=self.group.id).update(message_count=0)
+        MessageArchive.objects.create(
+            partition='groups_message_p2000_01', range_end=self.start, path='archive.ndjson.gz',
+            format=MessageArchive.FORMAT_NDJSON, row_count=5, group_counts={str(self.group.id): 5},
+        )
+        call_command('recount_group_messages', stdout=StringIO())
+        self.group.refresh_from_db(fields=['message_count'])
+        self.assertEqual(self.group.message_count, 7)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MessagePartitionTests(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir, ignore_errors=True)
+        self.enterContext(override_settings(MESSAGE_ARCHIVE={**settings.MESSAGE_ARCHIVE, 'DIR': archive_dir}))
+        self.archive_dir = Path(archive_dir)
+        self.user = User.objects.create_user(username='historian', email='historian@example.com', password='secret-pass-1')
+        self.group = Group.objects.create(owner=self.user, name='History', goal='g', description='d')
+        self.group.members.add(self.user)
+        self.this_month = month_start(timezone.now())
+
+    def message_at(self, months_ago, hour=0, group=None):
+        created_at = add_months(self.this_month, -months_ago) + timedelta(days=2, hours=hour)
+        return Message.objects.create(group=group or self.group, sender=self.user, content=f'{months_ago}/{hour}', created_at=created_at)
+
+    def partition_of(self, message):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT tableoid::regclass::text FROM {PARENT_TABLE} WHERE id = %s', [message.id])
+            return cursor.fetchone()[0]
+
+    def partition(self, name):
+        return next((partition for partition in list_partitions() if partition.name == name), None)
+
+    def test_partitions_are_created_ahead_once(self):
+        ensure_partitions(5)
+        names = {partition.name for partition in list_partitions()}
+        for months in range(6):
+            self.assertIn(partition_name(add_months(self.this_month, months)), names)
+        self.assertEqual(ensure_partitions(5), [])
+
+    def test_new_partitions_take_their_rows_from_the_default_partition(self):
+        future = Message.objects.create(
+            group=self.group, sender=self.user, content='early', created_at=add_months(self.this_month, 6) + timedelta(days=1),
+        )
+        self.assertEqual(self.partition_of(future), DEFAULT_PARTITION)
+        ensure_partitions(6)
+        self.assertEqual(self.partition_of(future), partition_name(add_months(self.this_month, 6)))
+
+    def test_old_months_are_split_out_of_the_legacy_partition(self):
+        oldest, older, recent = self.message_at(14), self.message_at(13), self.message_at(2)
+        cutoff = add_months(self.this_month, -12)
+        created = split_legacy_partition(until=cutoff)
+
+        self.assertEqual(created, [partition_name(add_months(self.this_month, -14)), partition_name(add_months(self.this_month, -13))])
+        self.assertEqual(self.partition_of(oldest), created[0])
+        self.assertEqual(self.partition_of(older), created[1])
+        self.assertEqual(self.partition_of(recent), LEGACY_PARTITION)
+        self.assertEqual(self.partition(LEGACY_PARTITION).start, cutoff)
+
+    def archive(self, months_ago):
+        [name] = split_legacy_partition(until=add_months(self.this_month, 1 - months_ago))[-1:]
+        return archive_partition(self.partition(name), MessageArchive.FORMAT_NDJSON)
+
+    def test_archiving_exports_and_detaches_a_partition(self):
+        other = Group.objects.create(owner=self.user, name='Other', goal='g', description='d')
+        for hour in range(3):
+            self.message_at(14, hour)
+        self.message_at(14, 5, group=other)
+        archive = self.archive(14)
+
+        self.assertEqual(archive.row_count, 4)
+        self.assertEqual(archive.group_counts, {str(self.group.id): 3, str(other.id): 1})
+        self.assertIsNone(self.partition(archive.partition))
+        self.assertFalse(Message.objects.filter(created_at__lt=add_months(self.this_month, -13)).exists())
+        self.assertEqual([row['content'] for row in archived_messages(other.id, limit=10)], ['14/5'])
+
+    def test_a_failed_export_leaves_the_partition_attached(self):
+        self.message_at(14)
+        [name] = split_legacy_partition(until=add_months(self.this_month, -13))
+        with mock.patch('groups.archive._write_ndjson', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                archive_partition(self.partition(name), MessageArchive.FORMAT_NDJSON)
+        self.assertIsNotNone(self.partition(name))
+        self.assertFalse(MessageArchive.objects.exists())
+        self.assertEqual(list(self.archive_dir.iterdir()), [])
+
+    def list_messages(self, **params):
+        response = self.client.get(
+            f'/api/groups/{self.group.id}/messages', {'include_archived': 'true', **params}, **self.auth(self.user),
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_history_pages_continue_into_the_archives(self):
+        archived = [self.message_at(14, hour) for hour in range(3)]
+        self.archive(14)
+        recent = self.message_at(0)
+
+        first = self.list_messages(limit=2)
+        self.assertEqual([item['id'] for item in first['items']], [archived[2].id, recent.id])
+        second = self.list_messages(limit=2, before=first['older_cursor'])
+        self.assertEqual([item['id'] for item in second['items']], [archived[0].id, archived[1].id])
+        self.assertIsNone(second['older_cursor'])
+
+        forward = self.list_messages(limit=2, after=second['newer_cursor'])
+        self.assertEqual([item['id'] for item in forward['items']], [archived[2].id, recent.id])
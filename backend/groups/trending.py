@@ -0,0 +1,177 @@
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterable, List
+from django.conf import settings
+from django.core.cache import caches
+from .models import Group
+
+logger = logging.getLogger(__name__)
+
+
+class TrendingGroups:
+    """
+    The biggest public groups, ranked by ``member_count``.
+
+    The ranking (group id and count, up to ``buffer`` entries) lives in the
+    shared cache. Membership and visibility changes patch it in place through
+    ``refresh``, so a read is one primary-key lookup for the top ``size``
+    groups. It is rebuilt from the ``(public, member_count)`` index when it
+    expires or when removals leave fewer than ``size`` entries.
+
+    Patches and rebuilds write the shared key under a short cache lock, so a
+    slower writer cannot overwrite a newer ranking with what it read earlier.
+    A patch that cannot take the lock drops the key and marks it dirty, which
+    keeps the lock holder from storing what it read before that change.
+    """
+
+    key = 'groups:trending:v1'
+    lock_key = 'groups:trending:v1:lock'
+    dirty_key = 'groups:trending:v1:dirty'
+
+    def __init__(self, cache_alias='default', size=10, buffer=50, ttl=300, lock_timeout=5, lock_wait=1.0):
+        self.cache_alias = cache_alias
+        self.size = size
+        self.buffer = max(buffer, size)
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _load(self):
+        try:
+            return self.cache.get(self.key)
+        except Exception:
+            logger.exception("Trending groups cache unavailable")
+            return None
+
+    def _store(self, ranking) -> None:
+        try:
+            self.cache.set(self.key, ranking, self.ttl)
+        except Exception:
+            logger.exception("Failed to store trending groups")
+
+    @contextmanager
+    def _lock(self, wait: float):
+        """Yield whether the write lock was taken within ``wait`` seconds."""
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        acquired = False
+        try:
+            while True:
+                acquired = self.cache.add(self.lock_key, token, self.lock_timeout)
+                if acquired or time.monotonic() >= deadline:
+                    break
+                time.sleep(0.01)
+        except Exception:
+            logger.exception("Trending groups lock unavailable")
+        if acquired:
+            self._clear_dirty()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    # Not ours any more if it expired while we held it
+                    if self.cache.get(self.lock_key) == token:
+                        self.cache.delete(self.lock_key)
+                except Exception:
+                    logger.exception("Failed to release trending groups lock")
+
+    def _clear_dirty(self) -> None:
+        try:
+            self.cache.delete(self.dirty_key)
+        except Exception:
+            logger.exception("Failed to clear trending groups dirty flag")
+
+    def _store_locked(self, ranking) -> None:
+        """Store ``ranking`` while holding the lock, unless a change was skipped meanwhile."""
+        try:
+            dirty = self.cache.get(self.dirty_key)
+        except Exception:
+            logger.exception("Trending groups cache unavailable")
+            dirty = True
+        if dirty:
+            self.invalidate()
+        else:
+            self._store(ranking)
+
+    def _query(self) -> dict:
+        ranking = list(
+            Group.objects.filter(public=True)
+            .order_by('-member_count', '-id')
+            .values_list('id', 'member_count')[:self.buffer]
+        )
+        # A short list holds every public group, so any group may enter it later
+        return {'ranking': ranking, 'complete': len(ranking) < self.buffer}
+
+    def rebuild(self) -> dict:
+        # Readers don't wait; without the lock they answer from the database without caching
+        with self._lock(wait=0) as locked:
+            state = self._query()
+            if locked:
+                self._store_locked(state)
+        return state
+
+    def top(self) -> List[Group]:
+        """The top ``size`` public groups, annotated for ``GroupSummaryOut``."""
+        state = self._load() or self.rebuild()
+        ids = [group_id for group_id, _ in state['ranking'][:self.size]]
+        # The ranking may predate a switch to private
+        groups = Group.objects.filter(id__in=ids, public=True).with_summary()
+        return sorted(groups, key=lambda group: (-group.member_count, -group.id))
+
+    def refresh(self, group_ids: Iterable[int]) -> None:
+        """Patch the cached ranking after the member count or visibility of ``group_ids`` changed."""
+        with self._lock(wait=self.lock_wait) as locked:
+            if not locked:
+                # Patching without the lock could lose a concurrent patch, start over instead
+                try:
+                    self.cache.set(self.dirty_key, 1, self.lock_timeout)
+                except Exception:
+                    logger.exception("Failed to mark trending groups dirty")
+                self.invalidate()
+                return
+            self._patch(set(group_ids))
+
+    def _patch(self, group_ids: set) -> None:
+        state = self._load()
+        if state is None:
+            # Nothing cached, the next read builds it from scratch
+            return
+        ranking, complete = state['ranking'], state['complete']
+        # Every group outside an incomplete ranking has at most this many members
+        floor = ranking[-1][1] if ranking and not complete else 0
+
+        entries = {group_id: count for group_id, count in ranking if group_id not in group_ids}
+        changed = Group.objects.filter(id__in=group_ids, public=True).values_list('id', 'member_count')
+        for group_id, count in changed:
+            if complete or count >= floor:
+                entries[group_id] = count
+
+        ranking = sorted(entries.items(), key=lambda entry: (-entry[1], -entry[0]))
+        if len(ranking) > self.buffer:
+            ranking, complete = ranking[:self.buffer], False
+        if not complete and len(ranking) < self.size:
+            # Too many entries fell out to know the top groups, rebuild on the next read
+            self.invalidate()
+        else:
+            self._store_locked({'ranking': ranking, 'complete': complete})
+
+    def invalidate(self) -> None:
+        try:
+            self.cache.delete(self.key)
+        except Exception:
+            logger.exception("Failed to invalidate trending groups")
+
+
+trending_groups = TrendingGroups(
+    cache_alias=settings.TRENDING_GROUPS['CACHE'],
+    size=settings.TRENDING_GROUPS['SIZE'],
+    buffer=settings.TRENDING_GROUPS['BUFFER'],
+    ttl=settings.TRENDING_GROUPS['TTL'],
+)
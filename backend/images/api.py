@@ -1,17 +1,84 @@
-from typing import Any, List
+import os
+from datetime import timedelta
+from typing import Any
+from uuid import UUID
+from django.conf import settings
+from django.core.files import File as DjangoFile
+from django.core.validators import get_available_image_extensions
+from django.db import transaction
 from django.shortcuts import get_object_or_404
-from ninja import Router, File
+from django.utils import timezone
+from ninja import Router, File, Query
 from ninja.files import UploadedFile
 from core.auth import AuthBearer
-from core.schemas import ImageCreate, ImageOut, ImageUpdate, Message
-from .models import Image
+from core.pagination import InvalidCursor, keyset_paginate
+from core.schemas import (
+    IMAGE_LIST_FIELDS,
+    ImageCreate,
+    ImageListParams,
+    ImageOut,
+    ImagePage,
+    ImageUpdate,
+    Message,
+    UploadConflictOut,
+    UploadFinalize,
+    UploadInit,
+    UploadSessionOut,
+)
+from . import uploads
+from .models import Blob, Image, UploadSession
+from .processing import process_image
 
 router = Router(tags=["images"])
 
-@router.get("/", response=List[ImageOut], auth=AuthBearer())
-def list_images(request) -> Any:
-    """List all images for the current user."""
-    return Image.objects.filter(user=request.auth)
+# Model fields to load for each field a client can ask for
+IMAGE_LIST_COLUMNS = {name: name for name in IMAGE_LIST_FIELDS} | {'user_id': 'user'}
+
+def _image_row(image: Image, fields) -> dict:
+    row = {}
+    for name in fields:
+        value = getattr(image, name)
+        if name == 'image':
+            value = value.url if value else None
+        row[name] = value
+    return row
+
+@router.get("/", response={200: ImagePage, 400: Message}, auth=AuthBearer(), exclude_unset=True)
+def list_images(request, params: ImageListParams = Query(...)) -> Any:
+    """
+    List the current user's images, newest first.
+    Page with `before`/`after` cursors, filter by creation time and title prefix,
+    and pass `fields=id,image,variants` to receive only those fields.
+    """
+    fields = IMAGE_LIST_FIELDS
+    if params.fields:
+        fields = tuple(dict.fromkeys(name.strip() for name in params.fields.split(',') if name.strip()))
+        unknown = [name for name in fields if name not in IMAGE_LIST_COLUMNS]
+        if unknown:
+            return 400, {"detail": f"Unknown fields: {', '.join(unknown)}"}
+
+    images = Image.objects.filter(user=request.auth)
+    if params.created_after:
+        images = images.filter(created_at__gte=params.created_after)
+    if params.created_before:
+        images = images.filter(created_at__lt=params.created_before)
+    if params.title_prefix:
+        images = images.filter(title__startswith=params.title_prefix)
+    # The cursor needs created_at and id whatever was asked for
+    images = images.only('id', 'created_at', *(IMAGE_LIST_COLUMNS[name] for name in fields))
+
+    try:
+        page = keyset_paginate(
+            images,
+            before=params.before,
+            after=params.after,
+            limit=params.limit,
+            newest_first=True,
+        )
+    except InvalidCursor as e:
+        return 400, {"detail": str(e)}
+    page.items = [_image_row(image, fields) for image in page.items]
+    return page
 
 @router.post("/", response={201: ImageOut, 400: Message}, auth=AuthBearer())
 def create_image(
@@ -27,6 +94,7 @@ def create_image(
             description=payload.description,
             image=image
         )
+        process_image(image_obj, 'image', 'variants')
         return 201, image_obj
     except Exception as e:
         return 400, {"detail": str(e)}
@@ -42,10 +110,12 @@ def update_image(request, image_id: int, payload: ImageUpdate) -> Any:
     """Update an image."""
     image = get_object_or_404(Image, id=image_id, user=request.auth)
     
-    for attr, value in payload.dict(exclude_unset=True).items():
+    changes = payload.dict(exclude_unset=True)
+    for attr, value in changes.items():
         setattr(image, attr, value)
     
-    image.save()
+    if changes:
+        image.save(update_fields=[*changes, 'updated_at'])
     return image
 
 @router.delete("/{image_id}", response={204: None, 404: Message}, auth=AuthBearer())
@@ -54,3 +124,125 @@ def delete_image(request, image_id: int) -> Any:
     image = get_object_or_404(Image, id=image_id, user=request.auth)
     image.delete()
     return 204, None
+
+
+# Resumable uploads: init -> PUT chunks at the current offset -> finalize
+
+def _session_expiry():
+    return timezone.now() + timedelta(seconds=settings.IMAGE_UPLOADS['SESSION_TTL'])
+
+def _known_blob(session: UploadSession, lock: bool = False):
+    """A stored blob with the declared checksum, whose bytes need not be uploaded again."""
+    if not session.sha256:
+        return None
+    blobs = Blob.objects.select_for_update() if lock else Blob.objects
+    return blobs.filter(digest=session.sha256, size=session.size, refcount__gt=0).first()
+
+def _with_offset(session: UploadSession) -> UploadSession:
+    offset = uploads.current_offset(session.id)
+    if offset == 0 and _known_blob(session) is not None:
+        # Identical bytes are already stored, the client can finalize right away
+        offset = session.size
+    session.offset = offset
+    return session
+
+@router.post("/uploads/", response={201: UploadSessionOut, 400: Message}, auth=AuthBearer())
+def init_upload(request, payload: UploadInit) -> Any:
+    """Start a resumable upload of an image of `size` bytes."""
+    extension = os.path.splitext(payload.filename)[1].lstrip('.').lower()
+    if extension not in get_available_image_extensions():
+        return 400, {"detail": f"Unsupported image type: {payload.filename}"}
+    if payload.size > settings.IMAGE_UPLOADS['MAX_SIZE']:
+        return 400, {"detail": f"Uploads are limited to {settings.IMAGE_UPLOADS['MAX_SIZE']} bytes"}
+
+    session = UploadSession.objects.create(
+        user=request.auth,
+        filename=os.path.basename(payload.filename),
+        size=payload.size,
+        sha256=(payload.sha256 or '').lower(),
+        title=payload.title,
+        description=payload.description or '',
+        expires_at=_session_expiry(),
+    )
+    return 201, _with_offset(session)
+
+@router.get("/uploads/{uuid:upload_id}", response={200: UploadSessionOut, 404: Message}, auth=AuthBearer())
+def get_upload(request, upload_id: UUID) -> Any:
+    """Report how many bytes have been received, to resume from there."""
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.auth)
+    return _with_offset(session)
+
+@router.put("/uploads/{uuid:upload_id}", response={200: UploadSessionOut, 400: Message, 404: Message, 409: UploadConflictOut}, auth=AuthBearer())
+def upload_chunk(request, upload_id: UUID, offset: int) -> Any:
+    """
+    Write the raw request body at `offset`, which must equal the current offset.
+    The body is streamed to the staging file, so chunks may be any size.
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.auth)
+    remaining = session.size - offset
+    content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    if offset < 0 or content_length > remaining:
+        return 400, {"detail": f"Chunk exceeds the declared size of {session.size} bytes"}
+
+    try:
+        uploads.write_chunk(session.id, request, offset, remaining)
+    except uploads.UploadConflict as e:
+        return 409, {"detail": str(e), "offset": e.offset}
+
+    UploadSession.objects.filter(id=session.id).update(expires_at=_session_expiry())
+    return _with_offset(session)
+
+@router.post("/uploads/{uuid:upload_id}/finalize", response={201: ImageOut, 400: Message, 404: Message, 409: UploadConflictOut}, auth=AuthBearer())
+def finalize_upload(request, upload_id: UUID, payload: UploadFinalize) -> Any:
+    """Verify the SHA-256 of the received bytes and create the image."""
+    with transaction.atomic():
+        # The row lock makes a repeated finalize wait and then 404 instead of creating a second image
+        session = get_object_or_404(
+            UploadSession.objects.select_for_update(),
+            id=upload_id,
+            user=request.auth,
+        )
+        expected = (payload.sha256 or session.sha256).lower()
+        received = uploads.current_offset(session.id)
+        # Locked so the blob cannot be collected before the new image references it
+        blob = _known_blob(session, lock=True) if received == 0 and expected == session.sha256 else None
+
+        if blob is not None:
+            image = Image(user=request.auth, title=session.title, description=session.description)
+            image.image.name = blob.name
+            # Reuse the renditions of an earlier image with the same bytes
+            image.variants = (
+                Image.objects.filter(image=blob.name).exclude(variants={}).values_list('variants', flat=True).first()
+                or {}
+            )
+            image.save()
+        else:
+            if received != session.size:
+                return 409, {"detail": f"Upload incomplete: {received} of {session.size} bytes", "offset": received}
+            if not expected:
+                return 400, {"detail": "A sha256 checksum is required"}
+            if uploads.sha256_of(session.id) != expected:
+                session.delete()
+                transaction.on_commit(lambda: uploads.discard(upload_id))
+                return 400, {"detail": "Checksum mismatch, the upload has been discarded"}
+
+            with uploads.part_path(session.id).open('rb') as part:
+                image = Image.objects.create(
+                    user=request.auth,
+                    title=session.title,
+                    description=session.description,
+                    image=DjangoFile(part, name=session.filename),
+                )
+        session.delete()
+        transaction.on_commit(lambda: uploads.discard(upload_id))
+        if not image.variants:
+            process_image(image, 'image', 'variants')
+    return 201, image
+
+@router.delete("/uploads/{uuid:upload_id}", response={204: None, 404: Message}, auth=AuthBearer())
+def abort_upload(request, upload_id: UUID) -> Any:
+    """Abandon an upload and drop the received bytes."""
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.auth)
+    session.delete()
+    uploads.discard(upload_id)
+    return 204, None
@@ -0,0 +1,64 @@
+"""
+Reference counts for files in the content-addressed storage.
+
+Every row whose file field points at a ``cas/`` name holds one reference.
+``acquire`` and ``release`` run inside the saving transaction; a blob whose
+count drops to zero is deleted together with its file and the variants
+rendered from it after commit, unless another row picked it up again in the
+meantime.
+"""
+import logging
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from core.storage import content_addressed_storage
+from .models import Blob
+from .processing import delete_variants
+
+logger = logging.getLogger(__name__)
+
+
+def is_managed(name: str) -> bool:
+    return bool(name) and name.startswith(f'{content_addressed_storage.prefix}/')
+
+
+def acquire(name: str) -> None:
+    if not is_managed(name):
+        return
+    updated = Blob.objects.filter(name=name).update(refcount=F('refcount') + 1)
+    # Either this transaction now holds the row lock, or there is no row to
+    # collect: the file cannot go away any more, put it back if it already did
+    if not content_addressed_storage.settle(name):
+        logger.error(f"Blob {name} is referenced but its file is missing")
+    if updated:
+        return
+    digest = name.rsplit('/', 1)[-1].split('.', 1)[0]
+    size = content_addressed_storage.size(name) if content_addressed_storage.exists(name) else 0
+    try:
+        with transaction.atomic():
+            Blob.objects.create(name=name, digest=digest, size=size, refcount=1)
+    except IntegrityError:
+        # Created concurrently by another upload of the same bytes
+        Blob.objects.filter(name=name).update(refcount=F('refcount') + 1)
+
+
+def release(name: str) -> None:
+    if not is_managed(name):
+        return
+    Blob.objects.filter(name=name, refcount__gt=0).update(refcount=F('refcount') - 1)
+    transaction.on_commit(lambda: collect(name))
+
+
+def collect(name: str) -> None:
+    """Delete ``name`` if nothing references it any more."""
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(name=name).first()
+        # Checked under the row lock: an acquire since the release has either
+        # raised the count already or waits for this transaction to end
+        if blob is None or blob.refcount > 0:
+            return
+        try:
+            content_addressed_storage.delete(name)
+        except OSError:
+            logger.exception(f"Failed to delete unreferenced blob {name}")
+        delete_variants(name)
+        blob.delete()
@@ -0,0 +1,37 @@
+import time
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from core.storage import content_addressed_storage
+from images import uploads
+from images.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = "Delete expired resumable upload sessions and staging files that no session refers to."
+
+    def handle(self, *args, **options):
+        expired = list(UploadSession.objects.filter(expires_at__lt=timezone.now()).values_list('id', flat=True))
+        UploadSession.objects.filter(id__in=expired).delete()
+        for session_id in expired:
+            uploads.discard(session_id)
+
+        # Part files left behind by a crash between deleting a session and its file
+        live = {str(session_id) for session_id in UploadSession.objects.values_list('id', flat=True)}
+        cutoff = time.time() - settings.IMAGE_UPLOADS['SESSION_TTL']
+        strays = 0
+        for part in uploads.upload_dir().glob('*.part'):
+            if part.stem not in live and part.stat().st_mtime < cutoff:
+                part.unlink(missing_ok=True)
+                strays += 1
+
+        # Copies kept by content-addressed saves that never settled, e.g. a failed request
+        tmp_dir = Path(content_addressed_storage.path(f'{content_addressed_storage.prefix}/tmp'))
+        if tmp_dir.is_dir():
+            for tmp in tmp_dir.iterdir():
+                if tmp.is_file() and tmp.stat().st_mtime < cutoff:
+                    tmp.unlink(missing_ok=True)
+                    strays += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Purged {len(expired)} expired sessions and {strays} stray files"))
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("images", "0002_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="variants",
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
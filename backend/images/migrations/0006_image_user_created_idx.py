@@ -0,0 +1,20 @@
+# Generated by Django 5.1.3 on 2026-10-18 14:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("images", "0005_blob_alter_image_image"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="image",
+            index=models.Index(
+                fields=["user", "created_at", "id"], name="images_user_created_idx"
+            ),
+        ),
+    ]
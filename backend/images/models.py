@@ -1,5 +1,7 @@
+import uuid
 from django.db import models
 from django.conf import settings
+from core.storage import content_addressed_storage
 
 # Create your models here.
 
@@ -8,12 +10,46 @@ class Image(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='images')
     title = models.CharField(max_length=200)
     description = models.TextField(blank=True)
-    image = models.ImageField(upload_to='user_images/')
+    image = models.ImageField(upload_to='user_images/', storage=content_addressed_storage)
+    # Resized renditions filled in by images.processing: {name: {width, height, webp, jpeg}}
+    variants = models.JSONField(default=dict, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of a user's library
+            models.Index(fields=['user', 'created_at', 'id'], name='images_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} - {self.user.username}"
+
+
+class UploadSession(models.Model):
+    """A resumable upload in progress; the bytes live in images.uploads part files."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64, blank=True)
+    title = models.CharField(max_length=200)
+    description = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.size} bytes) - {self.user_id}"
+
+
+class Blob(models.Model):
+    """A content-addressed file and how many rows reference it, maintained by images.blobs."""
+    name = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} refs)"
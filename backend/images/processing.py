@@ -0,0 +1,221 @@
+"""
+Background rendering of resized image variants.
+
+Uploads are stored untouched; once the transaction commits the original is
+handed to a process pool that decodes it once with Pillow and encodes a
+fixed set of EXIF-stripped WebP and JPEG variants. The parent process saves
+them beside the original as ``<digest>-<tag>-<variant>.<format>``, plus a
+``<digest>-<tag>-variants.json`` manifest of their URLs and dimensions, and
+records the same in the model's variants JSON field. Identical uploads share
+one original, so they reuse its manifest instead of rendering again. The tag
+hashes the Pillow version and the sizes and qualities below, so changing any
+of them renders new files instead of overwriting ones served as immutable.
+"""
+import hashlib
+import json
+import logging
+import posixpath
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache, partial
+from importlib import metadata
+from io import BytesIO
+from multiprocessing import get_context
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from core.storage import content_addressed_storage
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels, largest first so each variant is resized from the previous one
+VARIANT_SIZES = (
+    ('large', 1600),
+    ('medium', 640),
+    ('thumb', 160),
+)
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def render_variants(data: bytes) -> dict:
+    """
+    Decode ``data`` once and encode every variant.
+
+    Runs in a worker process, so it only depends on Pillow. Images are never
+    upscaled, and EXIF (including GPS data) is dropped after the orientation
+    has been applied to the pixels.
+    """
+    from PIL import Image as PILImage, ImageOps
+
+    with PILImage.open(BytesIO(data)) as source:
+        # Let the JPEG decoder downscale while decoding when the original is huge
+        largest = VARIANT_SIZES[0][1]
+        source.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(source)
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    rendered = {}
+    for name, size in VARIANT_SIZES:
+        if max(image.size) > size:
+            image = image.copy()
+            image.thumbnail((size, size), PILImage.Resampling.LANCZOS)
+
+        webp = BytesIO()
+        image.save(webp, 'WEBP', quality=WEBP_QUALITY, method=4)
+
+        # JPEG has no alpha channel, flatten onto white
+        flat = image
+        if has_alpha:
+            flat = PILImage.new('RGB', image.size, (255, 255, 255))
+            flat.paste(image, mask=image.getchannel('A'))
+        jpeg = BytesIO()
+        flat.save(jpeg, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+
+        rendered[name] = {
+            'width': image.width,
+            'height': image.height,
+            'webp': webp.getvalue(),
+            'jpeg': jpeg.getvalue(),
+        }
+    return rendered
+
+
+@cache
+def variants_tag() -> str:
+    """Short hash of everything that decides the rendered bytes."""
+    try:
+        pillow = metadata.version('Pillow')
+    except metadata.PackageNotFoundError:
+        pillow = ''
+    params = json.dumps([pillow, VARIANT_SIZES, WEBP_QUALITY, JPEG_QUALITY])
+    return hashlib.sha256(params.encode()).hexdigest()[:8]
+
+
+def _variant_stem(source_name: str) -> str:
+    # cas/aa/bb/<digest>.jpg -> cas/aa/bb/<digest>-<tag>
+    return f'{posixpath.splitext(source_name)[0]}-{variants_tag()}'
+
+
+def variant_name(source_name: str, name: str, fmt: str) -> str:
+    return f'{_variant_stem(source_name)}-{name}.{fmt}'
+
+
+def manifest_name(source_name: str) -> str:
+    return f'{_variant_stem(source_name)}-variants.json'
+
+
+def stored_variants(source_name: str):
+    """Return the variants already rendered from ``source_name``, or ``None``."""
+    try:
+        with content_addressed_storage.open(manifest_name(source_name), 'rb') as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return None
+
+
+def save_variants(source_name: str, rendered: dict) -> dict:
+    """Store rendered variants beside the original and return their URLs and dimensions."""
+    storage = content_addressed_storage
+    variants = {}
+    for name, variant in rendered.items():
+        entry = {'width': variant['width'], 'height': variant['height']}
+        for fmt in ('webp', 'jpeg'):
+            target = storage.save_derived(variant_name(source_name, name, fmt), ContentFile(variant[fmt]))
+            entry[fmt] = storage.url(target)
+        variants[name] = entry
+    # Written last, so a manifest always describes a complete set
+    storage.save_derived(manifest_name(source_name), ContentFile(json.dumps(variants).encode()))
+    if not storage.exists(source_name):
+        # The blob was collected while we rendered; nothing would delete these later
+        delete_variants(source_name)
+    return variants
+
+
+def delete_variants(source_name: str) -> None:
+    """Delete every file rendered from ``source_name`` with any tag, called when its blob is collected."""
+    storage = content_addressed_storage
+    directory, filename = posixpath.split(source_name)
+    prefix = f'{posixpath.splitext(filename)[0]}-'
+    try:
+        _, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in files:
+        if name.startswith(prefix):
+            try:
+                storage.delete(posixpath.join(directory, name))
+            except OSError:
+                logger.exception(f"Failed to delete image variant {name}")
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned workers only import Pillow; forking would copy the server's threads and sockets
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_PROCESSING['WORKERS'],
+                mp_context=get_context('spawn'),
+            )
+        return _pool
+
+
+def _record(model, pk, field_name, variants_field, source_name, variants):
+    # Only record the variants if the field still points at the file they were rendered from
+    model._default_manager.filter(pk=pk, **{field_name: source_name}).update(**{variants_field: variants})
+
+
+def _finish(model, pk, field_name, variants_field, source_name, future):
+    close_old_connections()
+    try:
+        _record(model, pk, field_name, variants_field, source_name, save_variants(source_name, future.result()))
+    except Exception:
+        logger.exception(f"Failed to process {model.__name__} {pk} image {source_name}")
+    finally:
+        close_old_connections()
+
+
+def _submit(model, pk, field_name, variants_field, source_name):
+    variants = stored_variants(source_name)
+    if variants is not None:
+        # The same bytes were uploaded before
+        try:
+            _record(model, pk, field_name, variants_field, source_name, variants)
+        except Exception:
+            logger.exception(f"Failed to record {model.__name__} {pk} image variants of {source_name}")
+        return
+
+    try:
+        with model._meta.get_field(field_name).storage.open(source_name, 'rb') as source:
+            data = source.read()
+    except OSError:
+        logger.exception(f"Could not read {source_name} for processing")
+        return
+
+    if settings.IMAGE_PROCESSING['WORKERS'] <= 0:
+        try:
+            _record(model, pk, field_name, variants_field, source_name, save_variants(source_name, render_variants(data)))
+        except Exception:
+            logger.exception(f"Failed to process {model.__name__} {pk} image {source_name}")
+        return
+
+    future = get_pool().submit(render_variants, data)
+    future.add_done_callback(partial(_finish, model, pk, field_name, variants_field, source_name))
+
+
+def process_image(instance, field_name: str, variants_field: str) -> None:
+    """
+    Render variants of ``instance.<field_name>`` once the current transaction commits.
+
+    The request only pays for reading the stored original back; decoding and
+    encoding happen on the process pool (or inline when ``WORKERS`` is 0).
+    """
+    file = getattr(instance, field_name)
+    if not file:
+        return
+    transaction.on_commit(partial(_submit, type(instance), instance.pk, field_name, variants_field, file.name))
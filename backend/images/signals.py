@@ -0,0 +1,58 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_init, post_save
+from groups.models import Group
+from . import blobs
+from .models import Image
+
+# Models whose file fields live in the content-addressed storage
+TRACKED_FIELDS = {
+    Image: ('image',),
+    get_user_model(): ('avatar',),
+    Group: ('avatar',),
+}
+UNKNOWN = object()
+
+
+def _stored_name(value):
+    if not value:
+        return None
+    return getattr(value, 'name', value)
+
+
+def _snapshot(instance, fields):
+    # Deferred fields are not loaded, so their previous value is unknown
+    instance._blob_names = {
+        field: _stored_name(instance.__dict__[field]) if field in instance.__dict__ else UNKNOWN
+        for field in fields
+    }
+
+
+def track_loaded(sender, instance, **kwargs):
+    _snapshot(instance, TRACKED_FIELDS[sender])
+
+
+def track_saved(sender, instance, created, update_fields=None, **kwargs):
+    fields = TRACKED_FIELDS[sender]
+    previous = getattr(instance, '_blob_names', {})
+    for field in fields:
+        if update_fields is not None and field not in update_fields:
+            continue
+        name = getattr(instance, field).name or None
+        old = None if created else previous.get(field, UNKNOWN)
+        if name == old:
+            continue
+        blobs.acquire(name)
+        if old and old is not UNKNOWN:
+            blobs.release(old)
+    _snapshot(instance, fields)
+
+
+def track_deleted(sender, instance, **kwargs):
+    for field in TRACKED_FIELDS[sender]:
+        blobs.release(getattr(instance, field).name)
+
+
+for model in TRACKED_FIELDS:
+    post_init.connect(track_loaded, sender=model, dispatch_uid=f'blobs_init_{model._meta.label}')
+    post_save.connect(track_saved, sender=model, dispatch_uid=f'blobs_save_{model._meta.label}')
+    post_delete.connect(track_deleted, sender=model, dispatch_uid=f'blobs_delete_{model._meta.label}')
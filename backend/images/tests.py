@@ -1,3 +1,422 @@
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from core.auth import create_access_token
+from core.principals import principal_cache
+from core.storage import content_addressed_storage
+from users.models import User
+from . import processing, uploads
+from .models import Blob, Image, UploadSession
+from .processing import (
+    delete_variants,
+    manifest_name,
+    process_image,
+    render_variants,
+    variant_name,
+    variants_tag,
+)
 
-# Create your tests here.
+# The shared cache tier without Redis, emptied before every test
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'images-tests'}}
+
+
+def image_bytes(size, mode='RGB', fmt='PNG', color=(200, 40, 40), **save_kwargs) -> bytes:
+    buffer = BytesIO()
+    PILImage.new(mode, size, color).save(buffer, fmt, **save_kwargs)
+    return buffer.getvalue()
+
+
+def decode(data: bytes):
+    image = PILImage.open(BytesIO(data))
+    image.load()
+    return image
+
+
+class MediaTestMixin:
+    """Media and upload staging in a temporary directory, with variants rendered inline."""
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        principal_cache.clear()
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.media_root = root / 'media'
+        self.enterContext(override_settings(
+            MEDIA_ROOT=self.media_root,
+            IMAGE_PROCESSING={'WORKERS': 0},
+            IMAGE_UPLOADS={**settings.IMAGE_UPLOADS, 'DIR': str(root / 'uploads')},
+        ))
+        self.user = User.objects.create_user(username='uploader', email='uploader@example.com', password='secret-pass-1')
+
+    def auth(self, user=None):
+        return {'HTTP_AUTHORIZATION': f'Bearer {create_access_token(user_id=(user or self.user).id)}'}
+
+    def create_image(self, data: bytes, filename='photo.png') -> Image:
+        return Image.objects.create(user=self.user, title='Photo', image=SimpleUploadedFile(filename, data))
+
+    def process(self, image: Image) -> Image:
+        with self.captureOnCommitCallbacks(execute=True):
+            process_image(image, 'image', 'variants')
+        image.refresh_from_db()
+        return image
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ImageProcessingTests(MediaTestMixin, TestCase):
+    def test_variants_are_recorded_after_commit(self):
+        image = self.create_image(image_bytes((2000, 1000)))
+        with self.captureOnCommitCallbacks() as callbacks:
+            process_image(image, 'image', 'variants')
+        image.refresh_from_db()
+        self.assertEqual(image.variants, {})
+
+        for callback in callbacks:
+            callback()
+        image.refresh_from_db()
+        self.assertEqual(
+            {name: (v['width'], v['height']) for name, v in image.variants.items()},
+            {'large': (1600, 800), 'medium': (640, 320), 'thumb': (160, 80)},
+        )
+        self.assertTrue(content_addressed_storage.exists(variant_name(image.image.name, 'thumb', 'webp')))
+        self.assertTrue(content_addressed_storage.exists(manifest_name(image.image.name)))
+        self.assertEqual(image.variants['thumb']['jpeg'], content_addressed_storage.url(variant_name(image.image.name, 'thumb', 'jpeg')))
+
+    def test_small_images_are_not_upscaled(self):
+        rendered = render_variants(image_bytes((100, 50)))
+        self.assertEqual({(v['width'], v['height']) for v in rendered.values()}, {(100, 50)})
+
+    def test_orientation_is_applied_and_exif_dropped(self):
+        exif = PILImage.Exif()
+        # Rotated 90 degrees clockwise by the camera
+        exif[0x0112] = 6
+        rendered = render_variants(image_bytes((200, 100), fmt='JPEG', exif=exif))
+
+        self.assertEqual((rendered['thumb']['width'], rendered['thumb']['height']), (100, 200))
+        for fmt in ('webp', 'jpeg'):
+            self.assertEqual(len(decode(rendered['thumb'][fmt]).getexif()), 0)
+
+    def test_transparency_is_flattened_onto_white_for_jpeg(self):
+        rendered = render_variants(image_bytes((50, 50), mode='RGBA', color=(0, 0, 0, 0)))
+        self.assertEqual(decode(rendered['thumb']['webp']).mode, 'RGBA')
+        jpeg = decode(rendered['thumb']['jpeg'])
+        self.assertEqual(jpeg.mode, 'RGB')
+        self.assertTrue(all(channel >= 250 for channel in jpeg.getpixel((25, 25))))
+
+    def test_identical_uploads_reuse_the_rendered_variants(self):
+        data = image_bytes((800, 600))
+        first = self.process(self.create_image(data))
+        second = self.create_image(data)
+        with mock.patch('images.processing.render_variants') as render:
+            second = self.process(second)
+        render.assert_not_called()
+        self.assertEqual(second.variants, first.variants)
+
+    def test_changing_the_rendering_parameters_changes_the_names(self):
+        self.addCleanup(variants_tag.cache_clear)
+        self.assertEqual(
+            variant_name('cas/ab/cd/abcd.png', 'thumb', 'webp'),
+            f'cas/ab/cd/abcd-{variants_tag()}-thumb.webp',
+        )
+        tag = variants_tag()
+        variants_tag.cache_clear()
+        with mock.patch.object(processing, 'JPEG_QUALITY', processing.JPEG_QUALITY + 1):
+            self.assertNotEqual(variants_tag(), tag)
+
+    def test_deleting_variants_removes_every_tag(self):
+        image = self.process(self.create_image(image_bytes((300, 300))))
+        name = image.image.name
+        stale = name.replace('.png', '-0ldt4g00-thumb.webp')
+        content_addressed_storage.save_derived(stale, ContentFile(b'old'))
+
+        delete_variants(name)
+        directory, _ = name.rsplit('/', 1)
+        _, files = content_addressed_storage.listdir(directory)
+        self.assertEqual(files, [name.rsplit('/', 1)[1]])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ResumableUploadTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = image_bytes((400, 300))
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def init(self, **fields):
+        payload = {'filename': 'photo.png', 'size': len(self.data), 'title': 'Holiday', **fields}
+        return self.client.post('/api/images/uploads/', payload, content_type='application/json', **self.auth())
+
+    def put(self, upload_id, offset, chunk):
+        return self.client.put(
+            f'/api/images/uploads/{upload_id}?offset={offset}', chunk,
+            content_type='application/octet-stream', **self.auth(),
+        )
+
+    def finalize(self, upload_id, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                f'/api/images/uploads/{upload_id}/finalize', fields,
+                content_type='application/json', **self.auth(),
+            )
+
+    def test_chunks_resume_from_the_received_offset(self):
+        upload_id = self.init(sha256=self.sha256).json()['id']
+        self.assertEqual(self.put(upload_id, 0, self.data[:1000]).json()['offset'], 1000)
+
+        # A client that lost track asks where to carry on
+        response = self.client.get(f'/api/images/uploads/{upload_id}', **self.auth())
+        self.assertEqual(response.json()['offset'], 1000)
+        self.assertEqual(self.put(upload_id, 1000, self.data[1000:]).json()['offset'], len(self.data))
+
+    def test_chunks_must_start_at_the_current_offset(self):
+        upload_id = self.init().json()['id']
+        self.put(upload_id, 0, self.data[:100])
+        response = self.put(upload_id, 50, self.data[50:200])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 100)
+        self.assertEqual(uploads.current_offset(upload_id), 100)
+
+    def test_chunks_beyond_the_declared_size_are_rejected(self):
+        upload_id = self.init().json()['id']
+        response = self.put(upload_id, 0, self.data + b'extra')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(uploads.current_offset(upload_id), 0)
+
+    def test_unsupported_and_oversized_uploads_are_refused(self):
+        self.assertEqual(self.init(filename='notes.txt').status_code, 400)
+        with override_settings(IMAGE_UPLOADS={**settings.IMAGE_UPLOADS, 'MAX_SIZE': 10}):
+            self.assertEqual(self.init().status_code, 400)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_finalize_creates_the_image_and_drops_the_session(self):
+        upload_id = self.init(sha256=self.sha256).json()['id']
+        self.put(upload_id, 0, self.data)
+        response = self.finalize(upload_id)
+
+        self.assertEqual(response.status_code, 201)
+        image = Image.objects.get(id=response.json()['id'])
+        self.assertEqual(image.title, 'Holiday')
+        with image.image.open('rb') as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertIn('thumb', image.variants)
+        self.assertFalse(UploadSession.objects.filter(id=upload_id).exists())
+        self.assertFalse(uploads.part_path(upload_id).exists())
+
+    def test_incomplete_uploads_cannot_be_finalized(self):
+        upload_id = self.init(sha256=self.sha256).json()['id']
+        self.put(upload_id, 0, self.data[:100])
+        response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 100)
+        self.assertFalse(Image.objects.exists())
+
+    def test_checksum_mismatch_discards_the_upload(self):
+        upload_id = self.init().json()['id']
+        self.put(upload_id, 0, self.data)
+        response = self.finalize(upload_id, sha256='0' * 64)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Image.objects.exists())
+        self.assertFalse(UploadSession.objects.filter(id=upload_id).exists())
+        self.assertFalse(uploads.part_path(upload_id).exists())
+
+    def test_a_checksum_is_required(self):
+        upload_id = self.init().json()['id']
+        self.put(upload_id, 0, self.data)
+        self.assertEqual(self.finalize(upload_id).status_code, 400)
+        self.assertTrue(UploadSession.objects.filter(id=upload_id).exists())
+
+    def test_known_bytes_finalize_without_being_uploaded(self):
+        existing = self.process(self.create_image(self.data))
+        response = self.init(sha256=self.sha256)
+        self.assertEqual(response.json()['offset'], len(self.data))
+
+        response = self.finalize(response.json()['id'])
+        self.assertEqual(response.status_code, 201)
+        image = Image.objects.get(id=response.json()['id'])
+        self.assertEqual(image.image.name, existing.image.name)
+        self.assertEqual(image.variants, existing.variants)
+        self.assertEqual(Blob.objects.get(name=existing.image.name).refcount, 2)
+
+    def test_sessions_belong_to_their_user(self):
+        upload_id = self.init().json()['id']
+        other = User.objects.create_user(username='other', email='other@example.com', password='secret-pass-1')
+        response = self.client.get(f'/api/images/uploads/{upload_id}', **self.auth(other))
+        self.assertEqual(response.status_code, 404)
+
+    def test_abort_drops_the_received_bytes(self):
+        upload_id = self.init().json()['id']
+        self.put(upload_id, 0, self.data[:100])
+        response = self.client.delete(f'/api/images/uploads/{upload_id}', **self.auth())
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(uploads.part_path(upload_id).exists())
+
+    def test_purge_removes_expired_sessions_and_stray_files(self):
+        live = self.init().json()['id']
+        expired = self.init().json()['id']
+        self.put(live, 0, self.data[:100])
+        self.put(expired, 0, self.data[:100])
+        UploadSession.objects.filter(id=expired).update(expires_at=timezone.now() - timedelta(seconds=1))
+        stray = uploads.upload_dir() / 'a-crashed-session.part'
+        stray.write_bytes(b'partial')
+        old = time.time() - settings.IMAGE_UPLOADS['SESSION_TTL'] - 60
+        os.utime(stray, (old, old))
+
+        call_command('purge_upload_sessions', stdout=StringIO())
+        self.assertEqual([str(session_id) for session_id in UploadSession.objects.values_list('id', flat=True)], [live])
+        self.assertTrue(uploads.part_path(live).exists())
+        self.assertFalse(uploads.part_path(expired).exists())
+        self.assertFalse(stray.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ContentAddressedStorageTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = image_bytes((64, 64))
+        self.digest = hashlib.sha256(self.data).hexdigest()
+
+    def delete(self, instance):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.delete()
+
+    def tmp_files(self):
+        tmp_dir = Path(content_addressed_storage.path('cas/tmp'))
+        return list(tmp_dir.iterdir()) if tmp_dir.is_dir() else []
+
+    def test_files_are_named_after_their_digest(self):
+        image = self.create_image(self.data, filename='Photo.PNG')
+        self.assertEqual(image.image.name, f'cas/{self.digest[:2]}/{self.digest[2:4]}/{self.digest}.png')
+
+    def test_identical_uploads_share_one_reference_counted_file(self):
+        first = self.create_image(self.data)
+        second = self.create_image(self.data)
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(Blob.objects.get(name=first.image.name).refcount, 2)
+        self.assertEqual(self.tmp_files(), [])
+
+    def test_the_file_is_deleted_with_its_last_reference(self):
+        first = self.process(self.create_image(self.data))
+        second = self.create_image(self.data)
+        name = first.image.name
+
+        self.delete(first)
+        self.assertTrue(content_addressed_storage.exists(name))
+        self.assertEqual(Blob.objects.get(name=name).refcount, 1)
+
+        self.delete(second)
+        self.assertFalse(content_addressed_storage.exists(name))
+        self.assertFalse(content_addressed_storage.exists(manifest_name(name)))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+
+    def test_replacing_an_avatar_releases_the_old_file(self):
+        self.user.avatar = SimpleUploadedFile('old.png', self.data)
+        self.user.save()
+        old = self.user.avatar.name
+
+        self.user.avatar = SimpleUploadedFile('new.png', image_bytes((64, 64), color=(0, 0, 255)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertFalse(content_addressed_storage.exists(old))
+        self.assertEqual(Blob.objects.get(name=self.user.avatar.name).refcount, 1)
+
+    def test_a_blob_referenced_again_before_collection_is_kept(self):
+        first = self.create_image(self.data)
+        name = first.image.name
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.delete()
+        self.create_image(self.data)
+
+        for callback in callbacks:
+            callback()
+        self.assertTrue(content_addressed_storage.exists(name))
+        self.assertEqual(Blob.objects.get(name=name).refcount, 1)
+
+    def test_settling_restores_a_file_collected_after_the_save(self):
+        first = self.create_image(self.data)
+        name = first.image.name
+        # Another request stores the same bytes, but has not referenced them yet
+        self.assertEqual(content_addressed_storage.save('again.png', ContentFile(self.data)), name)
+        self.delete(first)
+        self.assertFalse(content_addressed_storage.exists(name))
+
+        self.assertTrue(content_addressed_storage.settle(name))
+        with content_addressed_storage.open(name, 'rb') as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertEqual(self.tmp_files(), [])
+
+    def test_settling_drops_the_copy_when_the_file_survived(self):
+        name = self.create_image(self.data).image.name
+        content_addressed_storage.save('again.png', ContentFile(self.data))
+        self.assertEqual(len(self.tmp_files()), 1)
+        self.assertTrue(content_addressed_storage.settle(name))
+        self.assertEqual(self.tmp_files(), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ImageLibraryTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        data = image_bytes((32, 32))
+        self.start = timezone.now() - timedelta(days=10)
+        self.images = []
+        for i, title in enumerate(['Beach', 'Beach party', 'Mountain', 'Museum', 'Beach sunset']):
+            image = Image.objects.create(user=self.user, title=title, description='d', image=SimpleUploadedFile('p.png', data))
+            Image.objects.filter(id=image.id).update(created_at=self.start + timedelta(days=i))
+            self.images.append(image)
+        other = User.objects.create_user(username='stranger', email='stranger@example.com', password='secret-pass-1')
+        Image.objects.create(user=other, title='Beach', image=SimpleUploadedFile('p.png', data))
+
+    def list(self, **params):
+        return self.client.get('/api/images/', params, **self.auth())
+
+    def test_pages_walk_the_library_newest_first(self):
+        seen, cursor = [], None
+        while True:
+            page = self.list(limit=2, **({'before': cursor} if cursor else {})).json()
+            seen.extend(item['id'] for item in page['items'])
+            cursor = page.get('older_cursor')
+            if not cursor:
+                break
+        self.assertEqual(seen, [image.id for image in reversed(self.images)])
+
+    def test_newer_cursor_finds_later_uploads(self):
+        page = self.list().json()
+        newer = Image.objects.create(user=self.user, title='New', image=SimpleUploadedFile('p.png', image_bytes((8, 8))))
+        page = self.list(after=page['newer_cursor']).json()
+        self.assertEqual([item['id'] for item in page['items']], [newer.id])
+
+    def test_filters(self):
+        page = self.list(title_prefix='Beach').json()
+        self.assertEqual([item['title'] for item in page['items']], ['Beach sunset', 'Beach party', 'Beach'])
+
+        page = self.list(created_after=(self.start + timedelta(days=1)).isoformat(), created_before=(self.start + timedelta(days=3)).isoformat()).json()
+        self.assertEqual([item['id'] for item in page['items']], [self.images[2].id, self.images[1].id])
+
+    def test_sparse_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            page = self.list(fields='id,image').json()
+        self.assertEqual(set(page['items'][0]), {'id', 'image'})
+        self.assertTrue(page['items'][0]['image'].startswith('/media/cas/'))
+        listing = next(query['sql'] for query in queries if 'images_image' in query['sql'])
+        self.assertNotIn('description', listing)
+
+    def test_unknown_fields_and_bad_cursors_are_rejected(self):
+        self.assertEqual(self.list(fields='id,password').status_code, 400)
+        self.assertEqual(self.list(before='not-a-cursor').status_code, 400)
@@ -0,0 +1,81 @@
+"""
+Staging files for resumable uploads.
+
+Chunks are written straight to a per-session part file in
+``IMAGE_UPLOADS['DIR']``; the part file's size is the authoritative upload
+offset, so a chunk cut off mid-transfer resumes from the last byte that
+reached the disk. Concurrent writers to one session are rejected with a
+non-blocking ``flock``. The directory must be shared by every API worker.
+"""
+import fcntl
+import hashlib
+import os
+from pathlib import Path
+from django.conf import settings
+
+READ_SIZE = 64 * 1024
+
+
+class UploadConflict(Exception):
+    """Raised when a chunk does not start at the current offset or the session is busy."""
+
+    def __init__(self, detail: str, offset: int):
+        super().__init__(detail)
+        self.offset = offset
+
+
+def upload_dir() -> Path:
+    path = Path(settings.IMAGE_UPLOADS['DIR'])
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def part_path(session_id) -> Path:
+    return upload_dir() / f'{session_id}.part'
+
+
+def current_offset(session_id) -> int:
+    try:
+        return part_path(session_id).stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def write_chunk(session_id, stream, offset: int, limit: int) -> int:
+    """
+    Append up to ``limit`` bytes from ``stream`` at ``offset`` and return the new offset.
+
+    The stream is copied in small reads so the chunk is never held in memory.
+    """
+    fd = os.open(part_path(session_id), os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadConflict("Another chunk is being written to this upload", current_offset(session_id))
+        size = os.fstat(fd).st_size
+        if offset != size:
+            raise UploadConflict(f"Chunk must start at offset {size}", size)
+        os.lseek(fd, size, os.SEEK_SET)
+        remaining = limit
+        while remaining > 0:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            os.write(fd, data)
+            remaining -= len(data)
+        return os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+
+def sha256_of(session_id) -> str:
+    digest = hashlib.sha256()
+    with part_path(session_id).open('rb') as part:
+        for block in iter(lambda: part.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def discard(session_id) -> None:
+    part_path(session_id).unlink(missing_ok=True)
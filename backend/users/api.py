@@ -12,6 +12,7 @@ from core.schemas import (
     Message,
     LoginRequest
 )
+from images.processing import process_image
 
 router = Router(tags=["auth"])
 User = get_user_model()
@@ -39,6 +40,7 @@ def register(
             bio=payload.bio,
             avatar=avatar
         )
+        process_image(user, 'avatar', 'avatar_variants')
         return 201, user
     except Exception as e:
         return 400, {"detail": str(e)}
@@ -70,13 +72,22 @@ def update_me(
     avatar: UploadedFile = File(None)
 ) -> Any:
     """Update current user info."""
-    user = request.auth
+    # request.auth may be a cached copy, never write its columns back
+    user = User.objects.get(pk=request.auth.pk)
+    changed = []
     
     if payload.bio is not None:
         user.bio = payload.bio
+        changed.append('bio')
     
     if avatar:
         user.avatar = avatar
+        # Old renditions no longer match, new ones are rendered in the background
+        user.avatar_variants = {}
+        changed += ['avatar', 'avatar_variants']
     
-    user.save()
+    if changed:
+        user.save(update_fields=[*changed, 'updated_at'])
+    if avatar:
+        process_image(user, 'avatar', 'avatar_variants')
     return user
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:20
+
+import core.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0004_user_avatar_variants"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="user",
+            name="avatar",
+            field=models.ImageField(
+                blank=True,
+                null=True,
+                storage=core.storage.ContentAddressedStorage(),
+                upload_to="avatars/",
+            ),
+        ),
+    ]
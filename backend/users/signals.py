@@ -0,0 +1,16 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from core.principals import principal_cache
+
+User = get_user_model()
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_principal(sender, instance, **kwargs):
+    """Drop cached tokens and message senders so deactivation, password and profile changes apply at once."""
+    user_id = instance.pk
+    principal_cache.invalidate_user(user_id)
+    # Again once committed, in case another process reloaded the old row in between
+    transaction.on_commit(lambda: principal_cache.invalidate_user(user_id))
@@ -1,3 +1,118 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from core.auth import aauthenticate_token, authenticate_token, create_access_token
+from core.middleware import JWTAuthMiddleware
+from core.principals import PrincipalCache, principal_cache
+from .models import User
 
-# Create your tests here.
+# The shared cache tier without Redis, emptied before every test
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'users-tests'}}
+
+
+class PrincipalTestMixin:
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        principal_cache.clear()
+        self.user = User.objects.create_user(username='principal', email='principal@example.com', password='secret-pass-1')
+        self.token = create_access_token(user_id=self.user.id)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PrincipalCacheTests(PrincipalTestMixin, TestCase):
+    def test_repeated_lookups_skip_the_database(self):
+        self.assertEqual(authenticate_token(self.token), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(authenticate_token(self.token), self.user)
+
+    def test_deactivation_applies_at_once(self):
+        authenticate_token(self.token)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(authenticate_token(self.token))
+
+    def test_change_in_another_process_retires_entries(self):
+        authenticate_token(self.token)
+        # Another worker saving the user only replaces the shared version
+        caches['default'].set(principal_cache._version_key(self.user.id), 'elsewhere')
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticate_token(self.token), self.user)
+
+    def test_callers_get_their_own_copy(self):
+        authenticate_token(self.token).username = 'mutated'
+        self.assertEqual(authenticate_token(self.token).username, 'principal')
+
+    def test_invalid_and_expired_tokens_are_rejected(self):
+        expired = create_access_token(user_id=self.user.id, expires_delta=timedelta(seconds=-10))
+        self.assertIsNone(authenticate_token('not-a-token'))
+        self.assertIsNone(authenticate_token(expired))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = PrincipalCache(max_entries=2)
+        for i in range(3):
+            cache.set(f'token-{i}', self.user, '')
+        self.assertIsNone(cache.get('token-0'))
+        self.assertEqual(cache.get('token-2'), self.user)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_nothing_is_cached_without_a_shared_version(self):
+        cache = PrincipalCache()
+        cache.set('token', self.user, None)
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+class CapturingApp:
+    def __init__(self):
+        self.scope = None
+
+    async def __call__(self, scope, receive, send):
+        self.scope = scope
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WebSocketAuthTests(PrincipalTestMixin, TestCase):
+    def connect(self, query_string=b'', headers=()):
+        inner, fallback = CapturingApp(), CapturingApp()
+        middleware = JWTAuthMiddleware(inner, fallback=fallback)
+        scope = {'type': 'websocket', 'query_string': query_string, 'headers': list(headers)}
+        async_to_sync(middleware)(scope, None, None)
+        return inner.scope, fallback.scope
+
+    def test_token_in_query_string(self):
+        scope, _ = self.connect(query_string=f'token={self.token}'.encode())
+        self.assertEqual(scope['user'], self.user)
+
+    def test_token_in_authorization_header(self):
+        scope, _ = self.connect(headers=[(b'authorization', f'Bearer {self.token}'.encode())])
+        self.assertEqual(scope['user'], self.user)
+
+    def test_invalid_token_is_anonymous(self):
+        scope, fallback_scope = self.connect(query_string=b'token=nope')
+        self.assertIsInstance(scope['user'], AnonymousUser)
+        self.assertIsNone(fallback_scope)
+
+    def test_sockets_without_a_token_use_the_session_stack(self):
+        scope, fallback_scope = self.connect()
+        self.assertIsNone(scope)
+        self.assertIsNotNone(fallback_scope)
+
+    def test_sockets_share_the_http_principal_cache(self):
+        authenticate_token(self.token)
+        with self.assertNumQueries(0):
+            scope, _ = self.connect(query_string=f'token={self.token}'.encode())
+        self.assertEqual(scope['user'], self.user)
+
+    def test_concurrent_misses_share_one_lookup(self):
+        async def connect_many():
+            return await asyncio.gather(*(aauthenticate_token(self.token) for _ in range(5)))
+
+        with CaptureQueriesContext(connection) as queries:
+            users = async_to_sync(connect_many)()
+        self.assertEqual(users, [self.user] * 5)
+        self.assertEqual(len(queries), 1)